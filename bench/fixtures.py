@@ -0,0 +1,544 @@
+#!/usr/bin/env python
+##
+#
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of the tools originally by the HPC team of
+# Ghent University (http://ugent.be/hpc).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+##
+"""
+Stand-ins for the LDAP, Moab, PBS and GPFS, and the on-disk fixture they are served from.
+
+A Fixture is a directory, preferably on tmpfs, holding the synthetic data of a Workload and
+the directories the scripts write to. register_stand_ins registers modules in sys.modules that
+replace vsc.ldap, vsc.jobs.moab, vsc.administration.user, vsc.filesystem, vsc.gpfs and PBSQuery,
+which must happen before the modules in lib importing them are loaded. install_stand_ins points
+these at the fixture, after which the scripts can be loaded with load_script. The vsc-base modules
+and the modules in lib are the real ones.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import cPickle
+import imp
+import os
+import sys
+import tempfile
+import time
+
+from collections import namedtuple
+
+from vsc.utils import fancylogger
+from vsc.utils.ldap_snapshot import ldap_timestamp
+from vsc.utils.moab_collect import merge_information
+
+import generators
+
+logger = fancylogger.getLogger(__name__)
+
+TMPFS = '/dev/shm'
+BIN_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin')
+
+FILESYSTEM = 'scratchdelcatty'
+STORAGE = 'VSC_SCRATCH_DELCATTY'
+LOCATIONS = ['gengar', 'muk']
+
+# the LDAP entries that are not modified between runs were last modified at this time
+UNMODIFIED_TIMESTAMP = ldap_timestamp(generators.EPOCH)
+
+
+def tmpfs_directory(prefix='vsc-bench-'):
+    """Create a directory on tmpfs, or in the default temporary directory if there is no tmpfs."""
+    if os.path.isdir(TMPFS) and os.access(TMPFS, os.W_OK):
+        return tempfile.mkdtemp(prefix=prefix, dir=TMPFS)
+    logger.warning("No writable %s, the fixture is not on tmpfs" % (TMPFS))
+    return tempfile.mkdtemp(prefix=prefix)
+
+
+def _dump(filename, data):
+    f = open(filename, 'wb')
+    try:
+        cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+    finally:
+        f.close()
+
+
+def _load(filename):
+    f = open(filename, 'rb')
+    try:
+        return cPickle.load(f)
+    finally:
+        f.close()
+
+
+class Fixture(object):
+    """The synthetic data of a workload, and the directories the scripts use, under a single directory.
+
+    Layout:
+        workload.pickle                 the Workload
+        ldap.pickle                     the LDAP user and group entries
+        moab/<command>.<host>.pickle    what the Moab command returns for the host
+        gpfs/quota.pickle               the quota map and filesets of FILESYSTEM
+        gpfs/<fileset>/                 the fileset directories
+        storage/<user>/                 the user directories on STORAGE
+        home/<user>/                    the user pickle directories
+        state/                          the files the scripts keep between runs: digest indices, caches, ...
+        bench.log                       the log of the scripts
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.workload = _load(self.path('workload.pickle'))
+        self.ldap = None
+
+    def path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    def state(self, filename):
+        """The path of a file kept between runs."""
+        return self.path('state', filename)
+
+    @classmethod
+    def create(cls, directory, workload):
+        """Generate all data of the workload in the directory."""
+        for subdirectory in ['moab', 'gpfs', 'storage', 'home', 'state']:
+            os.mkdir(os.path.join(directory, subdirectory))
+
+        _dump(os.path.join(directory, 'workload.pickle'), workload)
+        _dump(os.path.join(directory, 'ldap.pickle'), generators.ldap_entries(workload))
+
+        # the information of a single command is generated at a time, to limit the memory use
+        for (command, generator) in [('showq', generators.showq_information),
+                                     ('checkjob', generators.checkjob_information)]:
+            for (host, information) in generator(workload).items():
+                _dump(os.path.join(directory, 'moab', "%s.%s.pickle" % (command, host)), information)
+
+        (quota_map, filesets) = generators.mmrepquota_map(workload, FILESYSTEM, os.path.join(directory, 'gpfs'))
+        _dump(os.path.join(directory, 'gpfs', 'quota.pickle'), (quota_map, filesets))
+        for fileset in filesets[FILESYSTEM].values():
+            if not os.path.isdir(fileset['path']):
+                os.mkdir(fileset['path'])
+
+        for user_id in workload.user_ids:
+            os.mkdir(os.path.join(directory, 'storage', user_id))
+            os.mkdir(os.path.join(directory, 'home', user_id))
+
+        return cls(directory)
+
+    def clusters(self, command):
+        """The clusters dict the scripts build from their configuration, for the given Moab command."""
+        return dict([(host, {'master': "master.%s.gent.vsc" % (host), 'path': "/opt/moab/bin/%s" % (command)})
+                     for host in self.workload.hosts])
+
+    def moab_information(self, command):
+        """The information the Moab command returns for all hosts together."""
+        information = {}
+        for host in self.workload.hosts:
+            merge_information(information, _load(self.path('moab', "%s.%s.pickle" % (command, host))))
+        return information
+
+    def quota(self):
+        """The quota map and filesets of FILESYSTEM."""
+        return _load(self.path('gpfs', 'quota.pickle'))
+
+    def user_id_map(self):
+        """Dict mapping the numerical UID to the user ID, as map_uids_to_names returns."""
+        return dict([(self.workload.uid_number(user), user_id) for (user, user_id) in enumerate(self.workload.user_ids)])
+
+
+class LdapFilter(object):
+    """Stand-in for vsc.ldap.filters.LdapFilter, supporting attr=value and attr>=value, combined with & and |."""
+
+    def __init__(self, expression=None, operator=None, children=None):
+        self.operator = operator
+        self.children = children
+        self._split = None
+        if expression is not None:
+            if '>=' in expression:
+                (self.attribute, self.value) = expression.split('>=', 1)
+                self.operator = '>='
+            else:
+                (self.attribute, self.value) = expression.split('=', 1)
+                self.operator = '='
+
+    def _combine(self, operator, other):
+        children = []
+        for ldap_filter in [self, other]:
+            if ldap_filter.operator == operator and ldap_filter.children is not None:
+                children.extend(ldap_filter.children)
+            else:
+                children.append(ldap_filter)
+        return LdapFilter(operator=operator, children=children)
+
+    def __and__(self, other):
+        return self._combine('&', other)
+
+    def __or__(self, other):
+        return self._combine('|', other)
+
+    def __str__(self):
+        if self.children is None:
+            return "(%s%s%s)" % (self.attribute, self.operator, self.value)
+        return "(%s%s)" % (self.operator, ''.join([str(child) for child in self.children]))
+
+    def _alternatives(self):
+        """Split the children of a | filter in a dict mapping the attribute to the set of values it may
+        be equal to, and the other children. This keeps matching a long list of alternatives cheap.
+        """
+        if self._split is None:
+            equalities = {}
+            others = []
+            for child in self.children:
+                if child.children is None and child.operator == '=':
+                    equalities.setdefault(child.attribute, set()).add(child.value)
+                else:
+                    others.append(child)
+            self._split = (equalities, others)
+        return self._split
+
+    def matches(self, entry):
+        """Does the entry (a dict of attributes) match the filter?"""
+        if self.operator == '&':
+            return all([child.matches(entry) for child in self.children])
+        elif self.operator == '|':
+            (equalities, others) = self._alternatives()
+            for (attribute, values) in equalities.items():
+                value = entry.get(attribute)
+                if isinstance(value, list):
+                    if values.intersection(value):
+                        return True
+                elif str(value) in values:
+                    return True
+            return any([child.matches(entry) for child in others])
+
+        value = entry.get(self.attribute)
+        if isinstance(value, list):
+            return self.value in value
+        elif self.operator == '>=':
+            return value is not None and str(value) >= self.value
+        return str(value) == self.value
+
+    def values(self, attribute):
+        """The set of values the filter allows for the attribute, or None if it does not restrict it."""
+        if self.children is None:
+            if self.attribute == attribute and self.operator == '=':
+                return set([self.value])
+            return None
+
+        child_values = [child.values(attribute) for child in self.children]
+        if self.operator == '|':
+            if [values for values in child_values if values is None]:
+                return None
+            return set().union(*child_values)
+
+        restricting = [values for values in child_values if values is not None]
+        if not restricting:
+            return None
+        return set.intersection(*restricting)
+
+
+class InstituteFilter(LdapFilter):
+    """Stand-in for vsc.ldap.filters.InstituteFilter."""
+
+    def __init__(self, institute):
+        super(InstituteFilter, self).__init__("institute=%s" % (institute))
+
+
+class LdapDirectory(object):
+    """In-memory stand-in for the VSC LDAP, counting the queries.
+
+    The users and groups are indexed by cn, so a filter selecting a set of cn values is cheap,
+    like it is on the LDAP server.
+    """
+
+    def __init__(self, filename):
+        (self.users, self.groups) = _load(filename)
+        self.entries = {'user': self.users, 'group': self.groups}
+        self.index = {
+            'user': dict([(entry['cn'], entry) for entry in self.users]),
+            'group': dict([(entry['cn'], entry) for entry in self.groups]),
+        }
+        self.queries = 0
+        self.modify()
+
+    def modify(self):
+        """Mark the entries that are modified between runs as modified now."""
+        now = ldap_timestamp(time.time())
+        for entry in self.users + self.groups:
+            if entry['modified']:
+                entry['modifyTimestamp'] = now
+            else:
+                entry['modifyTimestamp'] = UNMODIFIED_TIMESTAMP
+
+    def search(self, kind, ldap_filter):
+        """The entries of the given kind (user or group) matching the filter."""
+        self.queries += 1
+        names = ldap_filter.values('cn')
+        if names is None:
+            candidates = self.entries[kind]
+        else:
+            candidates = [self.index[kind][name] for name in names if name in self.index[kind]]
+        return [entry for entry in candidates if ldap_filter.matches(entry)]
+
+    def get(self, kind, name):
+        """The entry of the given kind with the given cn."""
+        self.queries += 1
+        return self.index[kind][name]
+
+
+class LdapEntity(object):
+    """Base class for the LDAP entity stand-ins, served from the LdapDirectory in the directory attribute."""
+    directory = None
+    kind = None
+
+    def __init__(self, name, entry=None):
+        if entry is None:
+            entry = self.directory.get(self.kind, name)
+        self._set(entry)
+
+    @classmethod
+    def lookup(cls, ldap_filter):
+        return [cls(entry['cn'], entry) for entry in cls.directory.search(cls.kind, ldap_filter)]
+
+
+class VscLdapUser(LdapEntity):
+    """Stand-in for vsc.ldap.entities.VscLdapUser."""
+    kind = 'user'
+
+    def _set(self, entry):
+        self.user_id = entry['cn']
+        self.gecos = entry['gecos']
+        self.status = entry['status']
+        self.institute = entry['institute']
+
+
+class VscLdapGroup(LdapEntity):
+    """Stand-in for vsc.ldap.entities.VscLdapGroup."""
+    kind = 'group'
+
+    def _set(self, entry):
+        self.group_id = entry['cn']
+        self.memberUid = entry['memberUid']
+        self.moderator = entry['moderator']
+
+
+class VscUser(object):
+    """Stand-in for vsc.administration.user.VscUser, which gets its LDAP entry when it is first needed."""
+    directory = None
+    storage_root = None
+
+    def __init__(self, user_id, entry=None):
+        self.user_id = user_id
+        self.entry = entry
+
+    @classmethod
+    def lookup(cls, ldap_filter):
+        return [cls(entry['cn'], entry) for entry in cls.directory.search('user', ldap_filter)]
+
+    def _get_path(self, storage):
+        if self.entry is None:
+            self.entry = self.directory.get('user', self.user_id)
+        return os.path.join(self.storage_root, self.entry['cn'])
+
+
+class UserPickleLocation(object):
+    """Stand-in for the per-location user classes in vsc.administration.user.cluster_user_pickle_location_map."""
+    home_root = None
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+    def pickle_path(self):
+        return os.path.join(self.home_root, self.user_id)
+
+
+def store_pickle_data_at_user(user_name, path, data):
+    """Stand-in for the store functions in vsc.administration.user.cluster_user_pickle_store_map.
+
+    The data is pickled to a temporary file, which is moved into place.
+    """
+    temp_path = "%s.tmp" % (path)
+    _dump(temp_path, data)
+    os.rename(temp_path, path)
+
+
+class MoabCommand(object):
+    """Base class for the Moab command stand-ins, serving the per-host pickles in the moab directory."""
+    directory = None
+    command = None
+
+    def __init__(self, clusters, cache_pickle=False, dry_run=False):
+        self.clusters = clusters
+
+    def get_moab_command_information(self):
+        information = {}
+        reported = []
+        failed = []
+        for host in sorted(self.clusters):
+            try:
+                host_information = _load(os.path.join(self.directory, "%s.%s.pickle" % (self.command, host)))
+            except (IOError, OSError), err:
+                logger.error("No %s information for host %s: %s" % (self.command, host, err))
+                failed.append(host)
+                continue
+            merge_information(information, host_information)
+            reported.append(host)
+        return (information, reported, failed)
+
+
+class Showq(MoabCommand):
+    """Stand-in for vsc.jobs.moab.showq.Showq."""
+    command = 'showq'
+
+
+class Checkjob(MoabCommand):
+    """Stand-in for vsc.jobs.moab.checkjob.Checkjob."""
+    command = 'checkjob'
+
+
+class CheckjobInfo(dict):
+    """Stand-in for vsc.jobs.moab.checkjob.CheckjobInfo."""
+    pass
+
+
+class PBSQuery(object):
+    """Stand-in for PBSQuery.PBSQuery, generating the jobs of the workload on every call."""
+    workload = None
+
+    def __init__(self, server=None):
+        self.server = server
+
+    def getjobs(self, attrib_list=None, job_list=None):
+        return dict(generators.pbs_jobs(self.workload, attrib_list))
+
+
+class GpfsOperations(object):
+    """Stand-in for vsc.filesystem.gpfs.GpfsOperations, with a single filesystem."""
+    fixture = None
+
+    def list_filesystems(self):
+        return {FILESYSTEM: {'defaultMountPoint': self.fixture.path('gpfs')}}
+
+    def list_filesets(self):
+        return self.fixture.quota()[1]
+
+    def list_quota(self):
+        return {FILESYSTEM: self.fixture.quota()[0]}
+
+
+QuotaInformation = namedtuple('QuotaInformation', ['timestamp', 'used', 'soft', 'hard', 'doubt', 'expired'])
+QuotaInformation.__module__ = __name__
+
+
+class QuotaEntity(object):
+    """Stand-in for vsc.filesystem.quota.entities.QuotaEntity."""
+
+    def __init__(self, storage, filesystem):
+        self.storage = storage
+        self.filesystem = filesystem
+        self.quota_map = {}
+
+    def update(self, fileset, used, soft, hard, doubt, expired, timestamp):
+        self.quota_map[fileset] = QuotaInformation(timestamp, used, soft, hard, doubt, expired)
+
+    def exceeds(self):
+        return any([quota.expired[0] or quota.used > quota.soft for quota in self.quota_map.values()])
+
+
+class QuotaUser(QuotaEntity):
+    """Stand-in for vsc.filesystem.quota.entities.QuotaUser."""
+
+    def __init__(self, storage, filesystem, user_id):
+        super(QuotaUser, self).__init__(storage, filesystem)
+        self.user_id = user_id
+
+
+class QuotaFileset(QuotaEntity):
+    """Stand-in for vsc.filesystem.quota.entities.QuotaFileset."""
+
+    def __init__(self, storage, filesystem, fileset_id):
+        super(QuotaFileset, self).__init__(storage, filesystem)
+        self.fileset_id = fileset_id
+
+
+class Unused(object):
+    """Stand-in for the classes the scripts create, but that do nothing of interest offline."""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+def _register(name, **attributes):
+    """Register a module with the given attributes, creating the missing parent packages."""
+    module = sys.modules.get(name)
+    if module is None:
+        module = imp.new_module(name)
+        sys.modules[name] = module
+        if '.' in name:
+            (parent, child) = name.rsplit('.', 1)
+            setattr(_register(parent), child, module)
+    for (attribute, value) in attributes.items():
+        setattr(module, attribute, value)
+    return module
+
+
+def register_stand_ins():
+    """Register the stand-in modules in sys.modules."""
+    _register('vsc.ldap.configuration', VscConfiguration=Unused)
+    _register('vsc.ldap.utils', LdapQuery=Unused)
+    _register('vsc.ldap.filters', LdapFilter=LdapFilter, InstituteFilter=InstituteFilter)
+    _register('vsc.ldap.entities', VscLdapUser=VscLdapUser, VscLdapGroup=VscLdapGroup)
+    _register('vsc.administration.user',
+              VscUser=VscUser,
+              cluster_user_pickle_location_map=dict([(location, UserPickleLocation) for location in LOCATIONS]),
+              cluster_user_pickle_store_map=dict([(location, store_pickle_data_at_user) for location in LOCATIONS]))
+    _register('vsc.jobs.moab.showq', Showq=Showq)
+    _register('vsc.jobs.moab.checkjob', Checkjob=Checkjob, CheckjobInfo=CheckjobInfo)
+    _register('vsc.filesystem.gpfs', GpfsOperations=GpfsOperations, GpfsQuota=generators.GpfsQuota)
+    _register('vsc.filesystem.quota.entities', QuotaUser=QuotaUser, QuotaFileset=QuotaFileset)
+    _register('vsc.gpfs.quota.report', GpfsQuotaMailReporter=Unused)
+    _register('PBSQuery', PBSQuery=PBSQuery)
+
+
+def install_stand_ins(fixture):
+    """Replace the LDAP, Moab, PBS and GPFS modules by the stand-ins serving the fixture.
+
+    The LdapDirectory is kept as the fixture's ldap attribute.
+    """
+    directory = LdapDirectory(fixture.path('ldap.pickle'))
+    fixture.ldap = directory
+    LdapEntity.directory = directory
+    VscUser.directory = directory
+    VscUser.storage_root = fixture.path('storage')
+    UserPickleLocation.home_root = fixture.path('home')
+    MoabCommand.directory = fixture.path('moab')
+    PBSQuery.workload = fixture.workload
+    GpfsOperations.fixture = fixture
+
+    register_stand_ins()
+
+
+def log_to_fixture(fixture):
+    """Log to the fixture's log file instead of the screen."""
+    fancylogger.logToScreen(False)
+    fancylogger.logToFile(fixture.path('bench.log'))
+
+
+def load_script(fixture, name):
+    """Load a script from the bin directory as a module, logging to the fixture's log file.
+
+    The stand-ins should have been installed.
+    """
+    log_to_file = fancylogger.logToFile
+    fancylogger.logToFile = lambda *args, **kwargs: None
+    try:
+        module = imp.load_source(name, os.path.join(BIN_DIRECTORY, "%s.py" % (name)))
+    finally:
+        fancylogger.logToFile = log_to_file
+
+    log_to_fixture(fixture)
+    return module
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+##
+#
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of the tools originally by the HPC team of
+# Ghent University (http://ugent.be/hpc).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+##
+"""
+Generators for synthetic input of the master scripts.
+
+A Workload fixes the users, their VO and LDAP status, and the jobs they have on the
+clusters. The generators turn it into what the scripts get from Moab (showq and checkjob),
+GPFS (mmrepquota) and PBS (qstat), scaled to the requested user, job and VO counts. The
+same parameters and seed always give the same data, so runs can be compared.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import os
+import random
+
+from collections import namedtuple
+
+DEFAULT_SEED = 42
+DEFAULT_HOSTS = 4
+DEFAULT_JOBS_PER_USER = 2
+DEFAULT_USERS_PER_VO = 20
+DEFAULT_ACTIVE_FRACTION = 0.2  # users that have jobs
+
+DEFAULT_VO = 'gvo00012'
+DEFAULT_VO_FRACTION = 0.2  # users that are only in the default VO
+GRACE_FRACTION = 0.02
+INACTIVE_FRACTION = 0.03
+EXCEEDING_FRACTION = 0.05  # quota entries over their soft limit
+
+USER_ID_BASE = 40000
+UID_NUMBER_BASE = 2540000
+VO_ID_BASE = 100  # stay clear of the default VO
+JOB_ID_BASE = 1000000
+
+# all generated timestamps are relative to this one, for reproducible data
+EPOCH = 1380000000
+
+SHOWQ_STATES = [('Running', 0.6), ('Idle', 0.3), ('Blocked', 0.1)]
+PBS_STATES = {'Running': 'R', 'Idle': 'Q', 'Blocked': 'H'}
+BLOCK_REASONS = ['IdlePolicy', 'BadDependency', 'Hold', 'SystemLimits']
+QUEUES = ['short', 'long', 'debug', 'bigmem']
+INSTITUTES = ['antwerpen', 'brussel', 'gent', 'leuven']
+
+GRACE_STRINGS = ['7 days', '6 days', '23 hours', '2 hours', 'expired']
+NO_GRACE = 'none'
+KIB_PER_GIB = 1024 * 1024
+
+GpfsQuota = namedtuple('GpfsQuota', ['name', 'blockUsage', 'blockQuota', 'blockLimit', 'blockInDoubt', 'blockGrace',
+                                     'filesUsage', 'filesQuota', 'filesLimit', 'filesInDoubt', 'filesGrace',
+                                     'remarks', 'quota', 'defQuota', 'fid', 'filesetname'])
+# Python 2.6 does not set the module of a namedtuple, which is needed to unpickle it
+GpfsQuota.__module__ = __name__
+
+
+def _weighted_choice(rng, choices):
+    """Pick a value from a list of (value, weight) tuples, the weights adding up to 1."""
+    point = rng.random()
+    for (value, weight) in choices:
+        point -= weight
+        if point < 0:
+            return value
+    return choices[-1][0]
+
+
+class Workload(object):
+    """The users, VOs and jobs of a synthetic cluster set.
+
+    The jobs are (job number, user index, host index, showq state) tuples. Every active user has
+    at least one job if there are enough jobs, the remaining jobs are spread at random over the
+    active users.
+    """
+
+    def __init__(self, users, jobs=None, vos=None, hosts=DEFAULT_HOSTS, active_fraction=DEFAULT_ACTIVE_FRACTION,
+                 seed=DEFAULT_SEED):
+        """Initialisation.
+
+        @type users: int, number of users
+        @type jobs: int, number of jobs, DEFAULT_JOBS_PER_USER per user if None
+        @type vos: int, number of VOs besides the default VO, one per DEFAULT_USERS_PER_VO users if None
+        @type hosts: int, number of clusters (Moab and PBS masters)
+        @type active_fraction: float, the fraction of users that has jobs
+        """
+        if jobs is None:
+            jobs = users * DEFAULT_JOBS_PER_USER
+        if vos is None:
+            vos = max(1, users // DEFAULT_USERS_PER_VO)
+
+        self.seed = seed
+        rng = random.Random(seed)
+
+        self.user_ids = ["vsc%05d" % (USER_ID_BASE + i) for i in xrange(users)]
+        self.hosts = ["cluster%02d" % (i) for i in xrange(hosts)]
+        self.vo_ids = ["gvo%05d" % (VO_ID_BASE + i) for i in xrange(vos)]
+
+        self.user_vo = []
+        self.user_status = []
+        for _ in xrange(users):
+            if rng.random() < DEFAULT_VO_FRACTION:
+                self.user_vo.append(DEFAULT_VO)
+            else:
+                self.user_vo.append(rng.choice(self.vo_ids))
+            self.user_status.append(_weighted_choice(rng, [('grace', GRACE_FRACTION),
+                                                           ('inactive', INACTIVE_FRACTION),
+                                                           ('active', 1.0)]))
+
+        active = rng.sample(xrange(users), max(1, int(users * active_fraction)))
+        self.jobs = []
+        for number in xrange(jobs):
+            if number < len(active):
+                user = active[number]
+            else:
+                user = rng.choice(active)
+            self.jobs.append((JOB_ID_BASE + number, user, number % hosts, _weighted_choice(rng, SHOWQ_STATES)))
+
+    def __str__(self):
+        return "%d users, %d jobs, %d VOs, %d hosts" % (len(self.user_ids), len(self.jobs), len(self.vo_ids),
+                                                       len(self.hosts))
+
+    def uid_number(self, user):
+        """The numerical UID of the user with the given index."""
+        return UID_NUMBER_BASE + user
+
+    def active_user_ids(self):
+        """The IDs of the users that have at least one job."""
+        return sorted(set([self.user_ids[user] for (_, user, _, _) in self.jobs]))
+
+    def vo_members(self):
+        """Dict mapping the VO ID (including the default VO) to the list of member user IDs."""
+        members = dict([(vo, []) for vo in self.vo_ids + [DEFAULT_VO]])
+        for (user, vo) in enumerate(self.user_vo):
+            members[vo].append(self.user_ids[user])
+        return members
+
+    def users_with_status(self, status):
+        """The IDs of the users with the given LDAP status."""
+        return [self.user_ids[user] for (user, user_status) in enumerate(self.user_status) if user_status == status]
+
+
+def showq_job(workload, job):
+    """The showq information of a single job, as parsed from the showq XML."""
+    (number, user, _, state) = job
+    information = {
+        'JobID': str(number),
+        'GJID': str(number),
+        'User': workload.user_ids[user],
+        'Group': workload.user_vo[user],
+        'Account': workload.user_vo[user],
+        'Class': QUEUES[number % len(QUEUES)],
+        'State': state,
+        'ReqAWDuration': str(3600 * (1 + number % 72)),
+        'ReqProcs': str(1 << (number % 6)),
+        'StartPriority': str(number % 10000),
+        'SubmissionTime': str(EPOCH - number % 604800),
+    }
+    if state == 'Running':
+        information['StartTime'] = str(EPOCH - number % 86400)
+        information['RemainingTime'] = str(number % 259200)
+        information['MasterHost'] = "node%04d" % (number % 2000)
+    elif state == 'Blocked':
+        information['BlockReason'] = BLOCK_REASONS[number % len(BLOCK_REASONS)]
+    return information
+
+
+def checkjob_job(workload, job):
+    """The checkjob information of a single job, which has more detail than its showq information."""
+    (number, user, host, state) = job
+    information = showq_job(workload, job)
+    information.update({
+        'EEDuration': str(number % 3600),
+        'Flags': 'RESTARTABLE',
+        'PAL': workload.hosts[host],
+        'QOS': 'normal',
+        'ReqNodes': str(1 + number % 4),
+        'StatPSDed': "%d.00" % (number % 100000),
+        'StatPSUtl': "%d.00" % (number % 90000),
+        'SubmitHost': "login%d.%s" % (number % 2, workload.hosts[host]),
+        'req': [{
+            'AllocNodeList': "node%04d" % (number % 2000),
+            'ReqMem': str(1024 * (1 + number % 8)),
+            'ReqProcPerTask': '1',
+            'TCReqMin': information['ReqProcs'],
+        }],
+    })
+    return information
+
+
+def showq_information(workload):
+    """The showq information of every host.
+
+    @returns: dict mapping the host to what Showq.get_moab_command_information returns for it, i.e.,
+              a dict mapping the user to the host to the state to the list of jobs
+    """
+    information = dict([(host, {}) for host in workload.hosts])
+    for job in workload.jobs:
+        (_, user, host, state) = job
+        host_name = workload.hosts[host]
+        states = information[host_name].setdefault(workload.user_ids[user], {}).setdefault(host_name, {})
+        states.setdefault(state, []).append(showq_job(workload, job))
+    return information
+
+
+def checkjob_information(workload):
+    """The checkjob information of every host.
+
+    @returns: dict mapping the host to what Checkjob.get_moab_command_information returns for it, i.e.,
+              a dict mapping the user to the host to the list of jobs
+    """
+    information = dict([(host, {}) for host in workload.hosts])
+    for job in workload.jobs:
+        (_, user, host, _) = job
+        host_name = workload.hosts[host]
+        jobs = information[host_name].setdefault(workload.user_ids[user], {}).setdefault(host_name, [])
+        jobs.append(checkjob_job(workload, job))
+    return information
+
+
+def _gpfs_quota(rng, name, fileset, quota_gib, exceeding_fraction):
+    """A single mmrepquota record, with the values as strings like the mmrepquota output."""
+    quota = quota_gib * KIB_PER_GIB
+    if rng.random() < exceeding_fraction:
+        usage = quota + rng.randint(1, quota // 10)
+        grace = rng.choice(GRACE_STRINGS)
+    else:
+        usage = rng.randint(0, quota)
+        grace = NO_GRACE
+    files = usage // 64
+    return GpfsQuota(name=name,
+                     blockUsage=str(usage),
+                     blockQuota=str(quota),
+                     blockLimit=str(quota + quota // 10),
+                     blockInDoubt=str(rng.randint(0, 1024)),
+                     blockGrace=grace,
+                     filesUsage=str(files),
+                     filesQuota='0',
+                     filesLimit='0',
+                     filesInDoubt='0',
+                     filesGrace=NO_GRACE,
+                     remarks='',
+                     quota='on',
+                     defQuota='off',
+                     fid=fileset,
+                     filesetname=fileset)
+
+
+def mmrepquota_map(workload, filesystem, root, exceeding_fraction=EXCEEDING_FRACTION):
+    """The mmrepquota information of a filesystem with a fileset per VO.
+
+    Every user has a USR record on the root fileset and on the fileset of his VO.
+
+    @type filesystem: string, the GPFS filesystem name
+    @type root: string, the directory the filesets are located in
+
+    @returns: tuple (quota map, as GpfsOperations.list_quota returns for the filesystem, i.e.,
+                     {'USR': {uid: [GpfsQuota]}, 'FILESET': {fileset ID: [GpfsQuota]}},
+                     filesets, as GpfsOperations.list_filesets returns them)
+    """
+    rng = random.Random(workload.seed)
+
+    fileset_ids = {'root': '0'}
+    filesets = {'0': {'filesetName': 'root', 'path': root}}
+    for (number, vo) in enumerate([DEFAULT_VO] + workload.vo_ids):
+        fileset_id = str(number + 1)
+        fileset_ids[vo] = fileset_id
+        filesets[fileset_id] = {'filesetName': vo, 'path': os.path.join(root, vo)}
+
+    user_quota = {}
+    for (user, user_id) in enumerate(workload.user_ids):
+        uid = str(workload.uid_number(user))
+        user_quota[uid] = [_gpfs_quota(rng, user_id, fileset_ids['root'], 25, exceeding_fraction),
+                           _gpfs_quota(rng, user_id, fileset_ids[workload.user_vo[user]], 250, exceeding_fraction)]
+
+    fileset_quota = {}
+    for (fileset_id, fileset) in filesets.items():
+        fileset_quota[fileset_id] = [_gpfs_quota(rng, fileset['filesetName'], fileset_id, 10240, exceeding_fraction)]
+
+    return ({'USR': user_quota, 'FILESET': fileset_quota}, {filesystem: filesets})
+
+
+def pbs_job(workload, job, attributes=None):
+    """The PBS information of a single job, as PBSQuery returns it: every value is a list of strings.
+
+    @type attributes: list of attribute names to keep, all attributes if None
+
+    @returns: tuple (job name, dict mapping the attribute to its values)
+    """
+    (number, user, host, state) = job
+    user_id = workload.user_ids[user]
+    server = "master.%s.gent.vsc" % (workload.hosts[host])
+    home = "/user/home/gent/%s/%s" % (user_id[:6], user_id)
+    information = {
+        'Job_Name': ["job%d" % (number)],
+        'Job_Owner': ["%s@login.%s" % (user_id, server)],
+        'euser': [user_id],
+        'egroup': [workload.user_vo[user]],
+        'job_state': [PBS_STATES[state]],
+        'queue': [QUEUES[number % len(QUEUES)]],
+        'server': [server],
+        'ctime': [str(EPOCH - number % 604800)],
+        'qtime': [str(EPOCH - number % 604800)],
+        'etime': [str(EPOCH - number % 604800)],
+        'mtime': [str(EPOCH - number % 3600)],
+        'Checkpoint': ['u'],
+        'Error_Path': ["login.%s:%s/job%d.e%d" % (server, home, number, number)],
+        'Output_Path': ["login.%s:%s/job%d.o%d" % (server, home, number, number)],
+        'Hold_Types': ['n'],
+        'Join_Path': ['oe'],
+        'Keep_Files': ['n'],
+        'Mail_Points': ['a'],
+        'Priority': ['0'],
+        'Rerunable': ['True'],
+        'Resource_List.nodect': ['1'],
+        'Resource_List.nodes': ["1:ppn=%d" % (1 << (number % 4))],
+        'Resource_List.vmem': ["%dgb" % (1 + number % 16)],
+        'Resource_List.walltime': ["%d:00:00" % (1 + number % 72)],
+        'Variable_List': [','.join(["PBS_O_HOME=%s" % (home),
+                                    "PBS_O_LOGNAME=%s" % (user_id),
+                                    "PBS_O_PATH=/usr/local/bin:/usr/bin:/bin",
+                                    "PBS_O_SHELL=/bin/bash",
+                                    "PBS_O_HOST=login.%s" % (server),
+                                    "PBS_O_WORKDIR=%s" % (home),
+                                    "PBS_O_QUEUE=%s" % (QUEUES[number % len(QUEUES)])])],
+        'fault_tolerant': ['False'],
+        'init_work_dir': [home],
+        'submit_args': ['job.sh'],
+        'submit_host': ["login.%s" % (server)],
+    }
+    if state == 'Running':
+        information.update({
+            'exec_host': ['+'.join(["node%04d/%d" % (number % 2000, core) for core in xrange(1 << (number % 4))])],
+            'start_time': [str(EPOCH - number % 86400)],
+            'start_count': ['1'],
+            'session_id': [str(number % 32768)],
+            'resources_used.cput': ["%d:00:00" % (number % 24)],
+            'resources_used.mem': ["%dkb" % (number % 4194304)],
+            'resources_used.vmem': ["%dkb" % (number % 8388608)],
+            'resources_used.walltime': ["%d:00:00" % (number % 24)],
+        })
+
+    if attributes is not None:
+        information = dict([(attribute, information[attribute]) for attribute in attributes if attribute in information])
+
+    return ("%d.%s" % (number, server), information)
+
+
+def pbs_jobs(workload, attributes=None):
+    """Generate the (job name, job information) tuples of all jobs, see pbs_job."""
+    for job in workload.jobs:
+        yield pbs_job(workload, job, attributes)
+
+
+def ldap_entries(workload, modified_fraction=0.01):
+    """The LDAP entries of the users and the VO groups.
+
+    A fraction of the entries is marked as modified, so an incremental refresh has something to do.
+
+    @returns: tuple (list of user attribute dicts, list of group attribute dicts). The entries do not have
+              a modifyTimestamp, instead the modified key is True for the entries that are modified between runs.
+    """
+    rng = random.Random(workload.seed)
+
+    users = []
+    for (user, user_id) in enumerate(workload.user_ids):
+        users.append({
+            'cn': user_id,
+            'uid': user_id,
+            'uidNumber': workload.uid_number(user),
+            'gecos': "User %s" % (user_id),
+            'institute': INSTITUTES[user % len(INSTITUTES)],
+            'status': workload.user_status[user],
+            'modified': rng.random() < modified_fraction,
+        })
+
+    groups = []
+    for (vo, members) in workload.vo_members().items():
+        groups.append({
+            'cn': vo,
+            'memberUid': members,
+            'moderator': members[:1],
+            'institute': 'gent',
+            'modified': rng.random() < modified_fraction,
+        })
+
+    return (users, groups)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+##
+#
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of the tools originally by the HPC team of
+# Ghent University (http://ugent.be/hpc).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+##
+"""
+Measurement of a single benchmark run: wall time per phase, peak memory and system calls.
+
+The phases are recorded by wrapping the functions of a script, so the scripts need not be
+changed. Phases may nest, e.g., the LDAP lookups inside the target determination. The system
+calls are the read and write calls in /proc/self/io, which are counted for all threads of the
+process. A full count of all system calls can be had by running the process under strace, see
+parse_strace_summary.
+
+The peak memory is that of the whole process, so every run should be done in a fresh process.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import resource
+import time
+
+from contextlib import contextmanager
+
+PROC_IO = '/proc/self/io'
+
+
+def peak_rss():
+    """The peak resident set size of this process so far, in KiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def io_counters():
+    """The number of read and write system calls of this process so far, or an empty dict if unknown."""
+    try:
+        f = open(PROC_IO)
+        try:
+            counters = dict([line.split(':', 1) for line in f.read().splitlines() if ':' in line])
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return {}
+    return {
+        'read': int(counters['syscr']),
+        'write': int(counters['syscw']),
+    }
+
+
+def _counter_overhead():
+    """The system calls counted for reading the counters themselves."""
+    first = io_counters()
+    second = io_counters()
+    return dict([(key, second[key] - first[key]) for key in second])
+
+_COUNTER_OVERHEAD = _counter_overhead()
+
+
+def _difference(end, start):
+    return dict([(key, end[key] - start[key] - _COUNTER_OVERHEAD[key]) for key in end if key in start])
+
+
+class Measurement(object):
+    """Records the phases of a run, and the peak memory and system calls of the run as a whole."""
+
+    def __init__(self):
+        self.phases = {}
+        self.order = []
+        self.counters = {}
+        self.prefix = ''
+
+        self._wrapped = []
+        self._start = None
+
+    def start(self):
+        """Start the measured part of the run, everything before it is setup."""
+        self._start = (time.time(), peak_rss(), io_counters())
+
+    @contextmanager
+    def phase(self, name):
+        """Record the time and system calls of the enclosed block under the name.
+
+        The time of a phase that is entered several times is accumulated.
+        """
+        name = self.prefix + name
+        if name not in self.phases:
+            self.phases[name] = {'calls': 0, 'seconds': 0.0, 'syscalls': {}}
+            self.order.append(name)
+
+        start_io = io_counters()
+        start = time.time()
+        try:
+            yield
+        finally:
+            phase = self.phases[name]
+            phase['calls'] += 1
+            phase['seconds'] += time.time() - start
+            for (key, value) in _difference(io_counters(), start_io).items():
+                phase['syscalls'][key] = phase['syscalls'].get(key, 0) + value
+
+    def wrap(self, owner, attribute, name=None):
+        """Record every call of the function owner.attribute as a phase.
+
+        @type owner: a module or class
+        @type name: the name of the phase, the attribute if None
+        """
+        function = getattr(owner, attribute)
+        if name is None:
+            name = attribute
+
+        def wrapper(*args, **kwargs):
+            with self.phase(name):
+                return function(*args, **kwargs)
+
+        self._wrapped.append((owner, attribute, owner.__dict__.get(attribute)))
+        setattr(owner, attribute, wrapper)
+
+    def unwrap(self):
+        """Restore the wrapped functions."""
+        while self._wrapped:
+            (owner, attribute, original) = self._wrapped.pop()
+            if original is None:
+                delattr(owner, attribute)
+            else:
+                setattr(owner, attribute, original)
+
+    def count(self, name, value):
+        """Record a counter, e.g., the number of LDAP queries."""
+        self.counters[name] = value
+
+    def result(self):
+        """Stop the measurement, and return the result as a dict."""
+        (start, start_rss, start_io) = self._start
+        return {
+            'seconds': time.time() - start,
+            'setup_rss': start_rss,
+            'peak_rss': peak_rss(),
+            'syscalls': _difference(io_counters(), start_io),
+            'phases': [(name, self.phases[name]) for name in self.order],
+            'counters': self.counters,
+        }
+
+
+def parse_strace_summary(filename):
+    """Parse the summary written by strace -c.
+
+    @returns: dict mapping the system call to the number of calls, with the total under 'total'
+    """
+    calls = {}
+    f = open(filename)
+    try:
+        for line in f:
+            fields = line.split()
+            # % time, seconds, usecs/call, calls, [errors], syscall
+            if len(fields) < 5 or not fields[3].isdigit():
+                continue
+            calls[fields[-1]] = int(fields[3])
+    finally:
+        f.close()
+    return calls
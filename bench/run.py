@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+##
+#
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of the tools originally by the HPC team of
+# Ghent University (http://ugent.be/hpc).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+##
+"""
+Offline benchmark of the master scripts on synthetic workloads.
+
+For every size (number of users), a fixture with the synthetic Moab, GPFS, PBS and LDAP data
+is generated on tmpfs. Every scenario then runs in a fresh process, against stand-ins for the
+LDAP, Moab, PBS and GPFS serving the fixture, recording the wall time per phase, the peak memory
+and the number of system calls. With --strace, the scenario is run a second time under strace,
+to count all system calls; the timings of that run are not used.
+
+The results can be stored with --output, and compared to an earlier result with --baseline, in which
+case the exit code is 1 if a phase got slower, or the peak memory grew, by more than --tolerance.
+
+Requires vsc-base. The modules in lib are taken from this checkout, the other vsc packages,
+PBSQuery and the masters are not needed.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import vsc.utils
+
+# the modules in lib are installed next to those of vsc-base, use the ones in this checkout
+LIB_UTILS_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lib', 'vsc', 'utils')
+vsc.utils.__path__.insert(0, LIB_UTILS_DIRECTORY)
+
+from vsc.utils import fancylogger
+from vsc.utils.generaloption import simple_option
+
+from fixtures import Fixture, install_stand_ins, log_to_fixture, register_stand_ins, tmpfs_directory
+from generators import Workload, DEFAULT_HOSTS, DEFAULT_JOBS_PER_USER, DEFAULT_SEED, DEFAULT_USERS_PER_VO
+from measure import Measurement, parse_strace_summary
+
+# the scenarios load modules from lib that import the replaced modules
+register_stand_ins()
+
+from scenarios import SCENARIOS
+
+logger = fancylogger.getLogger(__name__)
+fancylogger.logToScreen(True)
+fancylogger.setLogLevelInfo()
+
+DEFAULT_SIZES = '1000,10000,100000'
+DEFAULT_CYCLES = 2
+DEFAULT_TOLERANCE = 0.25
+# phases shorter than this are not compared to the baseline, their timing is too noisy
+MINIMAL_COMPARED_SECONDS = 0.1
+
+# the options passed on to the scenario processes
+SCENARIO_OPTIONS = ['information', 'format', 'writers', 'cycles', 'columnar']
+
+
+def run_scenario(opts):
+    """Run a single scenario in this process, and store the result in the result file."""
+    fixture = Fixture(opts.options.fixture)
+    install_stand_ins(fixture)
+    log_to_fixture(fixture)
+
+    settings = dict([(name, getattr(opts.options, name)) for name in SCENARIO_OPTIONS])
+    measurement = Measurement()
+    stats = dict(SCENARIOS)[opts.options.scenario](fixture, measurement, settings)
+    result = measurement.result()
+    measurement.unwrap()
+
+    result['stats'] = stats
+    f = open(opts.options.result, 'w')
+    try:
+        json.dump(result, f)
+    finally:
+        f.close()
+
+
+def spawn_scenario(opts, scenario, fixture_directory, strace=False):
+    """Run the scenario in a fresh process.
+
+    @returns: the result dict, with the strace counts if strace is True, or None if the scenario failed
+    """
+    (fd, result_filename) = tempfile.mkstemp(prefix='vsc-bench-result-')
+    os.close(fd)
+    command = [sys.executable, os.path.abspath(__file__),
+               '--scenario', scenario,
+               '--fixture', fixture_directory,
+               '--result', result_filename,
+               '--information', opts.options.information,
+               '--format', opts.options.format,
+               '--writers', str(opts.options.writers),
+               '--cycles', str(opts.options.cycles)]
+    if opts.options.columnar:
+        command.append('--columnar')
+
+    strace_filename = None
+    if strace:
+        strace_filename = "%s.strace" % (result_filename)
+        command = ['strace', '-f', '-c', '-o', strace_filename] + command
+
+    try:
+        if subprocess.call(command) != 0:
+            logger.error("Scenario %s failed, see %s" % (scenario, os.path.join(fixture_directory, 'bench.log')))
+            return None
+        f = open(result_filename)
+        try:
+            result = json.load(f)
+        finally:
+            f.close()
+        if strace:
+            result['strace'] = parse_strace_summary(strace_filename)
+        return result
+    finally:
+        for filename in [result_filename, strace_filename]:
+            if filename and os.path.exists(filename):
+                os.unlink(filename)
+
+
+def report(result):
+    """Print the result of a single scenario run."""
+    print "%s, %d users: %.2fs, peak RSS %d KiB (%d KiB after setup), syscalls %s" % (result['scenario'],
+                                                                                    result['users'],
+                                                                                    result['seconds'],
+                                                                                    result['peak_rss'],
+                                                                                    result['setup_rss'],
+                                                                                    result['syscalls'])
+    for (name, phase) in result['phases']:
+        print "    %-40s %10.3fs %6d calls  syscalls %s" % (name, phase['seconds'], phase['calls'], phase['syscalls'])
+    if result['counters']:
+        print "    counters: %s" % (result['counters'])
+    if 'strace' in result:
+        print "    strace: %d system calls" % (result['strace'].get('total', 0))
+    print "    stats: %s" % (result['stats'])
+
+
+def compare(results, baseline, tolerance):
+    """Compare the results to the baseline results.
+
+    @returns: list of strings describing the regressions
+    """
+    baseline_results = dict([((result['scenario'], result['users']), result) for result in baseline])
+    regressions = []
+    for result in results:
+        key = (result['scenario'], result['users'])
+        if key not in baseline_results:
+            continue
+        baseline_result = baseline_results[key]
+
+        if result['peak_rss'] > baseline_result['peak_rss'] * (1 + tolerance):
+            regressions.append("%s, %d users: peak RSS %d KiB, was %d KiB" % (key + (result['peak_rss'],
+                                                                                    baseline_result['peak_rss'])))
+
+        baseline_phases = dict(baseline_result['phases'])
+        for (name, phase) in result['phases']:
+            if name not in baseline_phases:
+                continue
+            seconds = phase['seconds']
+            baseline_seconds = baseline_phases[name]['seconds']
+            if seconds > MINIMAL_COMPARED_SECONDS and seconds > baseline_seconds * (1 + tolerance):
+                regressions.append("%s, %d users: phase %s took %.3fs, was %.3fs" % (key + (name, seconds,
+                                                                                          baseline_seconds)))
+    return regressions
+
+
+def main():
+    options = {
+        'sizes': ('comma separated numbers of users to run the scenarios for', str, 'store', DEFAULT_SIZES),
+        'jobs-per-user': ('the number of jobs per user', int, 'store', DEFAULT_JOBS_PER_USER),
+        'users-per-vo': ('the number of users per VO', int, 'store', DEFAULT_USERS_PER_VO),
+        'hosts': ('the number of Moab and PBS masters', int, 'store', DEFAULT_HOSTS),
+        'seed': ('the seed of the synthetic workload', int, 'store', DEFAULT_SEED),
+        'scenarios': ('the scenarios to run, all if empty: %s' % (", ".join([name for (name, _) in SCENARIOS])),
+                      None, 'extend', []),
+        'information': ('the sort of information the Moab scripts store: user, vo', None, 'store', 'vo'),
+        'format': ('format of the per-user files of the Moab scripts: pickle, binary', None, 'store', 'pickle'),
+        'writers': ('number of threads storing the files', int, 'store', 1),
+        'cycles': ('number of cycles of the scripts in every scenario', int, 'store', DEFAULT_CYCLES),
+        'columnar': ('use the NumPy based columnar quota representation in dquota', None, 'store_true', False),
+        'strace': ('also count all system calls by running every scenario under strace', None, 'store_true', False),
+        'output': ('file to store the results in, as JSON', str, 'store', None),
+        'baseline': ('file with earlier results to compare to', str, 'store', None),
+        'tolerance': ('fraction by which a phase may be slower than in the baseline', float, 'store',
+                      DEFAULT_TOLERANCE),
+        'keep': ('do not remove the fixtures', None, 'store_true', False),
+        # used to run a single scenario in a fresh process
+        'scenario': ('run only this scenario on the given fixture', str, 'store', None),
+        'fixture': ('the fixture directory for the scenario', str, 'store', None),
+        'result': ('the file to store the scenario result in', str, 'store', None),
+    }
+    opts = simple_option(options)
+
+    if opts.options.scenario:
+        run_scenario(opts)
+        sys.exit(0)
+
+    scenarios = opts.options.scenarios or [name for (name, _) in SCENARIOS]
+    unknown = [name for name in scenarios if name not in dict(SCENARIOS)]
+    if unknown:
+        logger.error("Unknown scenarios: %s" % (unknown))
+        sys.exit(1)
+
+    results = []
+    failed = []
+    for users in [int(size) for size in opts.options.sizes.split(',')]:
+        workload = Workload(users,
+                            jobs=users * opts.options.jobs_per_user,
+                            vos=max(1, users // opts.options.users_per_vo),
+                            hosts=opts.options.hosts,
+                            seed=opts.options.seed)
+        directory = tmpfs_directory()
+        try:
+            start = time.time()
+            Fixture.create(directory, workload)
+            logger.info("Generated the fixture for %s in %s in %.2fs" % (workload, directory, time.time() - start))
+
+            for scenario in scenarios:
+                result = spawn_scenario(opts, scenario, directory)
+                if result is None:
+                    failed.append((scenario, users))
+                    continue
+                if opts.options.strace:
+                    strace_result = spawn_scenario(opts, scenario, directory, strace=True)
+                    if strace_result is not None:
+                        result['strace'] = strace_result['strace']
+                result.update({'scenario': scenario, 'users': users, 'jobs': len(workload.jobs)})
+                report(result)
+                results.append(result)
+        finally:
+            if opts.options.keep:
+                logger.info("Keeping the fixture in %s" % (directory))
+            else:
+                shutil.rmtree(directory)
+
+    if opts.options.output:
+        f = open(opts.options.output, 'w')
+        try:
+            json.dump(results, f, indent=1)
+        finally:
+            f.close()
+
+    exit_code = 0
+    if failed:
+        logger.error("Failed scenarios: %s" % (failed))
+        exit_code = 1
+
+    if opts.options.baseline:
+        f = open(opts.options.baseline)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        regressions = compare(results, baseline, opts.options.tolerance)
+        for regression in regressions:
+            logger.warning("Regression: %s" % (regression))
+        if regressions:
+            exit_code = 1
+
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+##
+#
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of the tools originally by the HPC team of
+# Ghent University (http://ugent.be/hpc).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+##
+"""
+The benchmark scenarios.
+
+Every scenario takes the fixture, a Measurement and the settings of the run. It loads what it
+needs, starts the measurement, and returns a dict with the statistics of the run, e.g., the
+values the script reports to nagios.
+
+The script scenarios run the script's collect_and_store (or its equivalent) for a number of
+cycles. The first cycle starts without digest index or LDAP snapshot, the next ones run with
+what the previous cycle left, as on a master where the script runs periodically.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import cPickle
+import os
+import re
+import sys
+
+from optparse import Values
+
+from vsc.utils.digest_index import DigestIndex
+from vsc.utils.ldap_snapshot import LdapSnapshot
+from vsc.utils.pickled_payload import PickledPayload
+from vsc.utils.queue_file import QueueFileBody, KIND_SHOWQ, read as read_queue_file, read_header,\
+    write as write_queue_file
+from vsc.utils.queue_targets import determine_target_information, resolve_vo_membership
+
+from fixtures import FILESYSTEM, STORAGE, GpfsOperations, InstituteFilter, LdapFilter, VscLdapGroup,\
+    VscLdapUser, VscUser, load_script, store_pickle_data_at_user
+from generators import INSTITUTES
+
+
+def script_options(**options):
+    """Mimic the simple_option result the scripts get, i.e., an object with the options as opts.options."""
+    return Values({'options': Values(options)})
+
+
+def moab_options(settings, **options):
+    """The options shared by the Moab scripts."""
+    values = {
+        'dry_run': False,
+        'location': 'gengar',
+        'information': settings['information'],
+        'format': settings['format'],
+        'concurrent_hosts': True,
+        'host_deadline': 600,
+        'writers': settings['writers'],
+        'writers_per_filesystem': None,
+        'write_timeout': 600,
+    }
+    values.update(options)
+    return script_options(**values)
+
+
+def ldap_base_filter():
+    """The filter the scripts use for the LDAP snapshot."""
+    return reduce(lambda x, y: x | y, [InstituteFilter(institute) for institute in INSTITUTES])
+
+
+def run_cycles(fixture, measurement, settings, cycle, digest_index=None):
+    """Run the cycle the configured number of times, recording each as a phase.
+
+    Between the cycles, some LDAP entries are modified, and the digest index is flushed, as in daemon mode.
+
+    @returns: the statistics of the last cycle
+    """
+    stats = {}
+    for number in xrange(1, settings['cycles'] + 1):
+        measurement.prefix = "cycle%d/" % (number)
+        with measurement.phase('total'):
+            stats = cycle()
+        if digest_index:
+            digest_index.flush()
+        fixture.ldap.modify()
+    measurement.prefix = ''
+    return stats
+
+
+def dshowq(fixture, measurement, settings):
+    """dshowq, storing the showq information of every target user."""
+    script = load_script(fixture, 'dshowq')
+    opts = moab_options(settings, queue_index=None, queue_index_shards=1)
+    clusters = fixture.clusters('showq')
+    ldap_snapshot = LdapSnapshot(fixture.state('dshowq.ldap_snapshot.pickle'), VscLdapGroup, VscLdapUser, LdapFilter)
+    digest_index = DigestIndex(fixture.state('dshowq.digest.json.gz'))
+    mount_points = {}
+
+    measurement.wrap(script, 'collect_concurrently', 'collect')
+    measurement.wrap(script, 'determine_target_information', 'targets')
+    measurement.wrap(script, 'collect_vo_ldap', 'targets/ldap')
+    measurement.wrap(script.WriterPool, 'run', 'store')
+
+    measurement.start()
+    stats = run_cycles(fixture, measurement, settings,
+                       lambda: script.collect_and_store(opts, clusters, None, ldap_snapshot, digest_index, mount_points),
+                       digest_index)
+    digest_index.close()
+    measurement.count('ldap_queries', fixture.ldap.queries)
+    return stats
+
+
+def dcheckjob(fixture, measurement, settings):
+    """dcheckjob, storing the checkjob information of every active user."""
+    script = load_script(fixture, 'dcheckjob')
+    opts = moab_options(settings)
+    clusters = fixture.clusters('checkjob')
+    digest_index = DigestIndex(fixture.state('dcheckjob.digest.json.gz'))
+    mount_points = {}
+
+    measurement.wrap(script, 'collect_concurrently', 'collect')
+    measurement.wrap(script.WriterPool, 'run', 'store')
+
+    measurement.start()
+    stats = run_cycles(fixture, measurement, settings,
+                       lambda: script.collect_and_store(opts, clusters, None, digest_index, mount_points),
+                       digest_index)
+    digest_index.close()
+    return stats
+
+
+def dmoab(fixture, measurement, settings):
+    """dmoab, storing both the showq and the checkjob information."""
+    script = load_script(fixture, 'dmoab')
+    opts = moab_options(settings, directory_cache_ttl=script.DIRECTORY_CACHE_TTL)
+    showq_clusters = fixture.clusters('showq')
+    checkjob_clusters = fixture.clusters('checkjob')
+    ldap_snapshot = LdapSnapshot(fixture.state('dmoab.ldap_snapshot.pickle'), VscLdapGroup, VscLdapUser, LdapFilter)
+    checkjob_cache = script.CheckjobCache(fixture.state('dmoab.checkjob_cache.pickle'))
+    digest_index = DigestIndex(fixture.state('dmoab.digest.json.gz'))
+    mount_points = {}
+    directories = {}
+
+    measurement.wrap(script, 'collect_per_host', 'collect')
+    measurement.wrap(script, 'collect_changed', 'collect_checkjob')
+    measurement.wrap(script, 'determine_target_information', 'targets')
+    measurement.wrap(script, 'collect_vo_ldap', 'targets/ldap')
+    measurement.wrap(script.ProductWriter, 'run', 'store')
+
+    measurement.start()
+    stats = run_cycles(fixture, measurement, settings,
+                       lambda: script.collect_and_store(opts, showq_clusters, checkjob_clusters, ldap_snapshot,
+                                                        checkjob_cache, digest_index, mount_points, directories),
+                       digest_index)
+    digest_index.close()
+    measurement.count('ldap_queries', fixture.ldap.queries)
+    return stats
+
+
+def dquota(fixture, measurement, settings):
+    """dquota, processing the quota of a single storage."""
+    script = load_script(fixture, 'dquota')
+    (quota_map, filesets) = fixture.quota()
+    user_id_map = fixture.user_id_map()
+    gpfs = GpfsOperations()
+
+    columnar = settings['columnar']
+    if columnar and not script.columnar_available():
+        columnar = False
+
+    storage_settings = {
+        'columnar': columnar,
+        'table_snapshot': fixture.state('dquota.table.%(storage)s.npz'),
+        'digest_index': fixture.state('dquota.digest.%(storage)s.json.gz'),
+        'force_write': False,
+        'writers': settings['writers'],
+        'writers_per_filesystem': None,
+        'timeseries': fixture.state('dquota.%(filesystem)s.timeseries'),
+        'dry_run': False,
+    }
+
+    measurement.wrap(script, 'append_quota_timeseries', 'timeseries')
+    measurement.wrap(script, 'forecast_hard_limits', 'forecast')
+    measurement.wrap(script, 'get_mmrepquota_maps', 'ordering')
+    measurement.wrap(script, 'get_mmrepquota_tables', 'ordering')
+    measurement.wrap(script, 'process_fileset_quota', 'filesets')
+    measurement.wrap(script, 'process_user_quota', 'users')
+    measurement.wrap(script, 'prefetch_user_paths', 'users/ldap')
+    measurement.wrap(script, 'notify_exceeding_items', 'notify')
+
+    def cycle():
+        summary = script.process_storage(STORAGE, FILESYSTEM, quota_map, filesets, user_id_map, storage_settings, gpfs)
+        if summary['error']:
+            raise RuntimeError("dquota failed: %s" % (summary['error']))
+        return {
+            'users': summary['users'],
+            'filesets': summary['filesets'],
+            'exceeding_users': len(summary['exceeding_users']),
+            'exceeding_filesets': len(summary['exceeding_filesets']),
+            'columnar': columnar,
+        }
+
+    measurement.start()
+    stats = run_cycles(fixture, measurement, settings, cycle)
+    measurement.count('ldap_queries', fixture.ldap.queries)
+    return stats
+
+
+def pbs_check_inactive_user_jobs(fixture, measurement, settings):
+    """pbs_check_inactive_user_jobs, in dry run mode."""
+    script = load_script(fixture, 'pbs_check_inactive_user_jobs')
+
+    measurement.wrap(script, 'get_user_with_status', 'ldap')
+    measurement.wrap(script.PBSQuery, 'getjobs', 'getjobs')
+    measurement.wrap(script, 'remove_queued_jobs', 'queued')
+    measurement.wrap(script, 'remove_running_jobs', 'running')
+
+    def cycle():
+        grace_users = script.get_user_with_status('grace')
+        inactive_users = script.get_user_with_status('inactive')
+        jobs = script.PBSQuery().getjobs(attrib_list=script.PBS_JOB_ATTRIBUTES)
+        removed_queued = script.remove_queued_jobs(jobs, grace_users, inactive_users, True)
+        removed_running = script.remove_running_jobs(jobs, inactive_users, True)
+        return {
+            'jobs': len(jobs),
+            'queued': len(removed_queued),
+            'running': len(removed_running),
+        }
+
+    measurement.start()
+    return run_cycles(fixture, measurement, settings, cycle)
+
+
+# the grace parsing of dquota before the cache, with the regex of the cache so it matches the same strings
+BASELINE_GRACE_REGEX = re.compile(r"(?P<days>\d+)\s*days?|(?P<hours>\d+)\s*hours?|(?P<expired>expired)")
+
+
+def baseline_parse_grace(block_grace):
+    """The parsing of the blockGrace in dquota's _update_quota_entity before the cache.
+
+    The days and hours are not converted to int, so the string is multiplied, e.g., '7' * 86400.
+    """
+    grace = BASELINE_GRACE_REGEX.search(block_grace)
+
+    if not grace:
+        expired = (False, None)
+    else:
+        grace = grace.groupdict()
+        if grace.get('days', None):
+            expired = (True, grace['days'] * 86400)
+        elif grace.get('hours', None):
+            expired = (True, grace['hours'] * 3600)
+        elif grace.get('expired', None):
+            expired = (True, 0)
+        else:
+            expired = (False, None)
+    return expired
+
+
+def grace(fixture, measurement, settings):
+    """Parsing the blockGrace of all mmrepquota records, as dquota did before the cache and with the cache.
+
+    The memory counters are the bytes allocated for the parsed grace values: the baseline allocates a new
+    value for every record, the cache only one per distinct string.
+    """
+    script = load_script(fixture, 'dquota')
+    (quota_map, _) = fixture.quota()
+    block_graces = [quota.blockGrace
+                    for kind in ('USR', 'FILESET')
+                    for gpfs_quotas in quota_map[kind].values()
+                    for quota in gpfs_quotas]
+
+    measurement.start()
+    baseline_bytes = 0
+    with measurement.phase('baseline'):
+        for block_grace in block_graces:
+            (_, seconds) = baseline_parse_grace(block_grace)
+            baseline_bytes += sys.getsizeof(seconds)
+    with measurement.phase('regex'):
+        for block_grace in block_graces:
+            script.GPFS_GRACE_REGEX.search(block_grace)
+    script._grace_cache.clear()
+    with measurement.phase('parse_cold'):
+        for block_grace in block_graces:
+            script._parse_grace(block_grace)
+    with measurement.phase('parse_warm'):
+        for block_grace in block_graces:
+            script._parse_grace(block_grace)
+    cached_bytes = sum([sys.getsizeof(seconds) for (_, seconds) in script._grace_cache.values()])
+
+    phases = dict(measurement.phases)
+    baseline_seconds = phases['baseline']['seconds']
+    cached_seconds = phases['parse_cold']['seconds']
+    measurement.count('baseline_bytes', baseline_bytes)
+    measurement.count('cached_bytes', cached_bytes)
+    measurement.count('speedup', baseline_seconds / max(cached_seconds, 1e-9))
+    return {'records': len(block_graces), 'distinct': len(script._grace_cache)}
+
+
+def ldap_prefetch(fixture, measurement, settings):
+    """Looking up the storage path of all users, in batches as dquota does, and one user at a time."""
+    script = load_script(fixture, 'dquota')
+    user_ids = fixture.workload.user_ids
+
+    measurement.start()
+    queries = fixture.ldap.queries
+    with measurement.phase('prefetch'):
+        paths = script.prefetch_user_paths(user_ids, STORAGE)
+    measurement.count('prefetch_queries', fixture.ldap.queries - queries)
+
+    queries = fixture.ldap.queries
+    with measurement.phase('per_user'):
+        for user_id in user_ids:
+            VscUser(user_id)._get_path(STORAGE)
+    measurement.count('per_user_queries', fixture.ldap.queries - queries)
+    return {'users': len(paths)}
+
+
+def ldap_snapshot(fixture, measurement, settings):
+    """Building the LDAP snapshot dshowq uses, and refreshing it incrementally."""
+    snapshot = LdapSnapshot(fixture.state('ldap_snapshot.pickle'), VscLdapGroup, VscLdapUser, LdapFilter)
+    base_filter = ldap_base_filter()
+
+    measurement.start()
+    with measurement.phase('full_refresh'):
+        snapshot.refresh(base_filter)
+    fixture.ldap.modify()
+    with measurement.phase('incremental_refresh'):
+        snapshot.refresh(base_filter)
+    with measurement.phase('load'):
+        snapshot = LdapSnapshot(fixture.state('ldap_snapshot.pickle'), VscLdapGroup, VscLdapUser, LdapFilter)
+    measurement.count('ldap_queries', fixture.ldap.queries)
+    return {'groups': len(snapshot.groups), 'users': len(snapshot.users)}
+
+
+def vo_resolution(fixture, measurement, settings):
+    """Resolving the VO membership of the active users, and grouping their queue information."""
+    queue_information = fixture.moab_information('showq')
+    vo_members = fixture.workload.vo_members()
+    gecos = dict([(user_id, "User %s" % (user_id)) for user_id in fixture.workload.user_ids])
+    active_users = queue_information.keys()
+
+    measurement.start()
+    with measurement.phase('resolve'):
+        (vo_users, user_maps) = resolve_vo_membership(active_users, vo_members, gecos)
+    with measurement.phase('targets'):
+        (_, target_groups) = determine_target_information('vo', active_users, queue_information,
+                                                          lambda users: resolve_vo_membership(users, vo_members, gecos))
+    return {'active_users': len(active_users), 'vo_users': len(vo_users), 'groups': len(target_groups)}
+
+
+def queue_file(fixture, measurement, settings):
+    """Writing and reading the showq information of all target users as pickles and as binary queue files."""
+    queue_information = fixture.moab_information('showq')
+    vo_members = fixture.workload.vo_members()
+    gecos = dict([(user_id, "User %s" % (user_id)) for user_id in fixture.workload.user_ids])
+    (_, target_groups) = determine_target_information('vo', queue_information.keys(), queue_information,
+                                                      lambda users: resolve_vo_membership(users, vo_members, gecos))
+    queue_information = None
+
+    def targets(filename):
+        for (members, group_queue_information, user_map) in target_groups.values():
+            for user in members:
+                yield (fixture.path('home', user, filename), group_queue_information, user_map)
+
+    measurement.start()
+    with measurement.phase('pickle_write'):
+        for (path, group_queue_information, user_map) in targets('.showq.pickle'):
+            store_pickle_data_at_user(None, path, PickledPayload((group_queue_information, user_map)))
+    with measurement.phase('binary_write'):
+        for (path, group_queue_information, user_map) in targets('.showq.vscq'):
+            write_queue_file(path, KIND_SHOWQ, 0, QueueFileBody((group_queue_information, user_map)))
+    for (suffix, kind) in (('.showq.pickle', 'pickle'), ('.showq.vscq', 'binary')):
+        measurement.count('%s_bytes' % (kind), sum([os.path.getsize(path) for (path, _, _) in targets(suffix)]))
+    with measurement.phase('pickle_read'):
+        for (path, _, _) in targets('.showq.pickle'):
+            f = open(path, 'rb')
+            try:
+                cPickle.load(f)
+            finally:
+                f.close()
+    with measurement.phase('binary_read'):
+        for (path, _, _) in targets('.showq.vscq'):
+            read_queue_file(path)
+    with measurement.phase('binary_header_read'):
+        for (path, _, _) in targets('.showq.vscq'):
+            read_header(path)
+    return {'groups': len(target_groups), 'files': sum([len(members) for (members, _, _) in target_groups.values()])}
+
+
+# the scenarios in the order they are run
+SCENARIOS = [
+    ('dshowq', dshowq),
+    ('dcheckjob', dcheckjob),
+    ('dmoab', dmoab),
+    ('dquota', dquota),
+    ('pbs_check_inactive_user_jobs', pbs_check_inactive_user_jobs),
+    ('grace', grace),
+    ('ldap_prefetch', ldap_prefetch),
+    ('ldap_snapshot', ldap_snapshot),
+    ('vo_resolution', vo_resolution),
+    ('queue_file', queue_file),
+]
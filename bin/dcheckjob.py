@@ -16,21 +16,31 @@ users pickle directory.
 
 @author Andy Georges
 """
+import logging
 import os
 import sys
 import time
 
-from vsc.administration.user import cluster_user_pickle_location_map, cluster_user_pickle_store_map
+from functools import partial
+
+from vsc.administration.user import cluster_user_pickle_location_map
 from vsc.jobs.moab.checkjob import Checkjob, CheckjobInfo
 from vsc.ldap.configuration import VscConfiguration
 from vsc.ldap.utils import LdapQuery
 from vsc.utils import fancylogger
+from vsc.utils.digest_index import DigestIndex, digest
 from vsc.utils.fs_store import UserStorageError, FileStoreError, FileMoveError
 from vsc.utils.availability import proceed_on_ha_service
 from vsc.utils.generaloption import simple_option
+from vsc.utils.host_cache import HostCache, DEFAULT_CYCLE, DEFAULT_REFRESH_INTERVAL, DEFAULT_MAX_STALE
 from vsc.utils.lock import lock_or_bork, release_or_bork
+from vsc.utils.moab_collect import collect_concurrently, latency_statistics, DEFAULT_HOST_DEADLINE
 from vsc.utils.nagios import NagiosReporter, NagiosResult, NAGIOS_EXIT_OK, NAGIOS_EXIT_WARNING
+from vsc.utils.periodic import run_daemon
+from vsc.utils.pickled_payload import PickledPayload
+from vsc.utils.queue_file import QueueFileBody, KIND_CHECKJOB, store as store_queue_file, store_pickle
 from vsc.utils.timestamp_pid_lockfile import TimestampedPidLockfile
+from vsc.utils.writer_pool import WriterPool, mount_point
 
 #Constants
 NAGIOS_CHECK_FILENAME = '/var/log/pickles/dcheckjob.nagios.pickle'
@@ -39,25 +49,142 @@ NAGIOS_CHECK_INTERVAL_THRESHOLD = 30 * 60  # 30 minutes
 
 DCHECKJOB_LOCK_FILE = '/var/run/dcheckjob_tpid.lock'
 
+DIGEST_INDEX_FILENAME = '/var/log/pickles/dcheckjob.digest.json.gz'
+
+STORE_WRITERS = 1
+STORE_TIMEOUT = 60  # seconds
+
+DAEMON_INTERVAL = 5 * 60  # 5 minutes
+
 logger = fancylogger.getLogger(__name__)
 fancylogger.logToScreen(True)
 fancylogger.setLogLevelInfo()
 
 
 # FIXME: common
-def get_pickle_path(location, user_id):
+def get_pickle_path(location, user_id, file_format='pickle'):
     """Determine the path (directory) where the pickle file qith the queue information should be stored.
 
     @type location: string
     @type user_id: string
+    @type file_format: string, pickle or binary
 
     @param location: indication of the user accesible storage spot to use, e.g., home or scratch
     @param user_id: VSC user ID
 
     @returns: tuple of (string representing the directory where the pickle file should be stored,
-                        the relevant storing function in vsc.utils.fs_store).
+                        the storing function, vsc.utils.queue_file.store_pickle, or vsc.utils.queue_file.store for the binary format).
     """
-    return (os.path.join(cluster_user_pickle_location_map[location](user_id).pickle_path(), ".checkjob.pickle"), cluster_user_pickle_store_map[location])
+    path = cluster_user_pickle_location_map[location](user_id).pickle_path()
+    if file_format == 'binary':
+        return (os.path.join(path, ".checkjob.vscq"), partial(store_queue_file, KIND_CHECKJOB))
+    return (os.path.join(path, ".checkjob.pickle"), store_pickle)
+
+
+def collect_and_store(opts, clusters, checkjob, digest_index, mount_points, host_cache=None):
+    """Collect the checkjob information and store the pickle files for the active users.
+
+    @type opts: the script options
+    @type clusters: dict mapping the hosts to their master and checkjob path
+    @type checkjob: Checkjob instance, or None to query the hosts concurrently
+    @type digest_index: DigestIndex instance, or None to store all pickle files
+    @type mount_points: dict caching the mount point of the pickle directories
+    @type host_cache: HostCache instance, or None to always query all hosts
+
+    @returns: dict with the values for the NagiosResult
+    """
+    host_latencies = {}
+    cache_statistics = {}
+    stale_users = {}
+    if opts.options.concurrent_hosts or host_cache:
+        (job_information, reported_hosts, failed_hosts, host_latencies) = \
+            collect_concurrently(Checkjob, clusters, opts.options.host_deadline, host_cache,
+                                 cache_pickle=True, dry_run=opts.options.dry_run)
+        if host_cache:
+            cache_statistics = host_cache.statistics()
+            stale_users = host_cache.stale_users()
+            if not opts.options.dry_run:
+                host_cache.store()
+    else:
+        (job_information, reported_hosts, failed_hosts) = checkjob.get_moab_command_information()
+    timeinfo = time.time()
+
+    active_users = job_information.keys()
+
+    # formatting the complete checkjob information is expensive, so only do it when it is logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Active users: %s" % (active_users))
+        logger.debug("Checkjob information: %s" % (job_information))
+
+    nagios_user_count = 0
+    nagios_no_store = 0
+
+    writer_pool = WriterPool(opts.options.writers,
+                             default_target_limit=opts.options.writers_per_filesystem,
+                             timeout=opts.options.write_timeout)
+
+    digests = {}
+    nagios_unchanged = 0
+    # the binary files are tracked separately in the digest index
+    key_suffix = ""
+    if opts.options.format == 'binary':
+        key_suffix = ":binary"
+
+    for user in active_users:
+        if not opts.options.dry_run:
+            user_job_information = {user: job_information[user]}
+            # the information of hosts that could not be queried, or was not queried in this cycle, comes from the
+            # host cache, which is marked in the information of the users having such data with the time it was
+            # collected
+            if user in stale_users:
+                user_job_information['staleinfo'] = stale_users[user]
+            if opts.options.format == 'binary':
+                user_queue_information = QueueFileBody(user_job_information)
+                user_digest = digest(user_queue_information.data)
+            else:
+                user_queue_information = PickledPayload(CheckjobInfo(user_job_information))
+                user_digest = digest(user_queue_information.pickled)
+            key = "%s:%s%s" % (opts.options.location, user, key_suffix)
+            if digest_index and not digest_index.changed(key, user_digest):
+                logger.debug("Checkjob information for user %s is unchanged" % (user))
+                nagios_unchanged += 1
+                continue
+
+            try:
+                (path, store) = get_pickle_path(opts.options.location, user, opts.options.format)
+            except (UserStorageError, FileStoreError, FileMoveError), _:
+                logger.error("Could not determine pickle path for user %s" % (user))
+                nagios_no_store += 1
+                continue
+            writer_pool.submit(user, mount_point(os.path.dirname(path), mount_points), store, user, path, (timeinfo, user_queue_information))
+            digests[user] = (key, user_digest, path)
+        else:
+            logger.info("Dry run, not actually storing data for user %s at path %s" % (user, get_pickle_path(opts.options.location, user, opts.options.format)[0]))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Dry run, queue information for user %s is %s" % (user, job_information[user]))
+
+    (stored, failed, _) = writer_pool.run()
+    nagios_user_count += len(stored)
+    if digest_index:
+        for user in stored:
+            digest_index.stored(*digests[user])
+    for (user, err) in failed.items():
+        if isinstance(err, (UserStorageError, FileStoreError, FileMoveError)):
+            logger.error("Could not store pickle file for user %s" % (user))
+        else:
+            logger.error("Could not store pickle file for user %s, unexpected error: %s" % (user, err))
+        nagios_no_store += 1
+
+    stats = {
+        'hosts': len(reported_hosts),
+        'hosts_critical': len(failed_hosts),
+        'stored': nagios_user_count,
+        'stored_critical': nagios_no_store,
+        'unchanged': nagios_unchanged,
+    }
+    stats.update(latency_statistics(host_latencies))
+    stats.update(cache_statistics)
+    return stats
 
 
 def main():
@@ -73,6 +200,25 @@ def main():
         'location': ('the location for storing the pickle file: home, scratch', str, 'store', 'home'),
         'ha': ('high-availability master IP address', None, 'store', None),
         'dry-run': ('do not make any updates whatsoever', None, 'store_true', False),
+        'digest-index': ('file keeping track of the information last stored per user, and its freshness',
+                         str, 'store', DIGEST_INDEX_FILENAME),
+        'force-write': ('store the pickle files for all users, even when unchanged', None, 'store_true', False),
+        'concurrent-hosts': ('query the hosts concurrently', None, 'store_true', False),
+        'host-deadline': ('number of seconds after which a host that did not report is considered failed',
+                          int, 'store', DEFAULT_HOST_DEADLINE),
+        'host-cache': ('file keeping the last good result of every host, to fall back on when a host fails',
+                       str, 'store', None),
+        'host-cache-refresh-interval': ('number of seconds during which the cached result of a host is used without querying it',
+                                        int, 'store', DEFAULT_REFRESH_INTERVAL),
+        'host-cache-max-stale': ('number of seconds during which the cached result is used for a failed host',
+                                 int, 'store', DEFAULT_MAX_STALE),
+        'writers': ('number of threads storing the pickle files', int, 'store', STORE_WRITERS),
+        'writers-per-filesystem': ('maximal number of concurrent writes per filesystem', int, 'store', None),
+        'write-timeout': ('number of seconds after which storing a pickle file is abandoned', int, 'store', STORE_TIMEOUT),
+        'format': ('format of the per-user files: pickle, binary', None, 'store', 'pickle'),
+        'daemon': ('keep running, collecting the information every interval seconds', None, 'store_true', False),
+        'interval': ('number of seconds between the start of subsequent cycles in daemon mode',
+                     int, 'store', DAEMON_INTERVAL),
     }
 
     opts = simple_option(options)
@@ -110,49 +256,50 @@ def main():
             'path': checkjob_path
         }
 
-    checkjob = Checkjob(clusters, cache_pickle=True, dry_run=True)
-
-    (job_information, reported_hosts, failed_hosts) = checkjob.get_moab_command_information()
-    timeinfo = time.time()
-
-    active_users = job_information.keys()
-
-    logger.debug("Active users: %s" % (active_users))
-    logger.debug("Checkjob information: %s" % (job_information))
-
-    nagios_user_count = 0
-    nagios_no_store = 0
-
-    for user in active_users:
-        if not opts.options.dry_run:
-            try:
-                (path, store) = get_pickle_path(opts.options.location, user)
-                user_queue_information = CheckjobInfo({user: job_information[user]})
-                store(user, path, (timeinfo, user_queue_information))
-                nagios_user_count += 1
-            except (UserStorageError, FileStoreError, FileMoveError), _:
-                logger.error("Could not store pickle file for user %s" % (user))
-                nagios_no_store += 1
-        else:
-            logger.info("Dry run, not actually storing data for user %s at path %s" % (user, get_pickle_path(opts.options.location, user)[0]))
-            logger.debug("Dry run, queue information for user %s is %s" % (user, job_information[user]))
+    # everything below is kept across the cycles in daemon mode
+    host_cache = None
+    if opts.options.host_cache:
+        # outside daemon mode the time between the runs is unknown, so every cached result is stale
+        cycle = DEFAULT_CYCLE
+        if opts.options.daemon:
+            cycle = opts.options.interval
+        host_cache = HostCache(opts.options.host_cache,
+                               opts.options.host_cache_refresh_interval,
+                               opts.options.host_cache_max_stale,
+                               cycle)
+
+    checkjob = None
+    if not opts.options.concurrent_hosts and not host_cache:
+        checkjob = Checkjob(clusters, cache_pickle=True, dry_run=opts.options.dry_run)
+
+    # the unchanged pickles are left alone, their freshness is recorded in the index
+    digest_index = None
+    if not opts.options.dry_run and not opts.options.force_write:
+        digest_index = DigestIndex(opts.options.digest_index)
+    mount_points = {}
+
+    def run_cycle():
+        return collect_and_store(opts, clusters, checkjob, digest_index, mount_points,
+                                 host_cache)
+
+    if opts.options.daemon:
+        flush = None
+        if digest_index:
+            flush = digest_index.flush
+        stats = run_daemon(opts, lockfile, nagios_reporter, run_cycle, flush)
+    else:
+        stats = run_cycle()
+        if digest_index:
+            digest_index.close()
 
     logger.info("Finished dcheckjobd")
 
     #FIXME: this still looks fugly
-    bork_result = NagiosResult("lock release failed",
-                               hosts=len(reported_hosts),
-                               hosts_critical=len(failed_hosts),
-                               stored=nagios_user_count,
-                               stored_critical=nagios_no_store)
+    bork_result = NagiosResult("lock release failed", **stats)
     release_or_bork(lockfile, nagios_reporter, bork_result)
 
-    nagios_reporter.cache(NAGIOS_EXIT_OK,
-                          NagiosResult("run successful",
-                                       hosts=len(reported_hosts),
-                                       hosts_critical=len(failed_hosts),
-                                       stored=nagios_user_count,
-                                       stored_critical=nagios_no_store))
+    if not opts.options.daemon:
+        nagios_reporter.cache(NAGIOS_EXIT_OK, NagiosResult("run successful", **stats))
 
     sys.exit(0)
 
@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+##
+#
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of the tools originally by the HPC team of
+# Ghent University (http://ugent.be/hpc).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+##
+"""
+dmoab.py collects the showq and checkjob information from the Moab masters in a single pass, and stores
+both the showq and the checkjob pickle files in the users' pickle directories. It replaces running
+dshowq.py and dcheckjob.py separately.
+
+Every master is asked for its showq information once per cycle. The same showq information tells us
+for which masters the checkjob information changed, so checkjob is only run on those. The user
+lookups and the writes of both kinds of files are shared.
+
+@author Andy Georges
+"""
+import logging
+import os
+import resource
+import sys
+import time
+
+from vsc.administration.user import cluster_user_pickle_location_map
+from vsc.jobs.moab.checkjob import Checkjob, CheckjobInfo
+from vsc.jobs.moab.showq import Showq
+from vsc.ldap.configuration import VscConfiguration
+from vsc.ldap.entities import VscLdapGroup, VscLdapUser
+from vsc.ldap.filters import LdapFilter
+from vsc.ldap.utils import LdapQuery
+from vsc.utils import fancylogger
+from vsc.utils.availability import proceed_on_ha_service
+from vsc.utils.checkjob_cache import CheckjobCache, collect_changed
+from vsc.utils.digest_index import DigestIndex, digest
+from vsc.utils.fs_store import UserStorageError, FileStoreError, FileMoveError
+from vsc.utils.generaloption import simple_option
+from vsc.utils.host_cache import HostCache, stale_information, stale_users, DEFAULT_CYCLE, \
+    DEFAULT_REFRESH_INTERVAL, DEFAULT_MAX_STALE
+from vsc.utils.ldap_snapshot import LdapSnapshot
+from vsc.utils.lock import lock_or_bork, release_or_bork
+from vsc.utils.moab_collect import collect_per_host, latency_statistics, merge_hosts, DEFAULT_HOST_DEADLINE
+from vsc.utils.nagios import NagiosReporter, NagiosResult, NAGIOS_EXIT_OK, NAGIOS_EXIT_WARNING
+from vsc.utils.periodic import run_daemon
+from vsc.utils.pickled_payload import PickledPayload
+from vsc.utils.queue_file import QueueFileBody, KIND_SHOWQ, KIND_CHECKJOB, store as store_queue_file, store_pickle
+from vsc.utils.queue_targets import collect_vo_ldap, determine_target_information
+from vsc.utils.timestamp_pid_lockfile import TimestampedPidLockfile
+from vsc.utils.writer_pool import WriterPool, mount_point
+
+#Constants
+NAGIOS_CHECK_FILENAME = '/var/log/pickles/dmoab.nagios.pickle'
+NAGIOS_HEADER = 'dmoab'
+NAGIOS_CHECK_INTERVAL_THRESHOLD = 15 * 60  # 15 minutes
+
+DMOAB_LOCK_FILE = '/var/run/dmoab_tpid.lock'
+
+DIGEST_INDEX_FILENAME = '/var/log/pickles/dmoab.digest.json.gz'
+
+STORE_WRITERS = 1
+STORE_TIMEOUT = 60  # seconds
+
+LDAP_SNAPSHOT_FILENAME = '/var/log/pickles/dmoab.ldap_snapshot.pickle'
+LDAP_SNAPSHOT_FULL_REFRESH_INTERVAL = 24 * 60 * 60  # 1 day
+
+CHECKJOB_CACHE_FILENAME = '/var/log/pickles/dmoab.checkjob_cache.pickle'
+CHECKJOB_CACHE_MAX_AGE = 60 * 60  # 1 hour
+
+DAEMON_INTERVAL = 5 * 60  # 5 minutes
+
+DIRECTORY_CACHE_TTL = 60 * 60  # 1 hour
+
+# the file name of each product, per format
+PRODUCT_FILENAMES = {
+    'showq': {'pickle': '.showq.pickle', 'binary': '.showq.vscq'},
+    'checkjob': {'pickle': '.checkjob.pickle', 'binary': '.checkjob.vscq'},
+}
+PRODUCT_KINDS = {
+    'showq': KIND_SHOWQ,
+    'checkjob': KIND_CHECKJOB,
+}
+
+logger = fancylogger.getLogger(__name__)
+fancylogger.logToScreen(True)
+fancylogger.setLogLevelInfo()
+
+
+def get_pickle_directory(location, user_id, directories, ttl=DIRECTORY_CACHE_TTL):
+    """Determine the directory where the user's files should be stored.
+
+    The directory is kept in the directories dict, and looked up again once it is older than ttl seconds,
+    so a daemon picks up the users whose home or scratch moved.
+
+    @type location: string
+    @type user_id: string
+    @type directories: dict mapping user ID to a tuple (pickle directory, time it was looked up)
+    @type ttl: int
+    """
+    now = time.time()
+    cached = directories.get(user_id)
+    if cached is None or now - cached[1] > ttl:
+        cached = (cluster_user_pickle_location_map[location](user_id).pickle_path(), now)
+        directories[user_id] = cached
+    return cached[0]
+
+
+class ProductWriter(object):
+    """Submits the writes of both products to a single writer pool, keeping track of the unchanged files."""
+
+    def __init__(self, opts, digest_index, mount_points, directories):
+        self.opts = opts
+        self.digest_index = digest_index
+        self.mount_points = mount_points
+        self.directories = directories
+
+        self.writer_pool = WriterPool(opts.options.writers,
+                                      default_target_limit=opts.options.writers_per_filesystem,
+                                      timeout=opts.options.write_timeout)
+        self.digests = {}
+        self.unchanged = 0
+        self.no_store = 0
+
+    def changed(self, product, user, data_digest):
+        """Check if the product for the user changed since it was last stored.
+
+        @type product: string, showq or checkjob
+        @type data_digest: digest of the data, excluding the timestamp
+
+        @returns: the digest index key if the file should be stored, None otherwise
+        """
+        key = "%s:%s:%s" % (product, self.opts.options.location, user)
+        if self.opts.options.format == 'binary':
+            key += ":binary"
+
+        if self.digest_index and not self.digest_index.changed(key, data_digest):
+            logger.debug("%s information for user %s is unchanged" % (product, user))
+            self.unchanged += 1
+            return None
+        return key
+
+    def submit(self, product, user, key, data_digest, payload):
+        """Submit the write of the product for the user.
+
+        @type key: the digest index key returned by changed
+        @type payload: the data to store, a tuple (timestamp, QueueFileBody) for the binary format
+        """
+        try:
+            path = os.path.join(get_pickle_directory(self.opts.options.location, user, self.directories,
+                                                     self.opts.options.directory_cache_ttl),
+                                PRODUCT_FILENAMES[product][self.opts.options.format])
+        except (UserStorageError, FileStoreError, FileMoveError):
+            logger.error("Could not determine pickle path for user %s" % (user))
+            self.no_store += 1
+            return
+
+        if self.opts.options.dry_run:
+            logger.info("Dry run, not actually storing %s data for user %s at path %s" % (product, user, path))
+            return
+
+        if self.opts.options.format == 'binary':
+            store_args = (store_queue_file, PRODUCT_KINDS[product], user, path, payload)
+        else:
+            store_args = (store_pickle, user, path, payload)
+        self.writer_pool.submit((product, user), mount_point(os.path.dirname(path), self.mount_points), *store_args)
+        self.digests[(product, user)] = (key, data_digest, path)
+
+    def run(self):
+        """Store the files.
+
+        @returns: dict mapping the product to the number of stored files
+        """
+        (stored, failed, _) = self.writer_pool.run()
+
+        if self.digest_index:
+            for key in stored:
+                self.digest_index.stored(*self.digests[key])
+        for ((product, user), err) in failed.items():
+            if isinstance(err, (UserStorageError, FileStoreError, FileMoveError)):
+                logger.error("Could not store %s pickle file for user %s" % (product, user))
+            else:
+                logger.error("Could not store %s pickle file for user %s, unexpected error: %s" % (product, user, err))
+            self.no_store += 1
+
+        counts = {'showq': 0, 'checkjob': 0}
+        for (product, _) in stored:
+            counts[product] += 1
+        return counts
+
+
+def collect_and_store(opts, showq_clusters, checkjob_clusters, ldap_snapshot, checkjob_cache, digest_index,
+                      mount_points, directories, host_cache=None):
+    """Collect the showq and checkjob information and store both kinds of files for the users.
+
+    The showq information of a host that cannot be queried can come from the host_cache (a HostCache
+    instance). The checkjob information of such a host is then also the cached one, as its job listing
+    did not change.
+
+    @returns: dict with the values for the NagiosResult
+    """
+    kwargs = {'cache_pickle': True, 'dry_run': opts.options.dry_run}
+
+    (showq_host_information, failed_hosts, host_latencies) = collect_per_host(Showq, showq_clusters,
+                                                                              opts.options.host_deadline,
+                                                                              host_cache, **kwargs)
+    cache_statistics = {}
+    stale_hosts = {}
+    if host_cache:
+        cache_statistics = host_cache.statistics()
+        stale_hosts = host_cache.stale
+        if not opts.options.dry_run:
+            host_cache.store()
+
+    (checkjob_host_information, checkjob_failed_hosts, queried_hosts) = collect_changed(checkjob_cache,
+                                                                                        showq_host_information,
+                                                                                        Checkjob,
+                                                                                        checkjob_clusters,
+                                                                                        opts.options.host_deadline,
+                                                                                        **kwargs)
+    if not opts.options.dry_run:
+        checkjob_cache.store()
+    checkjob_hosts_cached = len(checkjob_host_information) - len(queried_hosts)
+    timeinfo = time.time()
+
+    # the checkjob information of a stale host is the one matching its cached job listing, so it is as stale
+    showq_stale_users = stale_users(showq_host_information, stale_hosts)
+    checkjob_stale_users = stale_users(checkjob_host_information, stale_hosts)
+
+    queue_information = merge_hosts(showq_host_information)
+    job_information = merge_hosts(checkjob_host_information)
+    showq_host_information = None
+    checkjob_host_information = None
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Queue information: %s" % (queue_information))
+        logger.debug("Checkjob information: %s" % (job_information))
+
+    (_, target_groups) = determine_target_information(opts.options.information,
+                                                      queue_information.keys(),
+                                                      queue_information,
+                                                      lambda users: collect_vo_ldap(users, ldap_snapshot))
+    queue_information = None
+
+    # the information of hosts that could not be queried, or was not queried in this cycle, comes from the host
+    # cache, which is marked in the information of the groups having such data with the time it was collected
+    if showq_stale_users:
+        for (_, group_queue_information, _) in target_groups.values():
+            staleinfo = stale_information(group_queue_information, showq_stale_users)
+            if staleinfo:
+                group_queue_information['staleinfo'] = staleinfo
+
+    writer = ProductWriter(opts, digest_index, mount_points, directories)
+
+    while target_groups:
+        (members, group_queue_information, user_map) = target_groups.popitem()[1]
+        # all members get the same information, so it is serialised only once
+        group_digest = digest(PickledPayload((group_queue_information, user_map)).pickled)
+        payload = None
+
+        for user in members:
+            key = writer.changed('showq', user, group_digest)
+            if key is None:
+                continue
+
+            if payload is None:
+                if opts.options.format == 'binary':
+                    payload = (timeinfo, QueueFileBody((group_queue_information, user_map)))
+                else:
+                    group_queue_information = dict(group_queue_information)
+                    group_queue_information['timeinfo'] = timeinfo
+                    payload = PickledPayload((group_queue_information, user_map))
+            writer.submit('showq', user, key, group_digest, payload)
+
+    while job_information:
+        (user, user_job_information) = job_information.popitem()
+        user_job_information = {user: user_job_information}
+        if user in checkjob_stale_users:
+            user_job_information['staleinfo'] = checkjob_stale_users[user]
+        if opts.options.format == 'binary':
+            body = QueueFileBody(user_job_information)
+            user_digest = digest(body.data)
+        else:
+            body = PickledPayload(CheckjobInfo(user_job_information))
+            user_digest = digest(body.pickled)
+
+        key = writer.changed('checkjob', user, user_digest)
+        if key is not None:
+            writer.submit('checkjob', user, key, user_digest, (timeinfo, body))
+
+    stored = writer.run()
+
+    stats = {
+        'hosts': len(showq_clusters) - len(failed_hosts),
+        'hosts_critical': len(set(failed_hosts) | set(checkjob_failed_hosts)),
+        'stored_showq': stored['showq'],
+        'stored_checkjob': stored['checkjob'],
+        'stored_critical': writer.no_store,
+        'unchanged': writer.unchanged,
+        'checkjob_hosts_cached': checkjob_hosts_cached,
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    stats.update(latency_statistics(host_latencies))
+    stats.update(cache_statistics)
+    return stats
+
+
+def main():
+    # Collect all info
+
+    # Note: debug option is provided by generaloption
+    # Note: other settings, e.g., for each cluster will be obtained from the configuration file
+    options = {
+        'nagios': ('print out nagios information', None, 'store_true', False, 'n'),
+        'nagios_check_filename': ('filename of where the nagios check data is stored', str, 'store', NAGIOS_CHECK_FILENAME),
+        'nagios_check_interval_threshold': ('threshold of nagios checks timing out', None, 'store', NAGIOS_CHECK_INTERVAL_THRESHOLD),
+        'hosts': ('the hosts/clusters that should be contacted for job information', None, 'extend', []),
+        'information': ('the sort of showq information to store: user, vo, project', None, 'store', 'user'),
+        'location': ('the location for storing the pickle files: home, scratch', str, 'store', 'home'),
+        'ha': ('high-availability master IP address', None, 'store', None),
+        'dry-run': ('do not make any updates whatsoever', None, 'store_true', False),
+        'host-deadline': ('number of seconds after which a host that did not report is considered failed',
+                          int, 'store', DEFAULT_HOST_DEADLINE),
+        'host-cache': ('file keeping the last good showq result of every host, to fall back on when a host fails',
+                       str, 'store', None),
+        'host-cache-refresh-interval': ('number of seconds during which the cached result of a host is used without querying it',
+                                        int, 'store', DEFAULT_REFRESH_INTERVAL),
+        'host-cache-max-stale': ('number of seconds during which the cached result is used for a failed host',
+                                 int, 'store', DEFAULT_MAX_STALE),
+        'writers': ('number of threads storing the pickle files', int, 'store', STORE_WRITERS),
+        'writers-per-filesystem': ('maximal number of concurrent writes per filesystem', int, 'store', None),
+        'write-timeout': ('number of seconds after which storing a pickle file is abandoned', int, 'store', STORE_TIMEOUT),
+        'digest-index': ('file keeping track of the information last stored per user, and its freshness',
+                         str, 'store', DIGEST_INDEX_FILENAME),
+        'force-write': ('store the pickle files for all users, even when unchanged', None, 'store_true', False),
+        'format': ('format of the per-user files: pickle, binary', None, 'store', 'pickle'),
+        'ldap-snapshot': ('file storing the local snapshot of the LDAP VOs and users', str, 'store', LDAP_SNAPSHOT_FILENAME),
+        'ldap-snapshot-full-refresh-interval': ('number of seconds after which the LDAP snapshot is fully rebuilt',
+                                                int, 'store', LDAP_SNAPSHOT_FULL_REFRESH_INTERVAL),
+        'checkjob-cache': ('file storing the checkjob information per host', str, 'store', CHECKJOB_CACHE_FILENAME),
+        'checkjob-cache-max-age': ('number of seconds after which checkjob is run for a host regardless',
+                                   int, 'store', CHECKJOB_CACHE_MAX_AGE),
+        'directory-cache-ttl': ('number of seconds after which the pickle directory of a user is looked up again',
+                                int, 'store', DIRECTORY_CACHE_TTL),
+        'daemon': ('keep running, collecting the information every interval seconds', None, 'store_true', False),
+        'interval': ('number of seconds between the start of subsequent cycles in daemon mode',
+                     int, 'store', DAEMON_INTERVAL),
+    }
+
+    opts = simple_option(options)
+
+    if opts.options.debug:
+        fancylogger.setLogLevelDebug()
+
+    nagios_reporter = NagiosReporter(NAGIOS_HEADER,
+                                     opts.options.nagios_check_filename,
+                                     opts.options.nagios_check_interval_threshold)
+    if opts.options.nagios:
+        logger.debug("Producing Nagios report and exiting.")
+        nagios_reporter.report_and_exit()
+        sys.exit(0)  # not reached
+
+    if not proceed_on_ha_service(opts.options.ha):
+        logger.warning("Not running on the target host in the HA setup. Stopping.")
+        nagios_reporter.cache(NAGIOS_EXIT_WARNING,
+                        NagiosResult("Not running on the HA master."))
+        sys.exit(NAGIOS_EXIT_WARNING)
+
+    lockfile = TimestampedPidLockfile(DMOAB_LOCK_FILE)
+    lock_or_bork(lockfile, nagios_reporter)
+
+    logger.info("Starting dmoab")
+
+    showq_clusters = {}
+    checkjob_clusters = {}
+    for host in opts.options.hosts:
+        master = opts.configfile_parser.get(host, "master")
+        showq_clusters[host] = {
+            'master': master,
+            'path': opts.configfile_parser.get(host, "showq_path")
+        }
+        checkjob_clusters[host] = {
+            'master': master,
+            'path': opts.configfile_parser.get(host, "checkjob_path")
+        }
+
+    # everything below is kept across the cycles in daemon mode
+    LdapQuery(VscConfiguration())
+
+    ldap_snapshot = None
+    if opts.options.information == 'vo':
+        ldap_snapshot = LdapSnapshot(opts.options.ldap_snapshot,
+                                     VscLdapGroup,
+                                     VscLdapUser,
+                                     LdapFilter,
+                                     opts.options.ldap_snapshot_full_refresh_interval)
+
+    checkjob_cache = CheckjobCache(opts.options.checkjob_cache, opts.options.checkjob_cache_max_age)
+
+    host_cache = None
+    if opts.options.host_cache:
+        # outside daemon mode the time between the runs is unknown, so every cached result is stale
+        cycle = DEFAULT_CYCLE
+        if opts.options.daemon:
+            cycle = opts.options.interval
+        host_cache = HostCache(opts.options.host_cache,
+                               opts.options.host_cache_refresh_interval,
+                               opts.options.host_cache_max_stale,
+                               cycle)
+
+    # the unchanged pickles are left alone, their freshness is recorded in the index
+    digest_index = None
+    if not opts.options.dry_run and not opts.options.force_write:
+        digest_index = DigestIndex(opts.options.digest_index)
+    mount_points = {}
+    directories = {}
+
+    def run_cycle():
+        return collect_and_store(opts, showq_clusters, checkjob_clusters, ldap_snapshot, checkjob_cache,
+                                 digest_index, mount_points, directories, host_cache)
+
+    if opts.options.daemon:
+        flush = None
+        if digest_index:
+            flush = digest_index.flush
+        stats = run_daemon(opts, lockfile, nagios_reporter, run_cycle, flush)
+    else:
+        stats = run_cycle()
+        if digest_index:
+            digest_index.close()
+
+    logger.info("Finished dmoab")
+
+    bork_result = NagiosResult("lock release failed", **stats)
+    release_or_bork(lockfile, nagios_reporter, bork_result)
+
+    if not opts.options.daemon:
+        nagios_reporter.cache(NAGIOS_EXIT_OK, NagiosResult("run successful", **stats))
+
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
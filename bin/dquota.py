@@ -21,10 +21,11 @@ Script to check for quota transgressions and notify the offending users.
 """
 
 import copy
+import multiprocessing
 import os
-import pwd
 import re
 import sys
+import threading
 import time
 
 from string import Template
@@ -34,13 +35,20 @@ from vsc.filesystem.gpfs import GpfsOperations
 from vsc.filesystem.quota.entities import QuotaUser, QuotaFileset
 from vsc.gpfs.quota.report import GpfsQuotaMailReporter
 from vsc.ldap.configuration import VscConfiguration
+from vsc.ldap.filters import LdapFilter
 from vsc.ldap.utils import LdapQuery
 from vsc.utils import fancylogger
 from vsc.utils.cache import FileCache
 from vsc.utils.generaloption import simple_option
+from vsc.utils.keyed_cache import open_keyed_cache
 from vsc.utils.lock import lock_or_bork, release_or_bork
 from vsc.utils.nagios import NagiosReporter, NagiosResult, NAGIOS_EXIT_OK, NAGIOS_EXIT_CRITICAL
+from vsc.utils.quota_digest import QuotaDigestIndex
+from vsc.utils.quota_table import QuotaTable, columnar_available, load_snapshot
+from vsc.utils.quota_timeseries import QuotaTimeSeries
 from vsc.utils.timestamp_pid_lockfile import TimestampedPidLockfile
+from vsc.utils.uid_index import UidIndex
+from vsc.utils.writer_pool import WriterPool
 
 ## Constants
 NAGIOS_CHECK_FILENAME = '/var/log/pickles/dquota.nagios.json.gz'
@@ -50,8 +58,24 @@ NAGIOS_CHECK_INTERVAL_THRESHOLD = 30 * 60  # 30 minutes
 QUOTA_CHECK_LOG_FILE = '/var/log/gpfs_quota_checker.log'
 QUOTA_CHECK_REMINDER_CACHE_FILENAME = '/var/log/quota/gpfs_quota_checker.report.reminderCache.pickle'
 QUOTA_CHECK_LOCK_FILE = '/var/run/gpfs_quota_checker_tpid.lock'
+QUOTA_CHECK_DIGEST_INDEX_FILENAME = '/var/log/quota/gpfs_quota_checker.digest.%(storage)s.json.gz'
+QUOTA_CHECK_TABLE_SNAPSHOT_FILENAME = '/var/log/quota/gpfs_quota_checker.table.%(storage)s.npz'
+QUOTA_CHECK_UID_INDEX_FILENAME = '/var/log/quota/gpfs_quota_checker.uids.json.gz'
+QUOTA_CHECK_UID_INDEX_TTL = 24 * 60 * 60  # 1 day
+QUOTA_CHECK_TIMESERIES_FILENAME = '/var/log/quota/gpfs_quota_checker.%(filesystem)s.timeseries'
+QUOTA_CHECK_FORECAST_HORIZON = 7 * 86400  # 1 week
+QUOTA_CHECK_FORECAST_LOGGED = 10  # number of entries named in the forecast warning
+QUOTA_CHECK_LDAP_BATCH_SIZE = 500  # users per LDAP query when prefetching the user paths
+QUOTA_CHECK_REMINDER_INTERVAL = 7 * 86400  # 1 week
 
-GPFS_GRACE_REGEX = re.compile(r"(?P<days>\d+)days|(?P<hours>\d+hours)|(?P<expired>expired)")
+GPFS_GRACE_REGEX = re.compile(r"(?P<days>\d+)\s*days?|(?P<hours>\d+)\s*hours?|(?P<expired>expired)")
+GPFS_NO_GRACE = (False, None)
+
+# mmrepquota only prints a handful of distinct grace strings, so we parse each one only once
+_grace_cache = {}
+
+# the LdapQuery instance a storage worker process inherited from its parent, see init_storage_worker
+_inherited_ldap_query = None
 
 # log setup
 fancylogger.logToFile(QUOTA_CHECK_LOG_FILE)
@@ -128,6 +152,72 @@ def get_mmrepquota_maps(quota_map, storage, filesystem, filesets):
     return {"USR": user_map, "FILESET": fs_map}
 
 
+def get_mmrepquota_tables(quota_map, storage, filesystem, filesets, snapshot=None):
+    """Obtain the quota information using the columnar QuotaTable representation.
+
+    Rather than updating a QuotaEntity for each GpfsQuota record, the records are first
+    stored in NumPy arrays. QuotaUser instances are only built for the users that exceed their
+    quota, or whose quota differs from the snapshot of the previous run (all users if there is
+    no snapshot). QuotaFileset instances are built for all filesets.
+
+    Returns a tuple ({ "USR": user dictionary, "FILESET": fileset dictionary}, the USR QuotaTable), the
+    dictionaries being those of get_mmrepquota_maps, restricted to the selected users.
+    """
+    timestamp = int(time.time())
+
+    def fileset_names(fileset):
+        return filesets[filesystem][fileset]['filesetName']
+
+    logger.info("ordering USR quota")
+    user_table = QuotaTable(quota_map['USR'], _parse_grace)
+    exceeding = user_table.exceeding_mask()
+    changed = user_table.changed_mask(snapshot)
+    selected = user_table.entity_mask(exceeding | changed, user_table.removed_entities(snapshot))
+    logger.info("%d USR quota records, %d exceeding, %d changed, %d selected" %
+                (len(user_table), exceeding.sum(), changed.sum(), selected.sum()))
+    user_map = user_table.entities(lambda user: QuotaUser(storage, filesystem, user),
+                                   fileset_names,
+                                   timestamp,
+                                   selected)
+
+    logger.info("ordering FILESET quota")
+    fileset_table = QuotaTable(quota_map['FILESET'], _parse_grace)
+    fs_map = fileset_table.entities(lambda fileset: QuotaFileset(storage, filesystem, fileset),
+                                    fileset_names,
+                                    timestamp)
+
+    return ({"USR": user_map, "FILESET": fs_map}, user_table)
+
+
+def _parse_grace(block_grace):
+    """Determine if the quota is in its grace period from the blockGrace string.
+
+    The result is cached per distinct string.
+
+    @type block_grace: string
+
+    @returns: tuple (in grace, remaining seconds or None)
+    """
+    try:
+        return _grace_cache[block_grace]
+    except KeyError:
+        pass
+
+    grace = GPFS_GRACE_REGEX.search(block_grace)
+    expired = GPFS_NO_GRACE
+    if grace:
+        grace = grace.groupdict()
+        if grace.get('days', None):
+            expired = (True, int(grace['days']) * 86400)
+        elif grace.get('hours', None):
+            expired = (True, int(grace['hours']) * 3600)
+        elif grace.get('expired', None):
+            expired = (True, 0)
+
+    _grace_cache[block_grace] = expired
+    return expired
+
+
 def _update_quota_entity(filesets, entity, filesystem, gpfs_quotas, timestamp):
     """
     Update the quota information for an entity (user or fileset).
@@ -141,20 +231,7 @@ def _update_quota_entity(filesets, entity, filesystem, gpfs_quotas, timestamp):
 
     for quota in gpfs_quotas:
         logger.debug("gpfs_quota = %s" % (str(quota)))
-        grace = GPFS_GRACE_REGEX.search(quota.blockGrace)
-
-        if not grace:
-            expired = (False, None)
-        else:
-            grace = grace.groupdict()
-            if grace.get('days', None):
-                expired = (True, grace['days'] * 86400)
-            elif grace.get('hours', None):
-                expired = (True, grace['hours'] * 3600)
-            elif grace.get('expired', None):
-                expired = (True, 0)
-            else:
-                expired = (False, None)
+        expired = _parse_grace(quota.blockGrace)
         if quota.filesetname:
             fileset_name = filesets[filesystem][quota.filesetname]['filesetName']
         else:
@@ -170,8 +247,102 @@ def _update_quota_entity(filesets, entity, filesystem, gpfs_quotas, timestamp):
     return entity
 
 
-def process_fileset_quota(gpfs, storage, filesystem, quota_map):
+def _store_quota_file(storage, path, filename, quota, owner):
+    """Atomically write the quota information to the given file, with the correct mode and ownership.
+
+    The temporary file in the same directory is created first, and gets its mode and ownership on the
+    open file descriptor. The FileCache then writes the information into it, after which the file is
+    renamed into place. Readers thus never see a partially written file, or a file with the wrong
+    permissions.
+
+    @type path: string, the directory the file is stored in
+    @type filename: string, the full path of the file
+    @type owner: function mapping the os.stat result of the directory to a (uid, gid) tuple
+    """
+    path_stat = os.stat(path)
+    (uid, gid) = owner(path_stat)
+
+    temp_filename = os.path.join(path, ".%s.%d.%d.tmp" % (os.path.basename(filename),
+                                                          os.getpid(),
+                                                          threading.currentThread().ident))
+    try:
+        fd = os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        try:
+            os.fchown(fd, uid, gid)
+            os.fchmod(fd, 0640)
+        finally:
+            os.close(fd)
+
+        # the temporary file is new, there is nothing to retain
+        cache = FileCache(temp_filename, False)
+        cache.update(key="quota", data=quota, threshold=0)
+        cache.update(key="storage", data=storage, threshold=0)
+        cache.close()
+
+        os.rename(temp_filename, filename)
+    except Exception:
+        if os.path.exists(temp_filename):
+            os.unlink(temp_filename)
+        raise
+
+    return filename
+
+
+def prefetch_user_paths(user_names, storage, batch_size=QUOTA_CHECK_LDAP_BATCH_SIZE):
+    """Determine the path on the given storage for all users, using a few bulk LDAP queries.
+
+    Rather than having each VscUser instance fetch its own LDAP entry, the entries are looked up
+    for batch_size users at a time.
+
+    @type user_names: list of VSC user names
+    @type storage: string
+
+    @returns: dict mapping user name to the user's path on the storage. Users that could not be
+              resolved are absent.
+    """
+    paths = {}
+    user_names = list(user_names)
+
+    for start in range(0, len(user_names), batch_size):
+        batch = user_names[start:start + batch_size]
+        ldap_filter = LdapFilter("cn=%s" % (batch[0]))
+        for user_name in batch[1:]:
+            ldap_filter = ldap_filter | LdapFilter("cn=%s" % (user_name))
+
+        try:
+            users = VscUser.lookup(ldap_filter)
+        except Exception, err:
+            logger.warning("Could not prefetch the LDAP information for %d users: %s" % (len(batch), err))
+            continue
+
+        for user in users:
+            try:
+                paths[user.user_id] = user._get_path(storage)
+            except Exception, err:
+                logger.warning("Could not determine path on storage %s for user %s: %s" % (storage, user.user_id, err))
+
+    logger.info("Prefetched the %s path for %d out of %d users" % (storage, len(paths), len(user_names)))
+    return paths
+
+
+def _store_user_quota_file(storage, user_name, quota, path=None):
+    """Write the quota information in the user's directory for the given storage.
+
+    If the path is not given, it is looked up through the user's VscUser instance.
+    """
+    logger.debug("User %s quota: %s" % (user_name, quota))
+
+    if not path:
+        path = VscUser(user_name)._get_path(storage)
+    filename = os.path.join(path, ".quota_user.json.gz")
+
+    return _store_quota_file(storage, path, filename, quota, lambda s: (s.st_uid, s.st_uid))
+
+
+def process_fileset_quota(gpfs, storage, filesystem, quota_map, digest_index=None):
     """Store the quota information in the filesets.
+
+    If a QuotaDigestIndex is given, the file is only written for filesets whose quota changed.
     """
 
     filesets = gpfs.list_filesets()
@@ -182,32 +353,43 @@ def process_fileset_quota(gpfs, storage, filesystem, quota_map):
     for (fileset, quota) in quota_map.items():
         logger.debug("Fileset %s quota: %s" % (filesets[filesystem][fileset]['filesetName'], quota))
 
+        #if quota.exceeds():
+        if True:
+            exceeding_filesets.append((fileset, quota))
+
+        digest = None
+        if digest_index:
+            digest = digest_index.changed(storage, 'FILESET', fileset, quota)
+            if not digest:
+                logger.debug("Fileset %s quota for storage %s is unchanged" % (fileset, storage))
+                continue
+
         path = filesets[filesystem][fileset]['path']
         filename = os.path.join(path, ".quota_fileset.json.gz")
-        path_stat = os.stat(path)
-
-        # TODO: This should somehow be some atomic operation.
-        cache = FileCache(filename)
-        cache.update(key="quota", data=quota, threshold=0)
-        cache.update(key="storage", data=storage, threshold=0)
-        cache.close()
 
-        gpfs.chmod(0640, filename)
-        gpfs.chown(path_stat.st_uid, path_stat.st_gid, filename)
+        _store_quota_file(storage, path, filename, quota, lambda s: (s.st_uid, s.st_gid))
 
         logger.info("Stored fileset %s quota for storage %s at %s" % (fileset, storage, filename))
 
-        #if quota.exceeds():
-        if True:
-            exceeding_filesets.append((fileset, quota))
+        if digest_index:
+            digest_index.stored(storage, 'FILESET', fileset, digest, filename)
 
     return exceeding_filesets
 
 
-def process_user_quota(gpfs, storage, filesystem, quota_map, user_map):
+def process_user_quota(gpfs, storage, filesystem, quota_map, user_map, digest_index=None, writer_pool=None):
     """Store the information in the user directories.
+
+    If a QuotaDigestIndex is given, the file is only written for users whose quota changed.
+
+    The files are written by the given WriterPool, or sequentially if there is none. A failed write
+    is logged and does not affect the other users.
+
+    @returns: tuple (list of (VscUser, quota) for the exceeding users, WriterStats or None,
+                     dict mapping the user ID to the error for the users whose file could not be written)
     """
     exceeding_users = []
+    writes = {}
 
     for (user_id, quota) in quota_map.items():
 
@@ -216,29 +398,54 @@ def process_user_quota(gpfs, storage, filesystem, quota_map, user_map):
         logger.debug("Checking quota for user %s with ID %s" % (user_name, user_id))
 
         if user_name and user_name.startswith('vsc'):
-            user = VscUser(user_name)
-            logger.debug("User %s quota: %s" % (user, quota))
-
-            path = user._get_path(storage)
-            path_stat = os.stat(path)
-            filename = os.path.join(path, ".quota_user.json.gz")
-
-            cache = FileCache(filename)
-            cache.update(key="quota", data=quota, threshold=0)
-            cache.update(key="storage", data=storage, threshold=0)
-            cache.close()
-
-            gpfs.ignorerealpathmismatch = True
-            gpfs.chmod(0640, filename)
-            gpfs.chown(path_stat.st_uid, path_stat.st_uid, filename)
-            gpfs.ignorerealpathmismatch = False
+            if quota.exceeds():
+                exceeding_users.append((VscUser(user_name), quota))
+
+            digest = None
+            if digest_index:
+                digest = digest_index.changed(storage, 'USR', user_id, quota)
+                if not digest:
+                    logger.debug("User %s quota for storage %s is unchanged" % (user_name, storage))
+                    continue
+
+            writes[user_id] = (user_name, quota, digest)
+
+    if not writes:
+        return (exceeding_users, None, {})
+
+    user_paths = prefetch_user_paths([user_name for (user_name, _, _) in writes.values()], storage)
+
+    if writer_pool:
+        for (user_id, (user_name, quota, _)) in writes.items():
+            writer_pool.submit(user_id,
+                               filesystem,
+                               _store_user_quota_file,
+                               storage,
+                               user_name,
+                               quota,
+                               user_paths.get(user_name))
+        (stored, failed, stats) = writer_pool.run()
+    else:
+        stored = {}
+        failed = {}
+        stats = None
+        for (user_id, (user_name, quota, _)) in writes.items():
+            try:
+                stored[user_id] = _store_user_quota_file(storage, user_name, quota, user_paths.get(user_name))
+            except Exception, err:
+                logger.error("Could not store quota for user %s: %s" % (user_name, err))
+                failed[user_id] = err
 
-            logger.info("Stored user %s quota for storage %s at %s" % (user_name, storage, filename))
+    for (user_id, filename) in stored.items():
+        (user_name, _, digest) = writes[user_id]
+        logger.info("Stored user %s quota for storage %s at %s" % (user_name, storage, filename))
+        if digest_index:
+            digest_index.stored(storage, 'USR', user_id, digest, filename)
 
-            if quota.exceeds():
-                exceeding_users.append((user, quota))
+    if failed:
+        logger.warning("storage %s failed to store quota for %d users" % (storage, len(failed)))
 
-    return exceeding_users
+    return (exceeding_users, stats, failed)
 
 
 def nagios_analyse_data(ex_users, ex_vos, user_count, vo_count):
@@ -258,8 +465,8 @@ def nagios_analyse_data(ex_users, ex_vos, user_count, vo_count):
     if ex_u == 0 and ex_v == 0:
         return (NAGIOS_EXIT_OK, NagiosResult("No quota exceeded", ex_u=0, ex_v=0, pU=0, pV=0))
     else:
-        pU = float(ex_u) / user_count
-        pV = float(ex_v) / vo_count
+        pU = float(ex_u) / max(1, user_count)
+        pV = float(ex_v) / max(1, vo_count)
         return (NAGIOS_EXIT_OK, NagiosResult("Quota exceeded", ex_u=ex_u, ex_v=ex_v, pU=pU, pV=pV))
 
 
@@ -297,21 +504,37 @@ def notify_exceeding_items(gpfs, storage, filesystem, exceeding_items, target, d
     - if the fileset belongs to a project: the project moderator
     - if the fileset belongs to a user: the user
 
-    The information is cached. The mail is sent in the following cases:
+    The information is cached in a KeyedCache, so only the entries of the exceeding items are touched.
+    The mail is sent in the following cases:
         - the excession is new
         - the excession occurred more than 7 days ago and stayed in the cache. In this case, the cache is updated as
           to avoid sending outdated mails repeatedly.
+
+    Afterwards, the entries older than 7 days are purged: these items no longer exceed their quota, and
+    should they exceed it again, they are notified anyway.
+
+    The cache is kept per storage and target. The cache of earlier versions (a gzipped FileCache shared
+    by the storages on the filesystem) is migrated the first time.
     """
-    cache_path = os.path.join(gpfs.list_filesystems()[filesystem]['defaultMountPoint'], ".quota_%s_cache.json.gz" % (target))
-    cache = FileCache(cache_path, True)  # we retain the old data
+    mount_point = gpfs.list_filesystems()[filesystem]['defaultMountPoint']
+    # sqlite keeps the database locked while it is being updated, so every storage on the filesystem,
+    # which may be processed concurrently, has its own cache
+    cache_path = os.path.join(mount_point, ".quota_%s_%s_cache.sqlite" % (storage, target))
+    legacy_cache_path = os.path.join(mount_point, ".quota_%s_cache.json.gz" % (target))
+    cache = open_keyed_cache(cache_path, legacy_cache_path)
 
     logger.info("Processing %d exceeding items" % (len(exceeding_items)))
 
     for (item, quota) in exceeding_items:
-        updated = cache.update(item, quota, 7 * 86400)
-        logger.info("Cache entry for %s was updated: %s" % (item, updated))
+        # users are VscUser instances, filesets are named by their ID
+        key = str(getattr(item, 'user_id', item))
+        updated = cache.update(key, quota, QUOTA_CHECK_REMINDER_INTERVAL)
+        logger.info("Cache entry for %s was updated: %s" % (key, updated))
         if updated:
-            notify(storage, item, quota, dry_run)
+            notify(storage, key, quota, dry_run)
+
+    purged = cache.purge(QUOTA_CHECK_REMINDER_INTERVAL)
+    logger.info("Purged %d expired entries from the %s cache" % (purged, target))
 
     cache.close()
 
@@ -329,13 +552,229 @@ def notify_exceeding_users(**kwargs):
     notify_exceeding_items(**kwargs)
 
 
-def map_uids_to_names():
-    """Determine the mapping between user ids and user names."""
-    ul = pwd.getpwall()
-    d = {}
-    for u in ul:
-        d[u[2]] = u[0]
-    return d
+def map_uids_to_names(uid_index, quota, filesystems):
+    """Determine the mapping between user ids and user names for the users with USR quota.
+
+    @type uid_index: UidIndex instance
+    @type quota: dict with the quota information per filesystem, as returned by GpfsOperations.list_quota
+    @type filesystems: the filesystems for which the users should be resolved
+    """
+    uids = set()
+    for filesystem in filesystems:
+        if filesystem in quota:
+            uids.update([int(uid) for uid in quota[filesystem]['USR']])
+    return uid_index.lookup(uids)
+
+
+def append_quota_timeseries(filename, quota_map, filesets, filesystem, timestamp):
+    """Append the quota information of this run to the filesystem's time series.
+
+    Each GpfsQuota record becomes an entry, identified by the quota type, entity and fileset name.
+
+    @returns: the QuotaTimeSeries instance
+    """
+    def samples():
+        for kind in ('USR', 'FILESET'):
+            for (entity, gpfs_quotas) in quota_map[kind].items():
+                for quota in gpfs_quotas:
+                    if quota.filesetname:
+                        fileset_name = filesets[filesystem][quota.filesetname]['filesetName']
+                    else:
+                        fileset_name = ''
+                    (expired, grace) = _parse_grace(quota.blockGrace)
+                    if not expired:
+                        grace = -1
+                    yield ("%s:%s:%s" % (kind, entity, fileset_name),
+                           int(quota.blockUsage),
+                           int(quota.blockQuota),
+                           int(quota.blockLimit),
+                           int(quota.blockInDoubt),
+                           grace)
+
+    timeseries = QuotaTimeSeries(filename)
+    timeseries.append(timestamp, samples())
+    return timeseries
+
+
+def forecast_hard_limits(timeseries, horizon=QUOTA_CHECK_FORECAST_HORIZON):
+    """Determine the quota entries that are expected to reach their hard limit within the horizon.
+
+    @returns: dict mapping the entry key to the estimated number of seconds, or None without NumPy
+    """
+    if not columnar_available():
+        logger.debug("NumPy is not available, not forecasting quota growth")
+        return None
+
+    forecast = timeseries.forecast()
+    return dict([(key, seconds) for (key, seconds) in forecast.items() if seconds is not None and seconds < horizon])
+
+
+def init_storage_worker():
+    """Set up the LDAP connection of a process_storage worker process.
+
+    LdapQuery is a Singleton, so the forked worker would reuse the instance of the parent, sharing
+    its LDAP connection. The inherited instance is dropped from the Singleton, and a new one is
+    created, which binds with its own connection. The inherited instance is kept referenced, since
+    closing it in the worker would also close the connection of the parent.
+    """
+    global _inherited_ldap_query
+    _inherited_ldap_query = LdapQuery._instances.pop(LdapQuery, None)
+    LdapQuery(VscConfiguration())
+
+
+def process_storage(storage, filesystem, quota_map, filesets, user_id_map, settings, gpfs=None):
+    """Process the quota for a single storage: store the quota files and notify the exceeding entities.
+
+    This can run in a separate process, in which case the log messages are tagged with the storage,
+    and a new GpfsOperations instance is created. The LDAP connection of such a process is set up by
+    init_storage_worker.
+
+    @type quota_map: the quota information for the storage's filesystem, as returned by GpfsOperations.list_quota
+    @type filesets: the filesets, as returned by GpfsOperations.list_filesets
+    @type user_id_map: dict mapping user ids to user names
+    @type settings: dict with the relevant command line options
+    @type gpfs: GpfsOperations instance, or None to create a new one
+
+    @returns: dict summarising the results for the storage
+    """
+    summary = {
+        'storage': storage,
+        'users': 0,
+        'filesets': 0,
+        'exceeding_users': [],
+        'exceeding_filesets': [],
+        'writes': None,
+        'reaching_hard_limit': 0,
+        'error': None,
+    }
+
+    if gpfs is None:
+        # running in a pool worker, this process only handles this storage
+        global logger
+        logger = fancylogger.getLogger('gpfs_quota_checker.%s' % (storage))
+        gpfs = GpfsOperations()
+
+    # the time series is only kept as an aid, failing to update it does not affect the quota files
+    if settings['timeseries']:
+        try:
+            timeseries = append_quota_timeseries(settings['timeseries'] % {'filesystem': filesystem},
+                                                 quota_map,
+                                                 filesets,
+                                                 filesystem,
+                                                 int(time.time()))
+            reaching = forecast_hard_limits(timeseries)
+            if reaching is not None:
+                keys = sorted(reaching.keys())
+                if len(keys) > QUOTA_CHECK_FORECAST_LOGGED:
+                    keys = keys[:QUOTA_CHECK_FORECAST_LOGGED] + ['...']
+                logger.warning("storage %s has %d quota entries expected to reach their hard limit within a week: %s" %
+                               (storage, len(reaching), ", ".join(keys)))
+                summary['reaching_hard_limit'] = len(reaching)
+        except Exception, err:
+            logger.warning("storage %s could not update the quota time series for filesystem %s: %s" %
+                           (storage, filesystem, err))
+
+    try:
+        user_table = None
+        if settings['columnar']:
+            # the users whose quota did not change since the snapshot and who do not exceed it are left out
+            snapshot_filename = settings['table_snapshot'] % {'storage': storage}
+            snapshot = None
+            if not settings['force_write']:
+                snapshot = load_snapshot(snapshot_filename)
+            (quota_storage_map, user_table) = get_mmrepquota_tables(quota_map, storage, filesystem, filesets, snapshot)
+        else:
+            quota_storage_map = get_mmrepquota_maps(quota_map, storage, filesystem, filesets)
+
+        summary['users'] = len(quota_map['USR'])
+        summary['filesets'] = len(quota_map['FILESET'])
+
+        if settings['force_write']:
+            digest_index = None
+        else:
+            digest_index = QuotaDigestIndex(settings['digest_index'] % {'storage': storage})
+
+        if settings['writers'] > 1:
+            writer_pool = WriterPool(settings['writers'], default_target_limit=settings['writers_per_filesystem'])
+        else:
+            writer_pool = None
+
+        exceeding_filesets = process_fileset_quota(gpfs,
+                                                   storage,
+                                                   filesystem,
+                                                   quota_storage_map['FILESET'],
+                                                   digest_index)
+        (exceeding_users, writer_stats, failed_users) = process_user_quota(gpfs,
+                                                                           storage,
+                                                                           filesystem,
+                                                                           quota_storage_map['USR'],
+                                                                           user_id_map,
+                                                                           digest_index,
+                                                                           writer_pool)
+        if digest_index:
+            digest_index.close()
+
+        if user_table is not None and not settings['dry_run']:
+            # the users whose file could not be written are left out, so they are selected again next time
+            complete = int(time.time())
+            if snapshot:
+                complete = snapshot.complete
+            user_table.snapshot(complete, failed_users.keys()).save(snapshot_filename)
+
+        if writer_stats:
+            logger.info("storage %s user quota writes: %s" % (storage, writer_stats))
+            summary['writes'] = writer_stats.summary()
+
+        logger.warning("storage %s found %d filesets that are exceeding their quota: %s" % (storage,
+                                                                                            len(exceeding_filesets),
+                                                                                            exceeding_filesets))
+        logger.warning("storage %s found %d users who are exceeding their quota: %s" % (storage,
+                                                                                        len(exceeding_users),
+                                                                                        exceeding_users))
+
+        notify_exceeding_filesets(gpfs=gpfs,
+                                  storage=storage,
+                                  filesystem=filesystem,
+                                  exceeding_items=exceeding_filesets,
+                                  dry_run=settings['dry_run'])
+        notify_exceeding_users(gpfs=gpfs,
+                               storage=storage,
+                               filesystem=filesystem,
+                               exceeding_items=exceeding_users,
+                               dry_run=settings['dry_run'])
+
+        summary['exceeding_filesets'] = [fileset for (fileset, _) in exceeding_filesets]
+        summary['exceeding_users'] = [user.user_id for (user, _) in exceeding_users]
+    except Exception, err:
+        logger.exception("storage %s processing failed: %s" % (storage, err))
+        summary['error'] = str(err)
+
+    return summary
+
+
+def merge_storage_summaries(summaries):
+    """Merge the per-storage summaries into a single nagios exit code and result."""
+    ex_users = []
+    ex_filesets = []
+    user_count = 0
+    fileset_count = 0
+    failed = []
+    for summary in summaries:
+        ex_users.extend(summary['exceeding_users'])
+        ex_filesets.extend(summary['exceeding_filesets'])
+        user_count += summary['users']
+        fileset_count += summary['filesets']
+        if summary['error']:
+            failed.append(summary['storage'])
+
+    (nagios_exit_code, nagios_result) = nagios_analyse_data(ex_users, ex_filesets, user_count, fileset_count)
+    if failed:
+        nagios_exit_code = NAGIOS_EXIT_CRITICAL
+        nagios_result = NagiosResult("CRITICAL processing failed for storage %s" % (", ".join(failed)),
+                                     ex_u=len(ex_users),
+                                     ex_v=len(ex_filesets),
+                                     failed=len(failed))
+    return (nagios_exit_code, nagios_result)
 
 
 def main():
@@ -347,11 +786,28 @@ def main():
         'nagios-check-interval-threshold': ('threshold of nagios checks timing out', None, 'store', NAGIOS_CHECK_INTERVAL_THRESHOLD),
         'storage': ('the VSC filesystems that are checked by this script', None, 'extend', []),
         'dry-run': ('do not make any updates whatsoever', None, 'store_true', False),
+        'columnar': ('use the NumPy based columnar quota representation', None, 'store_true', False),
+        'table-snapshot': ('file keeping the columnar quota table of the last run, '
+                           '%(storage)s is replaced by the storage name', str, 'store', QUOTA_CHECK_TABLE_SNAPSHOT_FILENAME),
+        'digest-index': ('file keeping track of the quota information last written per entity, '
+                         '%(storage)s is replaced by the storage name', str, 'store', QUOTA_CHECK_DIGEST_INDEX_FILENAME),
+        'force-write': ('write the quota files for all entities, even when unchanged', None, 'store_true', False),
+        'writers': ('number of threads writing the user quota files', int, 'store', 1),
+        'writers-per-filesystem': ('maximal number of concurrent writes per filesystem', int, 'store', None),
+        'uid-index': ('file caching the mapping of user ids to user names', str, 'store', QUOTA_CHECK_UID_INDEX_FILENAME),
+        'uid-index-ttl': ('number of seconds a cached user name remains valid', int, 'store', QUOTA_CHECK_UID_INDEX_TTL),
+        'timeseries': ('file storing the quota history, %(filesystem)s is replaced by the filesystem name',
+                       str, 'store', QUOTA_CHECK_TIMESERIES_FILENAME),
+        'concurrent-storage': ('process the storages concurrently, each in a separate process', None, 'store_true', False),
     }
     opts = simple_option(options)
 
     logger.info('started GPFS quota check run.')
 
+    if opts.options.columnar and not columnar_available():
+        logger.warning("NumPy is not available, falling back to the non-columnar quota representation")
+        opts.options.columnar = False
+
     nagios_reporter = NagiosReporter(NAGIOS_HEADER,
                                      opts.options.nagios_check_filename,
                                      opts.options.nagios_check_interval_threshold)
@@ -364,7 +820,6 @@ def main():
     lock_or_bork(lockfile, nagios_reporter)
 
     try:
-        user_id_map = map_uids_to_names() # is this really necessary?
         LdapQuery(VscConfiguration())
         gpfs = GpfsOperations()
         filesystems = gpfs.list_filesystems().keys()
@@ -375,9 +830,25 @@ def main():
 
         quota = gpfs.list_quota()
 
+        uid_index = UidIndex(opts.options.uid_index, opts.options.uid_index_ttl)
+        storage_filesystems = [opts.configfile_parser.get(storage, 'filesystem') for storage in opts.options.storage]
+        user_id_map = map_uids_to_names(uid_index, quota, storage_filesystems)
+        uid_index.close()
+
+        settings = {
+            'columnar': opts.options.columnar,
+            'table_snapshot': opts.options.table_snapshot,
+            'digest_index': opts.options.digest_index,
+            'force_write': opts.options.force_write,
+            'writers': opts.options.writers,
+            'writers_per_filesystem': opts.options.writers_per_filesystem,
+            'timeseries': opts.options.timeseries,
+            'dry_run': opts.options.dry_run,
+        }
+
+        storages = []
         for storage in opts.options.storage:
 
-            logger.info("Processing quota for storage %s" % (storage))
             filesystem = opts.configfile_parser.get(storage, 'filesystem')
 
             if filesystem not in filesystems:
@@ -388,30 +859,31 @@ def main():
                 logger.error("No quota defined for storage %s [%s]" % (storage, filesystem))
                 continue
 
-            quota_storage_map = get_mmrepquota_maps(quota[filesystem], storage,filesystem, filesets)
-
-            exceeding_filesets = process_fileset_quota(gpfs, storage, filesystem, quota_storage_map['FILESET'])
-            exceeding_users = process_user_quota(gpfs, storage, filesystem, quota_storage_map['USR'], user_id_map)
-
-            logger.warning("storage %s found %d filesets that are exceeding their quota: %s" % (storage,
-                                                                                                len(exceeding_filesets),
-                                                                                                exceeding_filesets))
-            logger.warning("storage %s found %d users who are exceeding their quota: %s" % (storage,
-                                                                                            len(exceeding_users),
-                                                                                            exceeding_users))
-
-            notify_exceeding_filesets(gpfs=gpfs,
-                                      storage=storage,
-                                      filesystem=filesystem,
-                                      exceeding_items=exceeding_filesets,
-                                      dry_run=opts.options.dry_run)
-            notify_exceeding_users(gpfs=gpfs,
-                                   storage=storage,
-                                   filesystem=filesystem,
-                                   exceeding_items=exceeding_users,
-                                   dry_run=opts.options.dry_run)
+            # the time series is per filesystem, so it is only appended for the first storage on the filesystem
+            storage_settings = settings
+            if filesystem in [f for (_, f, _) in storages]:
+                storage_settings = dict(settings, timeseries=None)
+
+            storages.append((storage, filesystem, storage_settings))
+
+        if opts.options.concurrent_storage and len(storages) > 1:
+            logger.info("Processing quota for storages %s concurrently" % ([s for (s, _, _) in storages]))
+            pool = multiprocessing.Pool(len(storages), init_storage_worker)
+            results = [pool.apply_async(process_storage, (storage, filesystem, quota[filesystem], filesets, user_id_map,
+                                                          storage_settings))
+                       for (storage, filesystem, storage_settings) in storages]
+            pool.close()
+            pool.join()
+            summaries = [result.get() for result in results]
+        else:
+            summaries = []
+            for (storage, filesystem, storage_settings) in storages:
+                logger.info("Processing quota for storage %s" % (storage))
+                summaries.append(process_storage(storage, filesystem, quota[filesystem], filesets, user_id_map,
+                                                 storage_settings, gpfs))
 
-        sys.exit(1)
+        for summary in summaries:
+            logger.info("storage %(storage)s: %(users)d users, %(filesets)d filesets, error: %(error)s" % summary)
 
     except Exception, err:
         logger.exception("critical exception caught: %s" % (err))
@@ -420,23 +892,15 @@ def main():
         if not opts.options.dry_run:
             lockfile.release()
         sys.exit(1)
-    except Exception, err:
-        logger.exception("exception caught: %s" % (err))
-        if not opts.options.dry_run:
-            lockfile.release()
-        sys.exit(1)
 
-    (nagios_exit_code, nagios_result) = nagios_analyse_data(ex_users,
-                                                            ex_vos,
-                                                            user_count=len(mm_rep_quota_map_users.values()),
-                                                            vo_count=len(mm_rep_quota_map_vos.values()))
+    (nagios_exit_code, nagios_result) = merge_storage_summaries(summaries)
 
     bork_result = copy.deepcopy(nagios_result)
     bork_result.message = "lock release failed"
     release_or_bork(lockfile, nagios_reporter, bork_result)
 
-    nagios_reporter.cache(nagios_exit_code, "%s" % (nagios_result,))
-    log.info("Nagios exit: (%s, %s)" % (nagios_exit_code, nagios_result))
+    nagios_reporter.cache(nagios_exit_code, nagios_result)
+    logger.info("Nagios exit: (%s, %s)" % (nagios_exit_code, nagios_result))
 
 if __name__ == '__main__':
     main()
@@ -21,24 +21,39 @@ showq pickle files in the users personal fileset.
 It should run on a regular bass to avoid information to become (too) outdated.
 """
 
+import logging
 import os
+import resource
 import sys
 import time
 
+from functools import partial
 
 from vsc.utils import fancylogger
-from vsc.administration.user import cluster_user_pickle_store_map, cluster_user_pickle_location_map
+from vsc.administration.user import cluster_user_pickle_location_map
 from vsc.utils.lock import lock_or_bork, release_or_bork
 from vsc.jobs.moab.showq import Showq
 from vsc.ldap.configuration import VscConfiguration
 from vsc.ldap.entities import VscLdapGroup, VscLdapUser
-from vsc.ldap.filters import InstituteFilter
+from vsc.ldap.filters import LdapFilter
 from vsc.ldap.utils import LdapQuery
 from vsc.utils.availability import proceed_on_ha_service
+from vsc.utils.digest_index import DigestIndex, digest
 from vsc.utils.fs_store import UserStorageError, FileStoreError, FileMoveError
 from vsc.utils.generaloption import simple_option
+from vsc.utils.host_cache import HostCache, stale_information, DEFAULT_CYCLE, DEFAULT_REFRESH_INTERVAL, \
+    DEFAULT_MAX_STALE
+from vsc.utils.ldap_snapshot import LdapSnapshot
+from vsc.utils.moab_collect import collect_concurrently, latency_statistics, DEFAULT_HOST_DEADLINE
 from vsc.utils.nagios import NagiosReporter, NagiosResult, NAGIOS_EXIT_OK, NAGIOS_EXIT_WARNING
+from vsc.utils.periodic import run_daemon
+from vsc.utils.pickled_payload import PickledPayload
+from vsc.utils.queue_file import QueueFileBody, KIND_SHOWQ, dumps as dumps_queue_file, store as store_queue_file,\
+    store_pickle
+from vsc.utils.queue_index import write_queue_index
+from vsc.utils.queue_targets import collect_vo_ldap, determine_target_information
 from vsc.utils.timestamp_pid_lockfile import TimestampedPidLockfile
+from vsc.utils.writer_pool import WriterPool, mount_point
 
 
 #Constants
@@ -50,91 +65,215 @@ NAGIOS_REPORT_VALUES_TEMPLATE = "HR=%d, HU=%d, UC=%d, NS=%d"
 
 DSHOWQ_LOCK_FILE = '/var/run/dshowq_tpid.lock'
 
-DEFAULT_VO = 'gvo00012'
+DIGEST_INDEX_FILENAME = '/var/log/pickles/dshowq.digest.json.gz'
+
+STORE_WRITERS = 1
+STORE_TIMEOUT = 60  # seconds
+
+LDAP_SNAPSHOT_FILENAME = '/var/log/pickles/dshowq.ldap_snapshot.pickle'
+LDAP_SNAPSHOT_FULL_REFRESH_INTERVAL = 24 * 60 * 60  # 1 day
+
+DAEMON_INTERVAL = 5 * 60  # 5 minutes
+
+QUEUE_INDEX_SHARDS = 1
 
 logger = fancylogger.getLogger(__name__)
 fancylogger.logToScreen(True)
 fancylogger.setLogLevelInfo()
 
 
-def collect_vo_ldap(active_users):
-    """Determine which active users are in the same VO.
-
-    @type active_users: list of strings
+def get_pickle_path(location, user_id, file_format='pickle'):
+    """Determine the path (directory) where the pickle file qith the queue information should be stored.
 
-    @param active_users: the users for which there currently are jobs running
+    @type location: string
+    @type user_id: string
+    @type file_format: string, pickle or binary
 
-    Generates a mapping between each user that belongs to a VO for which a member has jobs running and the active users
-    from that VO. If the user belongs to the default VO, he cannot see any information of the other users from this VO.
+    @param location: indication of the user accesible storage spot to use, e.g., home or scratch
+    @param user_id: VSC user ID
 
-    @return: dict with vo IDs as keys (default VO members are their own VO) and dicts mapping uid to gecos as values.
+    @returns: tuple of (string representing the directory where the pickle file should be stored,
+                        the storing function, vsc.utils.queue_file.store_pickle, or vsc.utils.queue_file.store for the binary format).
     """
-    LdapQuery(VscConfiguration())
-    ldap_filter = InstituteFilter('antwerpen') | InstituteFilter('brussel') | InstituteFilter('gent') | InstituteFilter('leuven')
-
-    vos = [g for g in VscLdapGroup.lookup(ldap_filter) if g.group_id.startswith('gvo')]
-    members = dict([(u.user_id, u) for u in VscLdapUser.lookup(ldap_filter)])
-    user_to_vo_map = dict([(u, vo) for vo in vos for u in vo.memberUid])
-
-    user_maps_per_vo = {}
-    found = set()
-    for user in active_users:
-
-        # If we already have a mapping for this user, we need not add him again
-        if user in found:
-            continue
-
-        # find VO of this user
-        vo = user_to_vo_map.get(user, None)
-        if vo:
-            if vo.group_id == DEFAULT_VO:
-                logger.debug("user %s belongs to the default vo %s" % (user, vo.group_id))
-                found.add(user)
-                name = members[user].gecos
-                user_maps_per_vo[user] = {user: name}
-            else:
-                user_map = dict([(uid, members[uid].gecos) for uid in vo.memberUid and uid in active_users])
-                for uid in user_map:
-                    found.add(uid)
-                user_maps_per_vo[vo.group_id] = user_map
-                logger.debug("added userMap for the vo %s" % (vo.group_id))
-        # ignore users not in any VO (including default VO)
+    path = cluster_user_pickle_location_map[location](user_id).pickle_path()
+    if file_format == 'binary':
+        return (os.path.join(path, ".showq.vscq"), partial(store_queue_file, KIND_SHOWQ))
+    return (os.path.join(path, ".showq.pickle"), store_pickle)
 
-    return (found, user_maps_per_vo)
 
+def peak_rss():
+    """The peak resident set size of this process so far, in KiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
 
-def determine_target_information(information, active_users, queue_information):
-    """Determine for the given information type, what should be stored for which users."""
 
-    if information == 'user':
-        user_info = dict([(u, {u: ""}) for u in active_users])  # FIXME: faking it
-        return (active_users, dict([(user, {user: queue_information[user]}) for user in active_users]), user_info)
-    elif information == 'vo':
-        (all_target_users, user_maps_per_vo) = collect_vo_ldap(active_users)
+def store_queue_index(opts, timeinfo, target_groups, reported_hosts, failed_hosts, host_latencies):
+    """Store the queue information for all target users in the central queue index.
 
-        target_queue_information = {}
-        for vo in user_maps_per_vo.values():
-            filtered_queue_information = dict([(user_id, queue_information[user_id]) for user_id in vo if user_id in queue_information])
-            target_queue_information.update(dict([(user_id, filtered_queue_information) for user_id in vo]))
+    @returns: dict with the values for the NagiosResult
+    """
+    entries = {}
+    while target_groups:
+        (members, group_queue_information, user_map) = target_groups.popitem()[1]
+        data = dumps_queue_file(KIND_SHOWQ, timeinfo, QueueFileBody((group_queue_information, user_map)))
+        for user in members:
+            entries[user] = data
+
+    stored = 0
+    stored_critical = 0
+    if opts.options.dry_run:
+        logger.info("Dry run, not actually storing the queue index %s for %d users" % (opts.options.queue_index, len(entries)))
+    else:
+        try:
+            write_queue_index(opts.options.queue_index, timeinfo, entries, opts.options.queue_index_shards)
+            stored = len(entries)
+        except (IOError, OSError), err:
+            logger.error("Could not store the queue index %s: %s" % (opts.options.queue_index, err))
+            stored_critical = len(entries)
+
+    stats = {
+        'hosts': len(reported_hosts),
+        'hosts_critical': len(failed_hosts),
+        'stored': stored,
+        'stored_critical': stored_critical,
+        'peak_rss': peak_rss(),
+    }
+    stats.update(latency_statistics(host_latencies))
+    return stats
 
-        return (all_target_users, target_queue_information, user_maps_per_vo)
-    elif information == 'project':
-        return (None, None, None)
 
+def collect_and_store(opts, clusters, showq, ldap_snapshot, digest_index, mount_points, host_cache=None):
+    """Collect the queue information and store the pickle files for the target users.
 
-def get_pickle_path(location, user_id):
-    """Determine the path (directory) where the pickle file qith the queue information should be stored.
+    @type opts: the script options
+    @type clusters: dict mapping the hosts to their master and showq path
+    @type showq: Showq instance, or None to query the hosts concurrently
+    @type ldap_snapshot: LdapSnapshot instance, or None if the VO information is not needed
+    @type digest_index: DigestIndex instance, or None to store all pickle files
+    @type mount_points: dict caching the mount point of the pickle directories
+    @type host_cache: HostCache instance, or None to always query all hosts
 
-    @type location: string
-    @type user_id: string
+    @returns: dict with the values for the NagiosResult
+    """
+    host_latencies = {}
+    cache_statistics = {}
+    stale_users = {}
+    if opts.options.concurrent_hosts or host_cache:
+        (queue_information, reported_hosts, failed_hosts, host_latencies) = \
+            collect_concurrently(Showq, clusters, opts.options.host_deadline, host_cache,
+                                 cache_pickle=True, dry_run=opts.options.dry_run)
+        if host_cache:
+            cache_statistics = host_cache.statistics()
+            stale_users = host_cache.stale_users()
+            if not opts.options.dry_run:
+                host_cache.store()
+    else:
+        (queue_information, reported_hosts, failed_hosts) = showq.get_moab_command_information()
+    timeinfo = time.time()
 
-    @param location: indication of the user accesible storage spot to use, e.g., home or scratch
-    @param user_id: VSC user ID
+    active_users = queue_information.keys()
 
-    @returns: tuple of (string representing the directory where the pickle file should be stored,
-                        the relevant storing function in vsc.utils.fs_store).
-    """
-    return (os.path.join(cluster_user_pickle_location_map[location](user_id).pickle_path(), ".showq.pickle"), cluster_user_pickle_store_map[location])
+    # formatting the complete queue information is expensive, so only do it when it is logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Active users: %s" % (active_users))
+        logger.debug("Queue information: %s" % (queue_information))
+
+    # We need to determine which users should get an updated pickle. This depends on
+    # - the active user set
+    # - the information we want to provide on the cluster(set) where this script runs
+    # At the same time, we need to determine the job information each user gets to see
+    (target_users, target_groups) = determine_target_information(opts.options.information,
+                                                                 active_users,
+                                                                 queue_information,
+                                                                 lambda users: collect_vo_ldap(users, ldap_snapshot))
+    # from here on, the information of a group is only referenced from target_groups, so it is
+    # released as soon as the group has been serialised
+    queue_information = None
+
+    # the information of hosts that could not be queried, or was not queried in this cycle, comes from the host
+    # cache, which is marked in the information of the groups having such data with the time it was collected
+    if stale_users:
+        for (_, group_queue_information, _) in target_groups.values():
+            staleinfo = stale_information(group_queue_information, stale_users)
+            if staleinfo:
+                group_queue_information['staleinfo'] = staleinfo
+
+    if opts.options.queue_index:
+        return dict(store_queue_index(opts, timeinfo, target_groups, reported_hosts, failed_hosts, host_latencies),
+                    **cache_statistics)
+
+    nagios_user_count = 0
+    nagios_no_store = 0
+
+    writer_pool = WriterPool(opts.options.writers,
+                             default_target_limit=opts.options.writers_per_filesystem,
+                             timeout=opts.options.write_timeout)
+
+    digests = {}
+    nagios_unchanged = 0
+    # the binary files are tracked separately in the digest index
+    key_suffix = ""
+    if opts.options.format == 'binary':
+        key_suffix = ":binary"
+
+    while target_groups:
+        (group, (members, group_queue_information, user_map)) = target_groups.popitem()
+        # all members get the same information, so it is serialised only once
+        group_digest = digest(PickledPayload((group_queue_information, user_map)).pickled)
+        group_info = group_queue_information
+        group_queue_information = dict(group_queue_information)
+        group_queue_information['timeinfo'] = timeinfo
+        payload = None
+
+        for user in members:
+            key = "%s:%s%s" % (opts.options.location, user, key_suffix)
+            if digest_index and not digest_index.changed(key, group_digest):
+                logger.debug("Queue information for user %s is unchanged" % (user))
+                nagios_unchanged += 1
+                continue
+
+            if payload is None:
+                if opts.options.format == 'binary':
+                    payload = (timeinfo, QueueFileBody((group_info, user_map)))
+                else:
+                    payload = PickledPayload((group_queue_information, user_map))
+
+            if not opts.options.dry_run:
+                try:
+                    (path, store) = get_pickle_path(opts.options.location, user, opts.options.format)
+                except (UserStorageError, FileStoreError, FileMoveError), err:
+                    logger.error("Could not determine pickle path for user %s" % (user))
+                    nagios_no_store += 1
+                    continue
+                writer_pool.submit(user, mount_point(os.path.dirname(path), mount_points), store, user, path, payload)
+                digests[user] = (key, group_digest, path)
+            else:
+                logger.info("Dry run, not actually storing data for user %s at path %s" % (user, get_pickle_path(opts.options.location, user, opts.options.format)[0]))
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Dry run, queue information for user %s in %s is %s" % (user, group, group_queue_information))
+
+    (stored, failed, _) = writer_pool.run()
+    nagios_user_count += len(stored)
+    if digest_index:
+        for user in stored:
+            digest_index.stored(*digests[user])
+    for (user, err) in failed.items():
+        if isinstance(err, (UserStorageError, FileStoreError, FileMoveError)):
+            logger.error("Could not store pickle file for user %s" % (user))
+        else:
+            logger.error("Could not store pickle file for user %s, unexpected error: %s" % (user, err))
+        nagios_no_store += 1
+
+    stats = {
+        'hosts': len(reported_hosts),
+        'hosts_critical': len(failed_hosts),
+        'stored': nagios_user_count,
+        'stored_critical': nagios_no_store,
+        'unchanged': nagios_unchanged,
+        'peak_rss': peak_rss(),
+    }
+    stats.update(latency_statistics(host_latencies))
+    stats.update(cache_statistics)
+    return stats
 
 
 def main():
@@ -151,6 +290,31 @@ def main():
         'location': ('the location for storing the pickle file: gengar, muk', str, 'store', 'gengar'),
         'ha': ('high-availability master IP address', None, 'store', None),
         'dry-run': ('do not make any updates whatsoever', None, 'store_true', False),
+        'concurrent-hosts': ('query the hosts concurrently', None, 'store_true', False),
+        'host-deadline': ('number of seconds after which a host that did not report is considered failed',
+                          int, 'store', DEFAULT_HOST_DEADLINE),
+        'host-cache': ('file keeping the last good result of every host, to fall back on when a host fails',
+                       str, 'store', None),
+        'host-cache-refresh-interval': ('number of seconds during which the cached result of a host is used without querying it',
+                                        int, 'store', DEFAULT_REFRESH_INTERVAL),
+        'host-cache-max-stale': ('number of seconds during which the cached result is used for a failed host',
+                                 int, 'store', DEFAULT_MAX_STALE),
+        'writers': ('number of threads storing the pickle files', int, 'store', STORE_WRITERS),
+        'writers-per-filesystem': ('maximal number of concurrent writes per filesystem', int, 'store', None),
+        'write-timeout': ('number of seconds after which storing a pickle file is abandoned', int, 'store', STORE_TIMEOUT),
+        'digest-index': ('file keeping track of the information last stored per user, and its freshness',
+                         str, 'store', DIGEST_INDEX_FILENAME),
+        'force-write': ('store the pickle files for all users, even when unchanged', None, 'store_true', False),
+        'ldap-snapshot': ('file storing the local snapshot of the LDAP VOs and users', str, 'store', LDAP_SNAPSHOT_FILENAME),
+        'ldap-snapshot-full-refresh-interval': ('number of seconds after which the LDAP snapshot is fully rebuilt',
+                                                int, 'store', LDAP_SNAPSHOT_FULL_REFRESH_INTERVAL),
+        'format': ('format of the per-user files: pickle, binary', None, 'store', 'pickle'),
+        'queue-index': ('store the information for all users in this central queue index, instead of per-user files',
+                        str, 'store', None),
+        'queue-index-shards': ('number of shard files of the queue index', int, 'store', QUEUE_INDEX_SHARDS),
+        'daemon': ('keep running, collecting the information every interval seconds', None, 'store_true', False),
+        'interval': ('number of seconds between the start of subsequent cycles in daemon mode',
+                     int, 'store', DAEMON_INTERVAL),
     }
 
     opts = simple_option(options)
@@ -184,60 +348,59 @@ def main():
             'path': showq_path
         }
 
-    showq = Showq(clusters, cache_pickle=True, dry_run=opts.options.dry_run)
-
-    (queue_information, reported_hosts, failed_hosts) = showq.get_moab_command_information()
-    timeinfo = time.time()
-
-    active_users = queue_information.keys()
-
-    logger.debug("Active users: %s" % (active_users))
-    logger.debug("Queue information: %s" % (queue_information))
-
-    # We need to determine which users should get an updated pickle. This depends on
-    # - the active user set
-    # - the information we want to provide on the cluster(set) where this script runs
-    # At the same time, we need to determine the job information each user gets to see
-    (target_users, target_queue_information, user_map) = determine_target_information(opts.options.information,
-                                                                                      active_users,
-                                                                                      queue_information)
-
-    nagios_user_count = 0
-    nagios_no_store = 0
+    # everything below is kept across the cycles in daemon mode
+    host_cache = None
+    if opts.options.host_cache:
+        # outside daemon mode the time between the runs is unknown, so every cached result is stale
+        cycle = DEFAULT_CYCLE
+        if opts.options.daemon:
+            cycle = opts.options.interval
+        host_cache = HostCache(opts.options.host_cache,
+                               opts.options.host_cache_refresh_interval,
+                               opts.options.host_cache_max_stale,
+                               cycle)
+
+    showq = None
+    if not opts.options.concurrent_hosts and not host_cache:
+        showq = Showq(clusters, cache_pickle=True, dry_run=opts.options.dry_run)
+
+    ldap_snapshot = None
+    if opts.options.information == 'vo':
+        ldap_snapshot = LdapSnapshot(opts.options.ldap_snapshot,
+                                     VscLdapGroup,
+                                     VscLdapUser,
+                                     LdapFilter,
+                                     opts.options.ldap_snapshot_full_refresh_interval)
 
     LdapQuery(VscConfiguration())
 
-    for user in target_users:
-        if not opts.options.dry_run:
-            try:
-                (path, store) = get_pickle_path(opts.options.location, user)
-                user_queue_information = target_queue_information[user]
-                user_queue_information['timeinfo'] = timeinfo
-                store(user, path, (user_queue_information, user_map[user]))
-                nagios_user_count += 1
-            except (UserStorageError, FileStoreError, FileMoveError), err:
-                logger.error("Could not store pickle file for user %s" % (user))
-                nagios_no_store += 1
-        else:
-            logger.info("Dry run, not actually storing data for user %s at path %s" % (user, get_pickle_path(opts.options.location, user)[0]))
-            logger.debug("Dry run, queue information for user %s is %s" % (user, target_queue_information[user]))
+    # the unchanged pickles are left alone, their freshness is recorded in the index
+    digest_index = None
+    if not opts.options.dry_run and not opts.options.force_write:
+        digest_index = DigestIndex(opts.options.digest_index)
+    mount_points = {}
+
+    def run_cycle():
+        return collect_and_store(opts, clusters, showq, ldap_snapshot, digest_index, mount_points, host_cache)
+
+    if opts.options.daemon:
+        flush = None
+        if digest_index:
+            flush = digest_index.flush
+        stats = run_daemon(opts, lockfile, nagios_reporter, run_cycle, flush)
+    else:
+        stats = run_cycle()
+        if digest_index:
+            digest_index.close()
 
     logger.info("Finished dshowq")
 
     #FIXME: this still looks fugly
-    bork_result = NagiosResult("lock release failed",
-                               hosts=len(reported_hosts),
-                               hosts_critical=len(failed_hosts),
-                               stored=nagios_user_count,
-                               stored_critical=nagios_no_store)
+    bork_result = NagiosResult("lock release failed", **stats)
     release_or_bork(lockfile, nagios_reporter, bork_result)
 
-    nagios_reporter.cache(NAGIOS_EXIT_OK,
-                          NagiosResult("run successful",
-                                       hosts=len(reported_hosts),
-                                       hosts_critical=len(failed_hosts),
-                                       stored=nagios_user_count,
-                                       stored_critical=nagios_no_store))
+    if not opts.options.daemon:
+        nagios_reporter.cache(NAGIOS_EXIT_OK, NagiosResult("run successful", **stats))
 
     sys.exit(0)
 
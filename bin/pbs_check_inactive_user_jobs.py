@@ -52,6 +52,9 @@ NAGIOS_CHECK_INTERVAL_THRESHOLD = 60 * 60  # 60 minutes
 
 PBS_CHECK_LOG_FILE = '/var/log/pbs_check_inactive_user_jobs.log'
 
+# the job attributes used in the checks and the reports, PBS need not send the others
+PBS_JOB_ATTRIBUTES = ['euser', 'job_state', 'qtime', 'exec_host', 'start_time']
+
 
 def get_user_with_status(status):
     """Get the users from the HPC LDAP that match the given status.
@@ -86,13 +89,12 @@ def remove_queued_jobs(jobs, grace_users, inactive_users, dry_run=True):
 
     @returns: list of jobs that have been removed
     """
-    uids = [u.user_id for u in grace_users]
-    uids.extend([u.user_id for u in inactive_users])
+    uids = set([u.user_id for u in grace_users])
+    uids.update([u.user_id for u in inactive_users])
 
     jobs_to_remove = []
-    for (job_name, job) in jobs.items():
-        user_id = jobs[job_name]['euser'][0]
-        if user_id in uids:
+    for (job_name, job) in jobs.iteritems():
+        if job['euser'][0] in uids:
             jobs_to_remove.append((job_name, job))
 
     logger.info("Found {queued_count} queued jobs belonging to gracing or inactive users".format(queued_count=len(jobs_to_remove)))
@@ -222,7 +224,7 @@ def main(args):
         pbs_query = PBSQuery()
 
         t = time.ctime()
-        jobs = pbs_query.getjobs()  # we just get them all
+        jobs = pbs_query.getjobs(attrib_list=PBS_JOB_ATTRIBUTES)  # all jobs, with only the attributes we use
 
         removed_queued = remove_queued_jobs(jobs, grace_users, inactive_users, opts.options.dry_run)
         removed_running = remove_running_jobs(jobs, inactive_users, opts.options.dry_run)
@@ -240,7 +242,7 @@ def main(args):
         nagios_reporter.cache(NAGIOS_EXIT_CRITICAL,
                               NagiosResult("grace or inactive user jobs queud",
                                            queued=len(removed_queued),
-                                           running=len(remove_running_jobs)))
+                                           running=len(removed_running)))
     else:
         nagios_reporter.cache(NAGIOS_EXIT_OK,
                               NagiosResult("no queued or running jobs for grace or inactive users",
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+##
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Per-host cache of the checkjob information, for incremental collection.
+
+Running checkjob for all idle and blocked jobs is expensive for the Moab masters. The cheap
+showq listing tells us which jobs are present, in which state, and why they are blocked. The
+checkjob information of a host is only collected again when that listing changed, i.e., when
+a job appeared or disappeared, or a job changed state or blocking reason, or when the cached
+information has become too old.
+
+The listing is the one the caller already collected, e.g., dmoab reuses the showq information it
+stores anyway, so no extra showq is run to decide whether checkjob is needed.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import cPickle
+import os
+import time
+
+from vsc.utils import fancylogger
+from vsc.utils.moab_collect import collect_per_host, DEFAULT_HOST_DEADLINE
+
+logger = fancylogger.getLogger(__name__)
+
+DEFAULT_MAX_AGE = 60 * 60  # seconds
+
+# the job attributes, as parsed from the showq XML by vsc.jobs.moab.showq, holding the job ID and
+# the reason a job is blocked
+JOB_ID_KEY = 'JobID'
+JOB_REASON_KEYS = ('BlockReason', 'Description')
+# states whose jobs checkjob does not report on
+IGNORED_STATES = ('Running',)
+
+
+def job_fingerprint(listing, ignored_states=IGNORED_STATES, state=None, fingerprint=None):
+    """Determine the state and blocking reason of every job in the (showq) listing.
+
+    The listing is a nested dict, in which the job lists are stored under the state they are in.
+
+    @returns: dict mapping the job ID to a tuple (state, blocking reason, description), or None if there
+              is a job without ID, in which case changes cannot be detected
+    """
+    if fingerprint is None:
+        fingerprint = {}
+
+    if isinstance(listing, dict):
+        for (key, value) in listing.items():
+            if job_fingerprint(value, ignored_states, key, fingerprint) is None:
+                return None
+    elif isinstance(listing, list) and state not in ignored_states:
+        for job in listing:
+            if isinstance(job, dict):
+                job_id = job.get(JOB_ID_KEY)
+                if job_id is None:
+                    logger.warning("Job without %s in state %s, cannot detect changes: %s" % (JOB_ID_KEY, state, job))
+                    return None
+                fingerprint[job_id] = (state,) + tuple([job.get(key) for key in JOB_REASON_KEYS])
+
+    return fingerprint
+
+
+class CheckjobCache(object):
+    """Keeps the checkjob information of every host, with the job fingerprint it corresponds to."""
+
+    def __init__(self, filename, max_age=DEFAULT_MAX_AGE):
+        """Initialisation.
+
+        @type filename: string, the file where the cache is stored
+        @type max_age: int, number of seconds after which the information of a host is collected again regardless
+        """
+        self.filename = filename
+        self.max_age = max_age
+        self.hosts = {}
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.filename):
+            return
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                self.hosts = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception, err:
+            logger.warning("Could not load checkjob cache %s, starting from scratch: %s" % (self.filename, err))
+            self.hosts = {}
+
+    def store(self):
+        """Store the cache on disk."""
+        temp_filename = "%s.tmp" % (self.filename)
+        f = open(temp_filename, 'wb')
+        try:
+            cPickle.dump(self.hosts, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(temp_filename, self.filename)
+
+    def lookup(self, host, fingerprint):
+        """Get the cached information for the host, or None if it is missing, too old, or for other jobs.
+
+        @type fingerprint: as returned by job_fingerprint, None always counts as changed
+        """
+        if host not in self.hosts or fingerprint is None:
+            return None
+
+        (cached_fingerprint, information, timestamp) = self.hosts[host]
+        if time.time() - timestamp > self.max_age:
+            logger.debug("Cached checkjob information for host %s is too old" % (host))
+            return None
+        if cached_fingerprint != fingerprint:
+            changed = len([j for (j, s) in fingerprint.items() if cached_fingerprint.get(j) != s])
+            gone = len([j for j in cached_fingerprint if j not in fingerprint])
+            logger.debug("Host %s has %d new or changed and %d removed jobs" % (host, changed, gone))
+            return None
+
+        return information
+
+    def update(self, host, fingerprint, information):
+        self.hosts[host] = (fingerprint, information, time.time())
+
+
+def collect_changed(cache, listings, command_class, clusters, deadline=DEFAULT_HOST_DEADLINE, **kwargs):
+    """Get the command information for the hosts with a job listing, only running the command if the listing changed.
+
+    The command is run concurrently for the hosts whose listing changed, see collect_per_host.
+
+    @type cache: CheckjobCache instance
+    @type listings: dict mapping the host to its job listing, i.e., its showq information
+    @type command_class: the vsc.jobs.moab class to use, i.e., Checkjob
+    @type clusters: dict mapping the host to its master and command path
+    @type deadline: number of seconds after which the hosts that did not finish are considered to have failed
+    @param kwargs: passed to the command_class constructor
+
+    @returns: tuple (dict mapping the reported hosts to their information, failed hosts,
+                     hosts for which the command was run)
+    """
+    host_information = {}
+    fingerprints = {}
+    queried_clusters = {}
+
+    for (host, listing) in listings.items():
+        fingerprint = job_fingerprint(listing)
+        information = cache.lookup(host, fingerprint)
+        if information is None:
+            fingerprints[host] = fingerprint
+            queried_clusters[host] = clusters[host]
+        else:
+            host_information[host] = information
+
+    failed_hosts = []
+    queried_hosts = []
+    if queried_clusters:
+        (queried_information, failed_hosts, _) = collect_per_host(command_class, queried_clusters, deadline, **kwargs)
+        for (host, information) in queried_information.items():
+            if fingerprints[host] is not None:
+                cache.update(host, fingerprints[host], information)
+            host_information[host] = information
+            queried_hosts.append(host)
+
+    logger.info("Collected information from %d hosts, %d from the cache, %d failed" %
+                (len(host_information), len(host_information) - len(queried_hosts), len(failed_hosts)))
+    return (host_information, failed_hosts, queried_hosts)
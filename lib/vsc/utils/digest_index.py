@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+##
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Central index of the digest of the data that was last written per key.
+
+Scripts that write a file per user (or other entity) on every run can use the index to
+skip rewriting files whose contents did not change. The unchanged files themselves are
+left alone: the writer may not be allowed to modify them, e.g., on root-squashed storage.
+The index records when the data was last seen instead, and the files are rewritten at
+least every rewrite interval, which bounds how old the timestamp in a file can get.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import hashlib
+import time
+
+from vsc.utils import fancylogger
+from vsc.utils.cache import FileCache
+
+logger = fancylogger.getLogger(__name__)
+
+# rewrite the file anyway if it was last written longer than this ago
+DEFAULT_REWRITE_INTERVAL = 24 * 60 * 60
+
+
+def digest(data):
+    """Compute the digest of a string."""
+    return hashlib.sha1(data).hexdigest()
+
+
+class DigestIndex(object):
+    """Keeps track of the digest of the data last written for each key.
+
+    The index is stored in a FileCache, which maps a key to a (timestamp, data) tuple.
+    The timestamp is the freshness of the entry, i.e., the last run that saw the data,
+    the data is the tuple (digest, timestamp of the last write, path of the file).
+    """
+
+    def __init__(self, filename, rewrite_interval=DEFAULT_REWRITE_INTERVAL):
+        """Initialisation.
+
+        @type filename: string
+        @type rewrite_interval: int, number of seconds after which the file is rewritten regardless
+        """
+        self.filename = filename
+        self.rewrite_interval = rewrite_interval
+        self.cache = FileCache(filename, True)  # we retain the old data
+        self.written = 0
+        self.skipped = 0
+
+    def changed(self, key, data_digest):
+        """Does the digest differ from the one that was last written for the key?
+
+        If not, only the freshness of the index entry is updated, the file is left alone.
+
+        @type key: string
+        @type data_digest: string
+        """
+        now = int(time.time())
+
+        entry = self.cache.load(key)
+        if entry:
+            data = entry[1]
+            (old_digest, written) = data[:2]
+            if old_digest == data_digest and now - written < self.rewrite_interval:
+                self.cache.update(key, data, 0)
+                self.skipped += 1
+                return False
+
+        return True
+
+    def stored(self, key, data_digest, path):
+        """Record that the data with the given digest has been written for the key to the file at path."""
+        self.cache.update(key, (data_digest, int(time.time()), path), 0)
+        self.written += 1
+
+    def freshness(self, key):
+        """Get the timestamp of the last run that saw the data for the key, or None if the key is unknown."""
+        entry = self.cache.load(key)
+        if entry:
+            return entry[0]
+        return None
+
+    def close(self):
+        """Store the index."""
+        logger.info("Digest index %s: %d files written, %d unchanged files skipped" %
+                    (self.filename, self.written, self.skipped))
+        self.cache.close()
+
+    def flush(self):
+        """Store the index and keep using it, e.g., between the cycles of a long-running script."""
+        self.close()
+        self.cache = FileCache(self.filename, True)
+        self.written = 0
+        self.skipped = 0
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+##
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Per-host cache of the information returned by the Moab masters.
+
+The last good result of every host is kept. A host is only queried again once its result is
+older than the refresh interval, so slow masters can be polled less often. When a query fails,
+the last good result is used instead, as long as it is not older than the maximal staleness.
+The hosts for which such a fallback was used, or whose cached result is older than a cycle, are
+reported with the time their result was collected, so the data can be marked as stale.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import cPickle
+import os
+import time
+
+from vsc.utils import fancylogger
+
+logger = fancylogger.getLogger(__name__)
+
+DEFAULT_REFRESH_INTERVAL = 0  # seconds, always query
+DEFAULT_MAX_STALE = 60 * 60  # seconds
+DEFAULT_CYCLE = 0  # seconds, every cached result is older than the cycle
+
+
+def stale_users(host_information, stale_hosts):
+    """Determine which users have information from the stale hosts.
+
+    @type host_information: dict mapping the host to its information, a dict with the users as keys
+    @type stale_hosts: dict mapping the stale hosts to the time their information was collected
+
+    @returns: dict mapping the user to a dict with the stale hosts of the user and their timestamp
+    """
+    users = {}
+    for (host, timestamp) in stale_hosts.items():
+        for user in host_information.get(host, {}):
+            users.setdefault(user, {})[host] = timestamp
+    return users
+
+
+def stale_information(information, users):
+    """Merge the stale hosts of the given users, i.e., the staleinfo of their information.
+
+    @type information: dict with the users as keys
+    @type users: dict mapping the user to the stale hosts, as returned by stale_users
+    """
+    staleinfo = {}
+    for user in information:
+        if user in users:
+            staleinfo.update(users[user])
+    return staleinfo
+
+
+class HostCache(object):
+    """Keeps the last good result (information, timestamp) of every host."""
+
+    def __init__(self, filename, refresh_interval=DEFAULT_REFRESH_INTERVAL, max_stale=DEFAULT_MAX_STALE,
+                 cycle=DEFAULT_CYCLE):
+        """Initialisation.
+
+        @type filename: string, the file where the cache is stored
+        @type refresh_interval: int, number of seconds during which a result is used without querying the host
+        @type max_stale: int, number of seconds during which a result is used when querying the host fails
+        @type cycle: int, number of seconds between collections, cached results that are older are stale
+        """
+        self.filename = filename
+        self.refresh_interval = refresh_interval
+        self.max_stale = max_stale
+        self.cycle = cycle
+        self.hosts = {}
+        self._load()
+        self.reset()
+
+    def _load(self):
+        if not os.path.exists(self.filename):
+            return
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                self.hosts = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception, err:
+            logger.warning("Could not load host cache %s, starting from scratch: %s" % (self.filename, err))
+            self.hosts = {}
+
+    def store(self):
+        """Store the cache on disk."""
+        temp_filename = "%s.tmp" % (self.filename)
+        f = open(temp_filename, 'wb')
+        try:
+            cPickle.dump(self.hosts, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(temp_filename, self.filename)
+
+    def reset(self):
+        """Start a new collection: clear the counters and the stale hosts."""
+        self.hits = 0
+        self.misses = 0
+        self.stale = {}
+
+    def fresh(self, host):
+        """Get the cached information if it is recent enough to skip querying the host, None otherwise.
+
+        The host is added to the stale hosts when the information is older than a cycle.
+
+        @returns: tuple (information, timestamp at which the information was collected), or None
+        """
+        if host in self.hosts:
+            (information, timestamp) = self.hosts[host]
+            age = time.time() - timestamp
+            if age < self.refresh_interval:
+                self.hits += 1
+                if age > self.cycle:
+                    self.stale[host] = timestamp
+                return (information, timestamp)
+        self.misses += 1
+        return None
+
+    def update(self, host, information):
+        """Store the result of a successful query."""
+        self.hosts[host] = (information, time.time())
+
+    def fallback(self, host):
+        """Get the cached information for a host whose query failed, None if there is none or it is too old.
+
+        The host is added to the stale hosts, mapped to the timestamp of the information.
+        """
+        if host in self.hosts:
+            (information, timestamp) = self.hosts[host]
+            if time.time() - timestamp < self.max_stale:
+                logger.warning("Using the information of host %s from %s" % (host, time.ctime(timestamp)))
+                self.stale[host] = timestamp
+                return information
+        return None
+
+    def stale_users(self):
+        """Determine which users have information from the stale hosts of the last collection, see stale_users."""
+        return stale_users(dict([(host, self.hosts[host][0]) for host in self.stale]), self.stale)
+
+    def statistics(self):
+        """The counters of the last collection, for the nagios result."""
+        return {
+            'host_cache_hits': self.hits,
+            'host_cache_misses': self.misses,
+            'hosts_stale': len(self.stale),
+        }
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+##
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Keyed on-disk cache backed by sqlite, for caches that are updated one key at a time.
+
+The semantics of update() follow those of vsc.utils.cache.FileCache, with the old data
+always retained, but each update only touches the affected row rather than rewriting
+the complete cache file.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import cPickle
+import os
+import sqlite3
+import time
+
+from vsc.utils import fancylogger
+from vsc.utils.cache import FileCache
+
+logger = fancylogger.getLogger(__name__)
+
+
+class KeyedCache(object):
+    """Cache mapping a string key to a (timestamp, data) tuple, stored in an sqlite database."""
+
+    def __init__(self, filename):
+        """Initialisation.
+
+        @type filename: string, the sqlite database file
+        """
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cache "
+                                "(key TEXT PRIMARY KEY, timestamp REAL NOT NULL, data BLOB NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS cache_timestamp ON cache (timestamp)")
+
+    def load(self, key):
+        """Get the (timestamp, data) tuple for the key, or None if the key is not present."""
+        row = self.connection.execute("SELECT timestamp, data FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return (row[0], cPickle.loads(str(row[1])))
+
+    def _store(self, key, timestamp, data):
+        self.connection.execute("INSERT OR REPLACE INTO cache (key, timestamp, data) VALUES (?, ?, ?)",
+                                (key, timestamp, sqlite3.Binary(cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL))))
+
+    def update(self, key, data, threshold):
+        """Store the data for the key if there is no entry or if the entry is older than threshold seconds.
+
+        @returns: True if the entry was stored, False if the existing entry was kept.
+        """
+        now = time.time()
+        row = self.connection.execute("SELECT timestamp FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is not None and now - row[0] <= threshold:
+            return False
+
+        self._store(key, now, data)
+        return True
+
+    def expired(self, threshold):
+        """Get the keys of the entries that are older than threshold seconds."""
+        rows = self.connection.execute("SELECT key FROM cache WHERE timestamp < ?", (time.time() - threshold,))
+        return [row[0] for row in rows]
+
+    def purge(self, threshold):
+        """Remove the entries that are older than threshold seconds.
+
+        @returns: the number of removed entries
+        """
+        cursor = self.connection.execute("DELETE FROM cache WHERE timestamp < ?", (time.time() - threshold,))
+        return cursor.rowcount
+
+    def migrate(self, file_cache_filename):
+        """Import the entries of a FileCache, unless the key is already present.
+
+        @returns: the number of imported entries
+        """
+        file_cache = FileCache(file_cache_filename, True)
+        count = 0
+        for (key, (timestamp, data)) in file_cache.shelf.items():
+            key = str(getattr(key, 'user_id', key))
+            if self.load(key) is None:
+                self._store(key, timestamp, data)
+                count += 1
+        self.connection.commit()
+        logger.info("Migrated %d entries from %s to %s" % (count, file_cache_filename, self.filename))
+        return count
+
+    def close(self):
+        """Commit the changes and close the database."""
+        self.connection.commit()
+        self.connection.close()
+
+
+def open_keyed_cache(filename, legacy_filename=None):
+    """Open the KeyedCache, migrating the entries from the legacy FileCache when the database is new."""
+    is_new = not os.path.exists(filename)
+    cache = KeyedCache(filename)
+    if is_new and legacy_filename and os.path.exists(legacy_filename):
+        cache.migrate(legacy_filename)
+    return cache
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+##
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Local snapshot of the VO groups and users in the VSC LDAP.
+
+Rather than looking up all groups and users on every run, the snapshot is stored on disk
+and refreshed incrementally, by only looking up the entries whose modifyTimestamp is more
+recent than the previous refresh. Entries that are removed from the LDAP are only dropped
+from the snapshot by the full rebuild, which is done when the snapshot is older than the
+configured interval.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import cPickle
+import os
+import time
+
+from vsc.utils import fancylogger
+
+logger = fancylogger.getLogger(__name__)
+
+DEFAULT_FULL_REFRESH_INTERVAL = 24 * 60 * 60
+# look back a bit further than the last refresh, to cope with clock skew between us and the LDAP server
+MODIFY_TIMESTAMP_OVERLAP = 5 * 60
+
+
+def ldap_timestamp(timestamp):
+    """Convert a unix timestamp to the LDAP GeneralizedTime format used by modifyTimestamp."""
+    return time.strftime("%Y%m%d%H%M%SZ", time.gmtime(timestamp))
+
+
+class LdapSnapshot(object):
+    """Snapshot of the VO groups (group ID -> member user IDs) and users (user ID -> gecos).
+
+    The LDAP entity classes are passed in, so a stand-in can be used instead of the real LDAP.
+    They should provide a lookup(ldap_filter) class method, the groups should have group_id and
+    memberUid attributes, the users user_id and gecos attributes.
+    """
+
+    def __init__(self, filename, group_class, user_class, filter_class,
+                 full_refresh_interval=DEFAULT_FULL_REFRESH_INTERVAL, group_prefix='gvo'):
+        """Initialisation.
+
+        @type filename: string, the file where the snapshot is stored
+        @type group_class: the LDAP group entity class, e.g., VscLdapGroup
+        @type user_class: the LDAP user entity class, e.g., VscLdapUser
+        @type filter_class: the LDAP filter class, e.g., LdapFilter
+        @type full_refresh_interval: int, number of seconds after which the snapshot is fully rebuilt
+        @type group_prefix: string, only groups whose ID starts with this prefix are kept
+        """
+        self.filename = filename
+        self.group_class = group_class
+        self.user_class = user_class
+        self.filter_class = filter_class
+        self.full_refresh_interval = full_refresh_interval
+        self.group_prefix = group_prefix
+
+        self.groups = {}
+        self.users = {}
+        self.last_refresh = 0
+        self.last_full_refresh = 0
+
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.filename):
+            return
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                (self.groups, self.users, self.last_refresh, self.last_full_refresh) = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception, err:
+            logger.warning("Could not load LDAP snapshot %s, doing a full refresh: %s" % (self.filename, err))
+            self.groups = {}
+            self.users = {}
+            self.last_refresh = 0
+            self.last_full_refresh = 0
+
+    def _store(self):
+        temp_filename = "%s.tmp" % (self.filename)
+        f = open(temp_filename, 'wb')
+        try:
+            cPickle.dump((self.groups, self.users, self.last_refresh, self.last_full_refresh), f,
+                         cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(temp_filename, self.filename)
+
+    def _update(self, ldap_filter):
+        """Add or replace the groups and users matching the filter.
+
+        @returns: tuple with the number of updated groups and users
+        """
+        groups = [g for g in self.group_class.lookup(ldap_filter) if g.group_id.startswith(self.group_prefix)]
+        for group in groups:
+            self.groups[group.group_id] = list(group.memberUid)
+
+        users = self.user_class.lookup(ldap_filter)
+        for user in users:
+            self.users[user.user_id] = user.gecos
+
+        return (len(groups), len(users))
+
+    def refresh(self, base_filter, force_full=False):
+        """Bring the snapshot up to date.
+
+        @type base_filter: LDAP filter selecting the relevant groups and users, e.g., the institutes
+        @type force_full: boolean, rebuild the snapshot even if the full refresh interval has not passed
+        """
+        now = time.time()
+
+        if force_full or not self.last_full_refresh or now - self.last_full_refresh > self.full_refresh_interval:
+            logger.info("Rebuilding the LDAP snapshot %s" % (self.filename))
+            self.groups = {}
+            self.users = {}
+            (group_count, user_count) = self._update(base_filter)
+            self.last_full_refresh = now
+        else:
+            since = ldap_timestamp(self.last_refresh - MODIFY_TIMESTAMP_OVERLAP)
+            modified_filter = base_filter & self.filter_class("modifyTimestamp>=%s" % (since))
+            (group_count, user_count) = self._update(modified_filter)
+
+        self.last_refresh = now
+        logger.info("LDAP snapshot refreshed: %d groups and %d users updated, %d groups and %d users in total" %
+                    (group_count, user_count, len(self.groups), len(self.users)))
+
+        self._store()
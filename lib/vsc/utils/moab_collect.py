@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+##
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Concurrent collection of Moab command information from multiple masters.
+
+The vsc.jobs.moab classes (Showq, Checkjob) query the masters one after the other, so a single
+slow master delays the complete collection. Here every master is queried from its own thread
+with its own instance of the command class, and masters that do not answer before the deadline
+are reported as failed without blocking the others. The thread of such a master is abandoned, and
+the master is skipped in the subsequent collections until that thread has finished, so threads
+do not pile up on a master that hangs.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import copy
+import re
+import threading
+import time
+
+from vsc.utils import fancylogger
+
+logger = fancylogger.getLogger(__name__)
+
+DEFAULT_HOST_DEADLINE = 120  # seconds
+
+# the last collector thread started per (command class, host)
+_collectors = {}
+_collectors_lock = threading.Lock()
+
+
+def merge_information(target, information):
+    """Merge the per-user information of a single host into the target dict.
+
+    Values that are dicts are merged, values that are lists are concatenated, other values are replaced.
+    """
+    for (user, user_information) in information.items():
+        current = target.get(user)
+        if current is None:
+            target[user] = user_information
+        elif isinstance(current, dict) and isinstance(user_information, dict):
+            current.update(user_information)
+        elif isinstance(current, list) and isinstance(user_information, list):
+            current.extend(user_information)
+        else:
+            target[user] = user_information
+
+
+def merge_hosts(host_information):
+    """Merge the information of all hosts into a single dict.
+
+    The per-host information is left untouched.
+
+    @type host_information: dict mapping the host to its information
+    """
+    information = {}
+    for host in sorted(host_information.keys()):
+        merge_information(information, dict([(user, copy.copy(user_information))
+                                             for (user, user_information) in host_information[host].items()]))
+    return information
+
+
+def latency_statistics(latencies):
+    """The latency values for the NagiosResult: one <host>_latency value per host, and the maximum.
+
+    @type latencies: dict mapping host to latency in seconds, as returned by collect_per_host
+    """
+    statistics = dict([("%s_latency" % (re.sub(r'\W', '_', host)), round(latency, 3))
+                       for (host, latency) in latencies.items()])
+    statistics['host_latency_max'] = round(max(latencies.values() or [0]), 3)
+    return statistics
+
+
+def collect_per_host(command_class, clusters, deadline=DEFAULT_HOST_DEADLINE, cache=None, **kwargs):
+    """Run get_moab_command_information for every host concurrently.
+
+    @type command_class: the vsc.jobs.moab class to use, e.g., Showq or Checkjob
+    @type clusters: dict mapping the host to its master and path, as expected by command_class
+    @type deadline: number of seconds after which the hosts that did not finish are considered to have failed
+    @type cache: HostCache instance, or None. Hosts with a fresh cached result are not queried, and failed
+                 hosts fall back to their cached result, if any. Such hosts are still reported as failed. The
+                 hosts whose cached result is older than a cycle are kept in the stale hosts of the cache.
+
+    A host whose thread from a previous call is still running is not queried again, and is reported as failed.
+    @param kwargs: passed to the command_class constructor
+
+    @returns: tuple (dict mapping the reported hosts to their information, failed hosts,
+                     dict mapping host to latency in seconds)
+    """
+    results = {}
+    latencies = {}
+    lock = threading.Lock()
+
+    def query(host):
+        start = time.time()
+        try:
+            result = command_class({host: clusters[host]}, **kwargs).get_moab_command_information()
+        except Exception, err:
+            logger.error("Collecting information from host %s failed: %s" % (host, err))
+            result = None
+        lock.acquire()
+        try:
+            results[host] = result
+            latencies[host] = time.time() - start
+        finally:
+            lock.release()
+
+    host_information = {}
+    queried_hosts = []
+    if cache:
+        cache.reset()
+    for host in clusters:
+        cached = None
+        if cache:
+            cached = cache.fresh(host)
+        if cached is None:
+            queried_hosts.append(host)
+        else:
+            host_information[host] = cached[0]
+
+    threads = []
+    busy_hosts = []
+    _collectors_lock.acquire()
+    try:
+        for host in queried_hosts:
+            previous = _collectors.get((command_class, host))
+            if previous is not None and previous.isAlive():
+                logger.warning("Host %s is still being queried by a previous %s collection, skipping it" %
+                               (host, command_class.__name__))
+                busy_hosts.append(host)
+                continue
+            thread = threading.Thread(target=query, args=(host,))
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+            _collectors[(command_class, host)] = thread
+    finally:
+        _collectors_lock.release()
+
+    end = time.time() + deadline
+    for thread in threads:
+        thread.join(max(0, end - time.time()))
+
+    failed_hosts = []
+
+    lock.acquire()
+    try:
+        for host in queried_hosts:
+            if host in busy_hosts:
+                result = None
+            elif host not in results:
+                logger.warning("Host %s did not report within %s seconds" % (host, deadline))
+                latencies[host] = float(deadline)
+                result = None
+            else:
+                result = results[host]
+
+            if result is None or result[2]:
+                failed_hosts.append(host)
+                if cache:
+                    information = cache.fallback(host)
+                    if information is not None:
+                        host_information[host] = information
+                continue
+
+            host_information[host] = result[0]
+            if cache:
+                cache.update(host, result[0])
+    finally:
+        lock.release()
+
+    logger.info("Collected information from %d hosts, %d failed, latencies: %s" %
+                (len(host_information), len(failed_hosts), latencies))
+    return (host_information, failed_hosts, latencies)
+
+
+def collect_concurrently(command_class, clusters, deadline=DEFAULT_HOST_DEADLINE, cache=None, **kwargs):
+    """Run get_moab_command_information for every host concurrently and merge the results.
+
+    See collect_per_host for the arguments.
+
+    @returns: tuple (information, reported hosts, failed hosts, dict mapping host to latency in seconds)
+    """
+    (host_information, failed_hosts, latencies) = collect_per_host(command_class, clusters, deadline, cache, **kwargs)
+    reported_hosts = [host for host in host_information if host not in failed_hosts]
+    return (merge_hosts(host_information), reported_hosts, failed_hosts, latencies)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+##
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Run a function periodically, for scripts that can run as a daemon instead of from cron.
+
+The cycles never overlap: the next cycle is scheduled interval seconds after the start of the
+previous one, or immediately when the previous cycle took longer than the interval. While
+waiting, a heartbeat function is called regularly, e.g., to renew a lock file.
+
+run_daemon combines this with the lock file, HA check and nagios reporting the master scripts
+need in daemon mode.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import os
+import signal
+import time
+
+from vsc.utils import fancylogger
+from vsc.utils.availability import proceed_on_ha_service
+from vsc.utils.nagios import NagiosResult, NAGIOS_EXIT_OK, NAGIOS_EXIT_WARNING, NAGIOS_EXIT_CRITICAL
+
+logger = fancylogger.getLogger(__name__)
+
+DEFAULT_HEARTBEAT_INTERVAL = 60  # seconds
+
+
+def touch_lockfile(lockfile):
+    """Renew the timestamp in the lock file, indicating the owner is still alive.
+
+    A TimestampedPidLockfile keeps the pid and timestamp in the contents of the file, so these are
+    rewritten, in a temporary file that is renamed over the lock file. The lock file thus always exists.
+
+    @type lockfile: TimestampedPidLockfile instance, held by this process
+
+    @returns: True if the lock was renewed, False if it is no longer held by this process
+    """
+    if not lockfile.i_am_locking():
+        logger.error("Not renewing lock file %s, it is not held by this process" % (lockfile.path))
+        return False
+
+    temp_path = "%s.%d.tmp" % (lockfile.path, os.getpid())
+    f = open(temp_path, 'w')
+    try:
+        f.write("%d\n%d\n" % (os.getpid(), int(time.time())))
+    finally:
+        f.close()
+    os.rename(temp_path, lockfile.path)
+    return True
+
+
+class PeriodicRunner(object):
+    """Calls a function every interval seconds, until stopped by SIGTERM or SIGINT."""
+
+    def __init__(self, interval, heartbeat=None, heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL):
+        """Initialisation.
+
+        @type interval: int, number of seconds between the start of subsequent cycles
+        @type heartbeat: function without arguments, or None
+        @type heartbeat_interval: int, maximal number of seconds between heartbeats while waiting
+        """
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self.heartbeat_interval = heartbeat_interval
+        self.stopped = False
+        self.cycles = 0
+
+    def stop(self, signum=None, frame=None):
+        """Stop after the current cycle."""
+        logger.info("Stopping after the current cycle (signal %s)" % (signum))
+        self.stopped = True
+
+    def _wait(self, until):
+        """Sleep until the given time, calling the heartbeat regularly."""
+        while not self.stopped:
+            now = time.time()
+            if now >= until:
+                break
+            if self.heartbeat:
+                self.heartbeat()
+            time.sleep(min(until - now, self.heartbeat_interval))
+
+    def run(self, cycle):
+        """Call cycle() periodically until stopped.
+
+        Exceptions raised by a cycle are logged, they do not stop the runner.
+
+        @type cycle: function without arguments
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        while not self.stopped:
+            start = time.time()
+            if self.heartbeat:
+                self.heartbeat()
+
+            try:
+                cycle()
+            except Exception, err:
+                logger.exception("Cycle %d failed: %s" % (self.cycles, err))
+            self.cycles += 1
+
+            duration = time.time() - start
+            if duration > self.interval:
+                logger.warning("Cycle %d took %.1f seconds, longer than the interval of %d seconds" %
+                               (self.cycles, duration, self.interval))
+            else:
+                logger.info("Cycle %d took %.1f seconds" % (self.cycles, duration))
+
+            self._wait(start + self.interval)
+
+        logger.info("Stopped after %d cycles" % (self.cycles))
+
+
+def run_daemon(opts, lockfile, nagios_reporter, collect, flush=None):
+    """Run collect every opts.options.interval seconds, until stopped.
+
+    Cycles are skipped when not running on the HA master. The lock file is renewed while running,
+    and the result of every cycle is cached for nagios.
+
+    @type opts: the script options, with the ha and interval options
+    @type lockfile: TimestampedPidLockfile instance, held by this process
+    @type nagios_reporter: NagiosReporter instance
+    @type collect: function without arguments, returning a dict with the values for the NagiosResult
+    @type flush: function without arguments called after every successful cycle, e.g., to store a digest index
+
+    @returns: dict with the values of the last successful cycle
+    """
+    stats = {}
+
+    def cycle():
+        if not proceed_on_ha_service(opts.options.ha):
+            logger.warning("Not running on the target host in the HA setup. Skipping cycle.")
+            nagios_reporter.cache(NAGIOS_EXIT_WARNING, NagiosResult("Not running on the HA master."))
+            return
+        try:
+            cycle_stats = collect()
+        except Exception, err:
+            nagios_reporter.cache(NAGIOS_EXIT_CRITICAL, NagiosResult("cycle failed - %s" % (err)))
+            raise
+        if flush:
+            flush()
+        nagios_reporter.cache(NAGIOS_EXIT_OK, NagiosResult("cycle successful", **cycle_stats))
+        stats.update(cycle_stats)
+
+    PeriodicRunner(opts.options.interval, heartbeat=lambda: touch_lockfile(lockfile)).run(cycle)
+    return stats
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+##
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Data that is pickled once and can then be embedded in other pickles at the cost of a copy.
+
+When the same information is stored for many users, serialising it again for every user
+is wasteful. A PickledPayload holds the serialised data; pickling the payload emits the
+serialised bytes and a call to cPickle.loads, so unpickling it yields the original data.
+Readers of the resulting file do not need to know about this class.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import cPickle
+
+
+class PickledPayload(object):
+    """Holds the pickled representation of some data."""
+
+    def __init__(self, data):
+        self.pickled = cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+
+    def load(self):
+        """Get a copy of the original data."""
+        return cPickle.loads(self.pickled)
+
+    def __len__(self):
+        return len(self.pickled)
+
+    def __reduce__(self):
+        return (cPickle.loads, (self.pickled,))
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+##
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Compact binary format for the per-user queue information files (.showq, .checkjob).
+
+The header and the job counts are defined below and do not depend on Python, so they can be read
+from any language. All integers and floats are little endian.
+
+A queue file consists of
+    - a fixed size header of 24 bytes:
+        - magic: 6 bytes, 'VSCQUE'
+        - version: uint8, currently 3
+        - kind: uint8, 1 for showq, 2 for checkjob information
+        - timestamp: float64, the time the information was collected, in seconds since the epoch
+        - counts length: uint32, the number of bytes of the job counts section
+        - body length: uint32, the number of bytes of the body
+    - the job counts section, which can be read without decoding the body:
+        - number of entries: uint32
+        - per entry: the path to a job list in the information, as a string with the keys joined
+          by '/' (e.g., 'vsc40001/gengar/Running'), followed by the length of that list as uint32
+    - the body: the information itself, as a pickle (protocol 2) of plain data only, i.e., dicts,
+      lists, tuples, strings, numbers, booleans and None. Pickles referring to classes are refused
+      when reading, so the files do not depend on the class layouts of the scripts that wrote them.
+
+A string in the job counts section is its length in bytes as uint32, followed by the UTF-8 encoded
+characters.
+
+The pickle files in the original format are written by store_pickle, which sets their owner like
+that of the queue files.
+
+The body was a tagged encoding of the values in version 2, which was several times slower to
+encode and decode in Python than the pickle, and larger.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import cPickle
+import os
+import struct
+import threading
+
+from cStringIO import StringIO
+
+from vsc.utils import fancylogger
+from vsc.utils.fs_store import FileStoreError
+
+logger = fancylogger.getLogger(__name__)
+
+MAGIC = 'VSCQUE'
+VERSION = 3
+
+KIND_SHOWQ = 1
+KIND_CHECKJOB = 2
+
+# magic, version, kind, timestamp, counts length, body length
+HEADER = struct.Struct('<6sBBdII')
+UINT32 = struct.Struct('<I')
+
+PICKLE_PROTOCOL = 2
+
+
+class QueueFileError(Exception):
+    """Raised when a queue file cannot be encoded or decoded."""
+    pass
+
+
+class QueueFileHeader(object):
+    """The information available without decoding the body of a queue file."""
+
+    def __init__(self, version, kind, timestamp, counts):
+        self.version = version
+        self.kind = kind
+        self.timestamp = timestamp
+        self.counts = counts
+
+    def jobs(self):
+        """Total number of jobs in the file."""
+        return sum(self.counts.values())
+
+    def __repr__(self):
+        return "QueueFileHeader(version=%d, kind=%d, timestamp=%s, jobs=%d)" % \
+               (self.version, self.kind, self.timestamp, self.jobs())
+
+
+def _encode_string(value, parts):
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    parts.append(UINT32.pack(len(value)))
+    parts.append(value)
+
+
+def encode(value):
+    """Encode the value, see the module documentation for the format."""
+    return cPickle.dumps(value, PICKLE_PROTOCOL)
+
+
+def _decode_string(data, offset):
+    length = UINT32.unpack_from(data, offset)[0]
+    offset += UINT32.size
+    end = offset + length
+    if end > len(data):
+        raise QueueFileError("Truncated string")
+    return (data[offset:end], end)
+
+
+def decode(data):
+    """Decode a value encoded with encode."""
+    unpickler = cPickle.Unpickler(StringIO(data))
+    # only plain data, no classes
+    unpickler.find_global = None
+    try:
+        return unpickler.load()
+    except (cPickle.UnpicklingError, EOFError, ValueError), err:
+        raise QueueFileError("Cannot decode the body: %s" % (err))
+
+
+def encode_counts(counts):
+    """Encode the job counts section."""
+    parts = [UINT32.pack(len(counts))]
+    for (path, count) in sorted(counts.items()):
+        _encode_string(path, parts)
+        parts.append(UINT32.pack(count))
+    return "".join(parts)
+
+
+def decode_counts(data):
+    """Decode the job counts section.
+
+    @returns: dict mapping the path to a job list to its length
+    """
+    try:
+        entries = UINT32.unpack_from(data, 0)[0]
+        offset = UINT32.size
+        counts = {}
+        for _ in xrange(entries):
+            (path, offset) = _decode_string(data, offset)
+            counts[path] = UINT32.unpack_from(data, offset)[0]
+            offset += UINT32.size
+    except struct.error, err:
+        raise QueueFileError("Truncated job counts: %s" % (err))
+    if offset != len(data):
+        raise QueueFileError("Trailing data after the job counts")
+    return counts
+
+
+def job_counts(information, prefix=None, counts=None):
+    """Determine the length of every list in the (nested dict) information.
+
+    @returns: dict mapping the path to the list (keys joined by '/') to its length
+    """
+    if counts is None:
+        counts = {}
+
+    if isinstance(information, dict):
+        for (key, value) in information.items():
+            if prefix is None:
+                path = str(key)
+            else:
+                path = "%s/%s" % (prefix, key)
+            job_counts(value, path, counts)
+    elif isinstance(information, tuple):
+        for value in information:
+            job_counts(value, prefix, counts)
+    elif isinstance(information, list) and prefix is not None:
+        counts[prefix] = counts.get(prefix, 0) + len(information)
+
+    return counts
+
+
+class QueueFileBody(object):
+    """Encoded information, which can be stored with different timestamps without encoding it again."""
+
+    def __init__(self, information):
+        self.counts = encode_counts(job_counts(information))
+        self.data = encode(information)
+
+    def __len__(self):
+        return len(self.counts) + len(self.data)
+
+
+def dumps(kind, timestamp, body):
+    """Build the queue file contents.
+
+    @type kind: KIND_SHOWQ or KIND_CHECKJOB
+    @type timestamp: float, the time the information was collected
+    @type body: QueueFileBody instance
+    """
+    header = HEADER.pack(MAGIC, VERSION, kind, timestamp, len(body.counts), len(body.data))
+    return "".join([header, body.counts, body.data])
+
+
+def _unpack_header(data):
+    """Decode the fixed size header.
+
+    @returns: tuple (version, kind, timestamp, counts length, body length)
+    """
+    if len(data) < HEADER.size:
+        raise QueueFileError("Truncated queue file header")
+    (magic, version, kind, timestamp, counts_length, body_length) = HEADER.unpack(data[:HEADER.size])
+    if magic != MAGIC:
+        raise QueueFileError("Not a queue file")
+    if version != VERSION:
+        raise QueueFileError("Unsupported queue file version %d" % (version))
+    return (version, kind, timestamp, counts_length, body_length)
+
+
+def loads(data, header_only=False):
+    """Decode the queue file contents.
+
+    @returns: tuple (QueueFileHeader, information), the information is None if header_only is set
+    """
+    (version, kind, timestamp, counts_length, body_length) = _unpack_header(data)
+
+    start = HEADER.size
+    end = start + counts_length
+    if header_only:
+        body_length = 0
+    if len(data) < end + body_length:
+        raise QueueFileError("Truncated queue file")
+
+    header = QueueFileHeader(version, kind, timestamp, decode_counts(data[start:end]))
+    if header_only:
+        return (header, None)
+    return (header, decode(data[end:end + body_length]))
+
+
+def read_header(filename):
+    """Read the header and job counts of the queue file, without reading the body.
+
+    @returns: QueueFileHeader instance
+    """
+    f = open(filename, 'rb')
+    try:
+        data = f.read(HEADER.size)
+        counts_length = _unpack_header(data)[3]
+        data += f.read(counts_length)
+    finally:
+        f.close()
+
+    return loads(data, header_only=True)[0]
+
+
+def read(filename):
+    """Read the complete queue file.
+
+    @returns: tuple (QueueFileHeader, information)
+    """
+    f = open(filename, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+
+    return loads(data)
+
+
+def _write_all(fd, data):
+    """Write all data to the file descriptor, os.write may write only part of it."""
+    view = buffer(data)
+    while view:
+        written = os.write(fd, view)
+        view = buffer(view, written)
+
+
+def _write(filename, data, mode, owner):
+    """Atomically write the data to the file, through a temporary file that is renamed into place.
+
+    The owner and mode are set on the temporary file, so the file never has other permissions.
+    """
+    path = os.path.dirname(filename)
+    temp_filename = os.path.join(path, ".%s.%d.%d.tmp" % (os.path.basename(filename),
+                                                          os.getpid(),
+                                                          threading.currentThread().ident))
+    try:
+        fd = os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        try:
+            _write_all(fd, data)
+            if owner:
+                os.fchown(fd, owner[0], owner[1])
+            os.fchmod(fd, mode)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        os.rename(temp_filename, filename)
+    except Exception:
+        if os.path.exists(temp_filename):
+            os.unlink(temp_filename)
+        raise
+
+
+def write(filename, kind, timestamp, body, owner=None, mode=0640):
+    """Atomically write the queue file.
+
+    The file is written to a temporary file in the same directory, which gets its owner and mode through
+    the open file descriptor before it is renamed into place. Only the calling thread is involved, the
+    effective user of the process is not changed, so files can be written concurrently.
+
+    @type owner: tuple (uid, gid), or None to keep the user running this process
+
+    @raises FileStoreError: when the file cannot be written
+    """
+    data = dumps(kind, timestamp, body)
+
+    if owner and os.geteuid() != 0:
+        owner = None
+
+    try:
+        _write(filename, data, mode, owner)
+    except (IOError, OSError), err:
+        raise FileStoreError(filename, err)
+
+    return filename
+
+
+def _directory_owner(path):
+    """The (uid, gid) of the directory the file is stored in."""
+    try:
+        path_stat = os.stat(os.path.dirname(path))
+    except OSError, err:
+        raise FileStoreError(path, err)
+    return (path_stat.st_uid, path_stat.st_gid)
+
+
+def store(kind, user_id, path, payload):
+    """Store the queue information for the user in the binary queue file format.
+
+    The signature follows that of the store functions in vsc.administration.user, so the WriterPool
+    can use it in their place. The file is owned by the owner of the directory it is stored in.
+
+    @type kind: KIND_SHOWQ or KIND_CHECKJOB
+    @type user_id: string
+    @type path: string, the full path of the file
+    @type payload: tuple (timestamp, QueueFileBody)
+    """
+    (timestamp, body) = payload
+    return write(path, kind, timestamp, body, _directory_owner(path))
+
+
+def store_pickle(user_id, path, payload, mode=0640):
+    """Store the information for the user as a pickle file, written like the queue files.
+
+    The store functions in vsc.administration.user switch the effective user of the whole process, so
+    they cannot run concurrently in the WriterPool threads. This function has the same signature, and
+    sets the owner on the temporary file instead.
+
+    @type user_id: string
+    @type path: string, the full path of the file
+    @type payload: the data to pickle, e.g., a PickledPayload instance
+    """
+    data = cPickle.dumps(payload, cPickle.HIGHEST_PROTOCOL)
+    owner = _directory_owner(path)
+    if os.geteuid() != 0:
+        owner = None
+
+    try:
+        _write(path, data, mode, owner)
+    except (IOError, OSError), err:
+        raise FileStoreError(path, err)
+
+    return path
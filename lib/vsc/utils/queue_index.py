@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+##
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Central, memory-mapped index of the queue information of all users of a cluster.
+
+Rather than storing a file in the home directory of every user, the information of all users
+is written sequentially into a few shard files, <filename>.0 up to <filename>.<shards - 1>.
+Each shard file consists of
+    - a fixed size header: magic, format version, number of shards, timestamp, number of users
+    - the directory: one fixed size record per user, sorted on the user name, holding the
+      offset and length of the user's data
+    - the data: for every user the contents of a queue file (see vsc.utils.queue_file)
+
+Users sharing the same data (e.g., the members of a VO) point to the same bytes. A reader
+maps the shard file in memory and looks up a user with a binary search on the directory.
+
+The index files are not world readable. user_view only gives access to the entry of the user
+running it, so it can be used from a privileged (e.g., setgid) wrapper.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import mmap
+import os
+import pwd
+import struct
+import zlib
+
+from vsc.utils import fancylogger
+from vsc.utils.queue_file import loads
+
+logger = fancylogger.getLogger(__name__)
+
+MAGIC = 'VSCQIX'
+VERSION = 1
+
+# magic, version, number of shards, timestamp, number of users
+HEADER = struct.Struct('<6sBBdI')
+# user name, offset, length
+RECORD = struct.Struct('<32sQI')
+MAX_USER_LENGTH = 32
+
+
+class QueueIndexError(Exception):
+    """Raised when the queue index cannot be read."""
+    pass
+
+
+def shard_of(user, shards):
+    """The shard holding the user's entry."""
+    return (zlib.crc32(user) & 0xffffffff) % shards
+
+
+def shard_filename(filename, shard):
+    """The name of the file for the given shard."""
+    return "%s.%d" % (filename, shard)
+
+
+def _write_shard(filename, timestamp, shards, entries, mode):
+    """Write a single shard file atomically.
+
+    @type entries: dict mapping user name to the queue file contents (string)
+
+    @returns: the size of the shard file
+    """
+    users = sorted(entries.keys())
+
+    # identical data is stored once
+    offsets = {}
+    chunks = []
+    directory = []
+    offset = HEADER.size + RECORD.size * len(users)
+    for user in users:
+        data = entries[user]
+        if id(data) not in offsets:
+            offsets[id(data)] = offset
+            chunks.append(data)
+            offset += len(data)
+        directory.append(RECORD.pack(user, offsets[id(data)], len(data)))
+
+    temp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    try:
+        f = os.fdopen(os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), 'wb')
+        try:
+            f.write(HEADER.pack(MAGIC, VERSION, shards, timestamp, len(users)))
+            f.write("".join(directory))
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            os.fchmod(f.fileno(), mode)
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(temp_filename, filename)
+    except Exception:
+        if os.path.exists(temp_filename):
+            os.unlink(temp_filename)
+        raise
+
+    return offset
+
+
+def write_queue_index(filename, timestamp, entries, shards=1, mode=0640):
+    """Write the queue index, one sequential write per shard.
+
+    @type filename: string, the shard files get a .<shard number> suffix
+    @type timestamp: float, the time the information was collected
+    @type entries: dict mapping user name to the queue file contents (string)
+    @type shards: int, number of shard files
+
+    @returns: total number of bytes written
+    """
+    sharded = [{} for _ in range(shards)]
+    for (user, data) in entries.items():
+        if len(user) > MAX_USER_LENGTH:
+            logger.warning("User name %s is too long for the queue index, skipping" % (user))
+            continue
+        sharded[shard_of(user, shards)][user] = data
+
+    size = 0
+    for (shard, shard_entries) in enumerate(sharded):
+        size += _write_shard(shard_filename(filename, shard), timestamp, shards, shard_entries, mode)
+
+    logger.info("Wrote queue index %s for %d users in %d shards, %d bytes" % (filename, len(entries), shards, size))
+    return size
+
+
+class QueueIndex(object):
+    """Looks up entries in a queue index."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._shards = {}
+        (self.shards, self.timestamp) = self._shard(0)[1:3]
+
+    def _shard(self, shard):
+        """Get the (mmap, number of shards, timestamp, number of users) for the shard, mapping the file if needed."""
+        if shard not in self._shards:
+            name = shard_filename(self.filename, shard)
+            f = open(name, 'rb')
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+
+            if len(data) < HEADER.size:
+                data.close()
+                raise QueueIndexError("Truncated queue index %s" % (name))
+            (magic, version, shards, timestamp, count) = HEADER.unpack(data[:HEADER.size])
+            if magic != MAGIC or version != VERSION:
+                data.close()
+                raise QueueIndexError("%s is not a queue index of version %d" % (name, VERSION))
+            if len(data) < HEADER.size + count * RECORD.size:
+                data.close()
+                raise QueueIndexError("Truncated queue index %s" % (name))
+
+            self._shards[shard] = (data, shards, timestamp, count)
+        return self._shards[shard]
+
+    def raw(self, user):
+        """Get the queue file contents stored for the user, or None if the user has no entry."""
+        (data, _, _, count) = self._shard(shard_of(user, self.shards))
+        key = RECORD.pack(user, 0, 0)[:MAX_USER_LENGTH]
+
+        (low, high) = (0, count)
+        while low < high:
+            middle = (low + high) // 2
+            start = HEADER.size + middle * RECORD.size
+            name = data[start:start + MAX_USER_LENGTH]
+            if name < key:
+                low = middle + 1
+            elif name > key:
+                high = middle
+            else:
+                (_, offset, length) = RECORD.unpack(data[start:start + RECORD.size])
+                return data[offset:offset + length]
+        return None
+
+    def get(self, user, header_only=False):
+        """Get the queue information stored for the user.
+
+        @returns: tuple (QueueFileHeader, information) as returned by vsc.utils.queue_file.loads,
+                  or None if the user has no entry
+        """
+        raw = self.raw(user)
+        if raw is None:
+            return None
+        return loads(raw, header_only)
+
+    def close(self):
+        for (data, _, _, _) in self._shards.values():
+            data.close()
+        self._shards = {}
+
+
+def user_view(filename, header_only=False):
+    """Get the queue information for the user running this process, and for that user only.
+
+    @returns: tuple (QueueFileHeader, information), or None if the user has no entry
+    """
+    user = pwd.getpwuid(os.getuid()).pw_name
+    index = QueueIndex(filename)
+    try:
+        return index.get(user, header_only)
+    finally:
+        index.close()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+##
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Determine which users get to see which queue information.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import logging
+
+from vsc.ldap.configuration import VscConfiguration
+from vsc.ldap.filters import InstituteFilter
+from vsc.ldap.utils import LdapQuery
+from vsc.utils import fancylogger
+
+logger = fancylogger.getLogger(__name__)
+
+DEFAULT_VO = 'gvo00012'
+
+
+def resolve_vo_membership(active_users, vo_members, gecos, default_vo=DEFAULT_VO):
+    """Map the active users to the active members of their VO.
+
+    Every VO member list is traversed once, to build the index of active user to VO, which is then
+    inverted into the active members per VO. The cost is thus linear in the number of active users
+    and VO members.
+
+    @type active_users: iterable of user IDs
+    @type vo_members: dict mapping VO ID to the list of member user IDs
+    @type gecos: dict mapping user ID to gecos
+
+    @return: tuple (set of users that belong to a VO, dict with vo IDs as keys (default VO members are their own
+             VO) and dicts mapping uid to gecos as values).
+    """
+    active = set(active_users)
+
+    user_to_vo = {}
+    for (vo, member_uids) in vo_members.items():
+        for uid in member_uids:
+            if uid in active:
+                user_to_vo[uid] = vo
+
+    active_members_per_vo = {}
+    for (uid, vo) in user_to_vo.items():
+        active_members_per_vo.setdefault(vo, set()).add(uid)
+
+    user_maps_per_vo = {}
+    for (vo, uids) in active_members_per_vo.items():
+        if vo == default_vo:
+            # members of the default VO cannot see each other's information
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("users %s belong to the default vo %s" % (sorted(uids), vo))
+            for uid in uids:
+                user_maps_per_vo[uid] = {uid: gecos.get(uid, "")}
+        else:
+            user_maps_per_vo[vo] = dict([(uid, gecos.get(uid, "")) for uid in uids])
+            logger.debug("added userMap for the vo %s" % (vo))
+    # users not in any VO are ignored
+
+    return (set(user_to_vo.keys()), user_maps_per_vo)
+
+
+def collect_vo_ldap(active_users, ldap_snapshot):
+    """Determine which active users are in the same VO.
+
+    @type active_users: list of strings
+    @type ldap_snapshot: LdapSnapshot instance
+
+    @param active_users: the users for which there currently are jobs running
+    @param ldap_snapshot: local copy of the VO groups and users, which is refreshed before use
+
+    Generates a mapping between each user that belongs to a VO for which a member has jobs running and the active users
+    from that VO. If the user belongs to the default VO, he cannot see any information of the other users from this VO.
+
+    @return: see resolve_vo_membership
+    """
+    LdapQuery(VscConfiguration())
+    ldap_filter = InstituteFilter('antwerpen') | InstituteFilter('brussel') | InstituteFilter('gent') | InstituteFilter('leuven')
+    ldap_snapshot.refresh(ldap_filter)
+
+    return resolve_vo_membership(active_users, ldap_snapshot.groups, ldap_snapshot.users)
+
+
+def determine_target_information(information, active_users, queue_information, resolve_vos=None):
+    """Determine for the given information type, what should be stored for which users.
+
+    The users that get to see the same information are grouped: each user on his own for the user
+    information type, the active members of a VO for the vo information type. The resolve_vos function,
+    which maps the active users to a tuple (users in a VO, dict mapping VO to the dict of its active
+    members to gecos), e.g., resolve_vo_membership on the LDAP information, is required for the vo
+    information type.
+
+    @returns: tuple (target users, dict mapping a group key to a tuple (list of member users,
+              queue information for the group, dict mapping uid to gecos for the group))
+    """
+
+    if information == 'user':
+        target_groups = dict([(user, ([user], {user: queue_information[user]}, {user: ""})) for user in active_users])  # FIXME: faking it
+        return (active_users, target_groups)
+    elif information == 'vo':
+        (all_target_users, user_maps_per_vo) = resolve_vos(active_users)
+
+        target_groups = {}
+        for (vo, user_map) in user_maps_per_vo.items():
+            filtered_queue_information = dict([(user_id, queue_information[user_id]) for user_id in user_map if user_id in queue_information])
+            target_groups[vo] = (user_map.keys(), filtered_queue_information, user_map)
+
+        return (all_target_users, target_groups)
+    elif information == 'project':
+        return ([], {})
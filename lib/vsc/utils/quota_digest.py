@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+##
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Central index of the quota information that was last written for each quota entity.
+
+dquota writes a .quota_user.json.gz or .quota_fileset.json.gz file for every entity on
+every run. Since the quota information rarely changes between runs, the index keeps a
+digest of the information last written per (storage, entity), so that only the entities
+whose quota changed need to have their file rewritten. The files of the unchanged entities
+are left alone, their freshness is only recorded in the index.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import cPickle
+
+from vsc.utils.digest_index import DigestIndex, digest
+
+
+def quota_digest(quota):
+    """Compute a digest of the quota information of a QuotaEntity, ignoring the timestamps.
+
+    @type quota: QuotaEntity instance, with the QuotaInformation per fileset in its quota_map
+    """
+    information = []
+    for (fileset, fileset_quota) in sorted(quota.quota_map.items()):
+        values = fileset_quota._asdict()
+        values.pop('timestamp', None)
+        information.append((fileset, sorted(values.items())))
+
+    return digest(cPickle.dumps((quota.__class__.__name__, information), cPickle.HIGHEST_PROTOCOL))
+
+
+class QuotaDigestIndex(DigestIndex):
+    """Keeps track of the digest of the quota information last written for each entity."""
+
+    @staticmethod
+    def _key(storage, kind, entity):
+        return "%s:%s:%s" % (storage, kind, entity)
+
+    def changed(self, storage, kind, entity, quota):
+        """Does the quota information for the entity differ from what was last written?
+
+        If not, only the freshness of the index entry is updated.
+
+        @type storage: string
+        @type kind: string, e.g., USR or FILESET
+        @type entity: the ID of the entity
+        @type quota: QuotaEntity instance
+
+        @returns: the digest of the quota if it should be written, None otherwise.
+        """
+        quota_information_digest = quota_digest(quota)
+        if super(QuotaDigestIndex, self).changed(self._key(storage, kind, entity), quota_information_digest):
+            return quota_information_digest
+        return None
+
+    def stored(self, storage, kind, entity, quota_information_digest, filename):
+        """Record that the quota information with the given digest has been written for the entity to the file."""
+        super(QuotaDigestIndex, self).stored(self._key(storage, kind, entity), quota_information_digest, filename)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+##
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Columnar representation of the GPFS quota information returned by mmrepquota.
+
+The quota records for a single quota type (USR, FILESET, ...) are stored as a set of
+NumPy arrays, one row per GpfsQuota record. The columns are filled in bulk, without
+handling the records one by one in Python.
+
+The table of a run can be saved as a snapshot. The next run compares its table with the
+snapshot, and together with the rows that exceed their quota, this selects the entities for
+which QuotaEntity instances are built. The entities whose quota did not change and that do
+not exceed it are thus never materialised.
+
+NumPy is an optional dependency. Use columnar_available() to check if it can be used.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import os
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from vsc.utils import fancylogger
+
+logger = fancylogger.getLogger(__name__)
+
+# value in the grace column for records that are not in their grace period
+NO_GRACE = -1
+
+# the columns holding the quota values, in the order of the values matrix
+VALUE_COLUMNS = ('blockUsage', 'blockQuota', 'blockLimit', 'blockInDoubt')
+
+# a snapshot is only used for this long after the last time all entities were materialised,
+# so every entity passes through the digest index regularly
+DEFAULT_SNAPSHOT_MAX_AGE = 24 * 60 * 60
+
+
+def columnar_available():
+    """Can we use the columnar representation, i.e., is NumPy present?"""
+    return numpy is not None
+
+
+class QuotaTable(object):
+    """Column store for the GpfsQuota records of a single quota type on a single filesystem.
+
+    The columns are
+        - ids: the entity (user ID or fileset ID) each row belongs to
+        - names: the entity of the row as a string
+        - filesets: the GPFS fileset ID for the record, '' if there is none
+        - values: usage, quota, limit and indoubt block values as int64, one row per record
+        - grace: remaining grace in seconds, 0 if expired and NO_GRACE if not in grace
+        - keys: the entity and fileset of the row, identifying it in a snapshot
+    """
+
+    def __init__(self, quota_map, parse_grace):
+        """Build the columns from a dict mapping entity to a list of GpfsQuota namedtuples.
+
+        @type quota_map: dict of entity -> [GpfsQuota]
+        @type parse_grace: function turning a blockGrace string into a tuple (in grace, seconds or None),
+                           called once per distinct string
+        """
+        if not columnar_available():
+            raise ImportError("NumPy is required for the columnar quota representation")
+
+        ids = []
+        records = []
+        for (entity, gpfs_quotas) in quota_map.iteritems():
+            ids.extend([entity] * len(gpfs_quotas))
+            records.extend(gpfs_quotas)
+
+        self.ids = numpy.array(ids, dtype=object)
+        self.names = numpy.array(ids, dtype=str)
+        if not records:
+            self.filesets = numpy.array([], dtype=str)
+            self.values = numpy.zeros((0, len(VALUE_COLUMNS)), dtype=numpy.int64)
+            self.grace = numpy.zeros(0, dtype=numpy.int64)
+            self.keys = numpy.array([], dtype=str)
+            return
+
+        # transpose the records into their columns
+        fields = records[0]._fields
+        columns = zip(*records)
+        records = None
+
+        def column(name):
+            return columns[fields.index(name)]
+
+        self.filesets = numpy.array([fileset or '' for fileset in column('filesetname')], dtype=str)
+        self.values = numpy.column_stack([numpy.array(column(name), dtype=numpy.int64) for name in VALUE_COLUMNS])
+
+        (grace_strings, grace_index) = numpy.unique(numpy.array(column('blockGrace'), dtype=str), return_inverse=True)
+        grace_seconds = []
+        for grace_string in grace_strings.tolist():
+            (expired, remaining) = parse_grace(grace_string)
+            if expired:
+                grace_seconds.append(remaining or 0)
+            else:
+                grace_seconds.append(NO_GRACE)
+        self.grace = numpy.array(grace_seconds, dtype=numpy.int64)[grace_index]
+
+        self.keys = numpy.char.add(numpy.char.add(self.names, '/'), self.filesets)
+
+        logger.debug("Built quota table with %d rows for %d entities" % (len(ids), len(quota_map)))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def exceeding_mask(self):
+        """Boolean array marking the rows that are in grace or exceed their soft or hard quota."""
+        usage = self.values[:, 0]
+        quota = self.values[:, 1]
+        limit = self.values[:, 2]
+        return (self.grace != NO_GRACE) | ((quota > 0) & (usage > quota)) | ((limit > 0) & (usage > limit))
+
+    def changed_mask(self, snapshot):
+        """Boolean array marking the rows that are new or differ from the snapshot.
+
+        @type snapshot: QuotaTableSnapshot instance, or None to mark all rows
+        """
+        if snapshot is None or not len(snapshot.keys):
+            return numpy.ones(len(self), dtype=bool)
+
+        positions = numpy.searchsorted(snapshot.keys, self.keys)
+        positions = numpy.minimum(positions, len(snapshot.keys) - 1)
+        found = snapshot.keys[positions] == self.keys
+        same = found & (snapshot.grace[positions] == self.grace) & \
+            numpy.all(snapshot.values[positions] == self.values, axis=1)
+        return ~same
+
+    def removed_entities(self, snapshot):
+        """The entities that still have rows in this table, but lost some of the rows in the snapshot."""
+        if snapshot is None or not len(snapshot.keys):
+            return numpy.array([], dtype=str)
+        removed = ~numpy.in1d(snapshot.keys, self.keys)
+        return numpy.unique(snapshot.ids[removed])
+
+    def entity_mask(self, row_mask, entities=None):
+        """Extend the row mask to all rows of the entities having a marked row, or one of the given entities."""
+        marked = numpy.unique(self.names[row_mask])
+        if entities is not None and len(entities):
+            marked = numpy.union1d(marked, entities)
+        return numpy.in1d(self.names, marked)
+
+    def entities(self, entity_factory, fileset_names, timestamp, mask=None):
+        """Build the QuotaEntity instances for the rows in the mask.
+
+        @type entity_factory: function taking an entity ID and returning a fresh QuotaEntity instance
+        @type fileset_names: function mapping a GPFS fileset ID to the fileset name
+        @type timestamp: integer timestamp to store with the quota information
+        @type mask: boolean array selecting the rows, which should hold all rows of an entity, or None for all rows
+
+        @returns: dict mapping entity ID to the updated QuotaEntity
+        """
+        if mask is None:
+            rows = numpy.arange(len(self))
+        else:
+            rows = numpy.flatnonzero(mask)
+
+        entity_map = {}
+        fileset_name_map = {}
+
+        ids = self.ids[rows].tolist()
+        filesets = self.filesets[rows].tolist()
+        values = self.values[rows].tolist()
+        grace = self.grace[rows].tolist()
+
+        for (entity_id, fileset, (usage, quota, limit, indoubt), remaining) in zip(ids, filesets, values, grace):
+            entity = entity_map.get(entity_id)
+            if entity is None:
+                entity = entity_factory(entity_id)
+                entity_map[entity_id] = entity
+
+            if fileset:
+                if fileset not in fileset_name_map:
+                    fileset_name_map[fileset] = fileset_names(fileset)
+                fileset_name = fileset_name_map[fileset]
+            else:
+                fileset_name = None
+
+            if remaining == NO_GRACE:
+                expired = (False, None)
+            else:
+                expired = (True, remaining)
+
+            entity.update(fileset_name, usage, quota, limit, indoubt, expired, timestamp)
+
+        return entity_map
+
+    def snapshot(self, complete, skipped=None):
+        """Get the snapshot of this table, to compare the table of the next run with.
+
+        @type complete: the time all entities were last materialised
+        @type skipped: entities whose rows are left out of the snapshot, e.g., because their file could not be
+                       written, so they are new in the next run
+
+        @returns: QuotaTableSnapshot instance
+        """
+        rows = numpy.arange(len(self))
+        if skipped:
+            rows = numpy.flatnonzero(~numpy.in1d(self.names, numpy.array([str(entity) for entity in skipped])))
+        order = rows[numpy.argsort(self.keys[rows], kind='mergesort')]
+        return QuotaTableSnapshot(self.keys[order], self.names[order], self.values[order],
+                                  self.grace[order], complete)
+
+
+class QuotaTableSnapshot(object):
+    """The keys and values of a QuotaTable, sorted by key, along with the time it was last complete."""
+
+    def __init__(self, keys, ids, values, grace, complete):
+        self.keys = keys
+        self.ids = ids
+        self.values = values
+        self.grace = grace
+        self.complete = complete
+
+    def save(self, filename):
+        """Atomically store the snapshot in the file."""
+        temp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        f = open(temp_filename, 'wb')
+        try:
+            numpy.savez(f, keys=self.keys, ids=self.ids, values=self.values, grace=self.grace,
+                        complete=numpy.array([self.complete], dtype=numpy.int64))
+        finally:
+            f.close()
+        os.rename(temp_filename, filename)
+
+
+def load_snapshot(filename, max_age=DEFAULT_SNAPSHOT_MAX_AGE):
+    """Load the QuotaTableSnapshot stored in the file.
+
+    @type max_age: int, number of seconds after the snapshot was last complete during which it is used
+
+    @returns: the QuotaTableSnapshot, or None if there is none, it cannot be read or it is too old
+    """
+    if not columnar_available() or not os.path.exists(filename):
+        return None
+    try:
+        f = open(filename, 'rb')
+        try:
+            data = numpy.load(f)
+            snapshot = QuotaTableSnapshot(data['keys'], data['ids'], data['values'], data['grace'],
+                                          int(data['complete'][0]))
+        finally:
+            f.close()
+    except Exception, err:
+        logger.warning("Could not load the quota table snapshot %s, ignoring it: %s" % (filename, err))
+        return None
+
+    if time.time() - snapshot.complete > max_age:
+        logger.info("Quota table snapshot %s is older than %d seconds, ignoring it" % (filename, max_age))
+        return None
+    return snapshot
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+##
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Append-only time series of quota information, one file per filesystem.
+
+Every run appends a fixed-size binary record per quota entry (entity and fileset) with
+the usage, soft and hard limits, in-doubt blocks and remaining grace. Each record also
+holds the number of the previous record of the same entry, so the records of an entry
+form a chain that is followed backwards from its last record. A separate index file only
+keeps the entry keys and the number of the last record of every entry, so it does not grow
+with the history. The data file is read through mmap.
+
+The data file is appended before the index is stored. Records beyond the ones the index
+knows about are left by a run that did not complete, and are truncated when the time
+series is opened. A single run appends at most a fixed number of records, so a run with
+bogus quota information cannot blow up the data file.
+
+The forecaster fits a linear growth to the last records of every entry at once, and
+estimates the time until each entry reaches its hard limit. It requires NumPy, the rest
+of this module does not.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import array
+import cPickle
+import mmap
+import os
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from vsc.utils import fancylogger
+
+logger = fancylogger.getLogger(__name__)
+
+MAGIC = 'VSCQTS'
+VERSION = 2
+HEADER = struct.Struct('<6sHI')  # magic, version, record size
+# timestamp, entry number, previous record of the entry (-1 if none), usage, soft, hard, in doubt,
+# grace (seconds, -1 if not in grace)
+RECORD = struct.Struct('<qiqqqqqq')
+NO_GRACE = -1
+NO_RECORD = -1
+
+DEFAULT_WINDOW = 12  # number of records used for the forecast
+DEFAULT_MAX_APPEND_RECORDS = 2000000  # about 120MB per run
+
+
+def record_dtype():
+    """The NumPy dtype corresponding to RECORD."""
+    return numpy.dtype([
+        ('timestamp', '<i8'),
+        ('entry', '<i4'),
+        ('previous', '<i8'),
+        ('usage', '<i8'),
+        ('soft', '<i8'),
+        ('hard', '<i8'),
+        ('doubt', '<i8'),
+        ('grace', '<i8'),
+    ])
+
+
+class QuotaTimeSeriesError(Exception):
+    pass
+
+
+class QuotaTimeSeries(object):
+    """Time series store for the quota information of a single filesystem.
+
+    An entry is identified by a string key, e.g., USR:2540001:vsc40001 or FILESET:2:gvo00002.
+    """
+
+    def __init__(self, filename):
+        """Initialisation.
+
+        @type filename: string, the data file. The index is stored in filename.index
+        """
+        self.filename = filename
+        self.index_filename = "%s.index" % (filename)
+
+        self.keys = []
+        self.entries = {}
+        self.last = array.array('l')
+        self.count = 0
+
+        if os.path.exists(self.filename):
+            self._check_header()
+            if os.path.exists(self.index_filename):
+                self._load_index()
+            else:
+                raise QuotaTimeSeriesError("Missing index %s for time series %s" % (self.index_filename, self.filename))
+            self._truncate()
+        else:
+            f = open(self.filename, 'wb')
+            try:
+                f.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+            finally:
+                f.close()
+
+    def _check_header(self):
+        f = open(self.filename, 'rb')
+        try:
+            (magic, version, record_size) = HEADER.unpack(f.read(HEADER.size))
+        finally:
+            f.close()
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            raise QuotaTimeSeriesError("Unsupported time series file %s (%s, %s, %s)" %
+                                       (self.filename, magic, version, record_size))
+
+    def _truncate(self):
+        """Drop the records the index does not know about, i.e., those of a run that did not complete."""
+        records = (os.path.getsize(self.filename) - HEADER.size) // RECORD.size
+        if records < self.count:
+            raise QuotaTimeSeriesError("Time series %s has %d records, its index refers to %d records" %
+                                       (self.filename, records, self.count))
+
+        size = HEADER.size + self.count * RECORD.size
+        if os.path.getsize(self.filename) > size:
+            logger.warning("Truncating time series %s to the %d records in its index, dropping %d records" %
+                           (self.filename, self.count, records - self.count))
+            f = open(self.filename, 'r+b')
+            try:
+                f.truncate(size)
+            finally:
+                f.close()
+
+    def _load_index(self):
+        f = open(self.index_filename, 'rb')
+        try:
+            (self.keys, self.last, self.count) = cPickle.load(f)
+        finally:
+            f.close()
+        self.entries = dict([(key, number) for (number, key) in enumerate(self.keys)])
+
+    def _store_index(self):
+        temp_filename = "%s.tmp" % (self.index_filename)
+        f = open(temp_filename, 'wb')
+        try:
+            cPickle.dump((self.keys, self.last, self.count), f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(temp_filename, self.index_filename)
+
+    def _entry(self, key):
+        """Get the entry number for the key, adding it if it is new."""
+        number = self.entries.get(key)
+        if number is None:
+            number = len(self.keys)
+            self.keys.append(key)
+            self.entries[key] = number
+            self.last.append(NO_RECORD)
+        return number
+
+    def append(self, timestamp, samples, max_records=DEFAULT_MAX_APPEND_RECORDS):
+        """Append the records for a single run.
+
+        Nothing is appended if there are more than max_records samples.
+
+        @type timestamp: int
+        @type samples: iterable of (key, usage, soft, hard, doubt, grace) tuples
+        @type max_records: int
+        """
+        data = []
+        count = self.count
+        known_keys = len(self.keys)
+        last = {}
+        for (key, usage, soft, hard, doubt, grace) in samples:
+            if count - self.count >= max_records:
+                for new_key in self.keys[known_keys:]:
+                    del self.entries[new_key]
+                del self.keys[known_keys:]
+                del self.last[known_keys:]
+                raise QuotaTimeSeriesError("More than %d records for a single run of time series %s, not appending" %
+                                           (max_records, self.filename))
+            number = self._entry(key)
+            data.append(RECORD.pack(timestamp, number, last.get(number, self.last[number]),
+                                    usage, soft, hard, doubt, grace))
+            last[number] = count
+            count += 1
+
+        for (number, record) in last.items():
+            self.last[number] = record
+
+        f = open(self.filename, 'ab')
+        try:
+            f.write(''.join(data))
+        finally:
+            f.close()
+
+        logger.debug("Appended %d records to %s" % (count - self.count, self.filename))
+        self.count = count
+        self._store_index()
+
+    def _map(self):
+        f = open(self.filename, 'rb')
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+    def history(self, key):
+        """Get the records for the given key.
+
+        @returns: list of (timestamp, usage, soft, hard, doubt, grace) tuples, oldest first
+        """
+        number = self.entries.get(key)
+        if number is None or not self.count:
+            return []
+
+        data = self._map()
+        try:
+            result = []
+            record = self.last[number]
+            while record != NO_RECORD:
+                values = RECORD.unpack_from(data, HEADER.size + record * RECORD.size)
+                result.append(values[:1] + values[3:])
+                record = values[2]
+            result.reverse()
+            return result
+        finally:
+            data.close()
+
+    def forecast(self, window=DEFAULT_WINDOW):
+        """Estimate for every entry the number of seconds until its usage reaches the hard limit.
+
+        A least squares linear fit is made to the last window records of each entry.
+
+        @returns: dict mapping key to the estimated number of seconds, 0 if the hard limit is already
+                  reached, or None if the usage is not growing or there is no hard limit.
+        """
+        if numpy is None:
+            raise ImportError("NumPy is required for the quota forecast")
+        if not self.count:
+            return {}
+
+        data = self._map()
+        records = None
+        try:
+            records = numpy.frombuffer(data, dtype=record_dtype(), count=self.count, offset=HEADER.size)
+
+            # matrix of record numbers, one row per entry, following the chain of every entry backwards
+            # and padding on the left with its oldest record
+            selection = numpy.empty((len(self.keys), window), dtype=numpy.int64)
+            selection[:, -1] = numpy.frombuffer(self.last, dtype=numpy.dtype('l')).astype(numpy.int64)
+            for column in xrange(window - 1, 0, -1):
+                previous = records['previous'][selection[:, column]]
+                selection[:, column - 1] = numpy.where(previous != NO_RECORD, previous, selection[:, column])
+
+            selected = records[selection]
+            times = selected['timestamp'].astype(numpy.float64)
+            usage = selected['usage'].astype(numpy.float64)
+            hard = selected['hard'][:, -1].astype(numpy.float64)
+
+            times_centered = times - times.mean(axis=1)[:, numpy.newaxis]
+            variance = (times_centered ** 2).sum(axis=1)
+            covariance = (times_centered * (usage - usage.mean(axis=1)[:, numpy.newaxis])).sum(axis=1)
+            slope = numpy.where(variance > 0, covariance / numpy.where(variance > 0, variance, 1), 0.0)
+
+            remaining = hard - usage[:, -1]
+            growing = (slope > 0) & (hard > 0)
+            seconds = numpy.where(growing, numpy.maximum(remaining, 0) / numpy.where(growing, slope, 1), -1)
+            seconds = numpy.where((hard > 0) & (remaining <= 0), 0, seconds)
+        finally:
+            records = None  # drop the view on the mapped data before unmapping
+            data.close()
+
+        result = {}
+        for (number, key) in enumerate(self.keys):
+            value = seconds[number]
+            if value < 0:
+                result[key] = None
+            else:
+                result[key] = float(value)
+        return result
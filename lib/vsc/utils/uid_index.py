@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+##
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Persistent index mapping UIDs to user names.
+
+Listing all users through pwd.getpwall() is expensive when the passwd database is backed by
+LDAP. The index keeps the names on disk in a FileCache, and only the UIDs that are requested
+and whose entry is missing or older than the TTL are resolved again. If too many of them need
+resolving, a single bulk listing is done instead.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import pwd
+import time
+
+from vsc.utils import fancylogger
+from vsc.utils.cache import FileCache
+
+logger = fancylogger.getLogger(__name__)
+
+DEFAULT_TTL = 24 * 60 * 60
+# if more than this fraction of the requested UIDs needs resolving, list all users instead
+DEFAULT_BULK_FRACTION = 0.1
+
+
+class UidIndex(object):
+    """On-disk UID to user name map, refreshed lazily.
+
+    UIDs that are unknown to the passwd database are stored with name None, so they are not
+    looked up again until their entry expires. The UIDs are stored as strings, so the keys
+    survive the serialisation of the FileCache.
+    """
+
+    def __init__(self, filename, ttl=DEFAULT_TTL, bulk_fraction=DEFAULT_BULK_FRACTION):
+        """Initialisation.
+
+        @type filename: string, the file the index is stored in
+        @type ttl: int, number of seconds an entry remains valid
+        @type bulk_fraction: float, fraction of stale UIDs above which all users are listed
+        """
+        self.filename = filename
+        self.ttl = ttl
+        self.bulk_fraction = bulk_fraction
+        self.cache = FileCache(filename, True)  # we retain the old data
+
+    def _fresh(self, uid, now):
+        """Return the tuple (True, name) if there is a valid entry for the uid, (False, None) otherwise."""
+        entry = self.cache.load(str(uid))
+        if entry:
+            (timestamp, name) = entry
+            if now - timestamp < self.ttl:
+                return (True, name)
+        return (False, None)
+
+    def _bulk_refresh(self):
+        """Refresh all entries from the complete passwd database.
+
+        @returns: dict mapping all known UIDs to their user name
+        """
+        logger.info("Refreshing the complete UID index from the passwd database")
+        all_names = {}
+        for entry in pwd.getpwall():
+            all_names[entry[2]] = entry[0]
+            self.cache.update(str(entry[2]), entry[0], 0)
+        return all_names
+
+    def lookup(self, uids):
+        """Get the user names for the given UIDs.
+
+        @type uids: iterable of int
+
+        @returns: dict mapping the uid to the user name, for the UIDs known to the passwd database.
+        """
+        now = time.time()
+        names = {}
+        stale = []
+
+        uids = set(uids)
+        for uid in uids:
+            (fresh, name) = self._fresh(uid, now)
+            if fresh:
+                if name:
+                    names[uid] = name
+            else:
+                stale.append(uid)
+
+        logger.info("UID index: %d UIDs requested, %d need resolving" % (len(uids), len(stale)))
+
+        if stale and len(stale) > self.bulk_fraction * len(uids):
+            all_names = self._bulk_refresh()
+            for uid in stale:
+                if uid in all_names:
+                    names[uid] = all_names[uid]
+                else:
+                    self.cache.update(str(uid), None, 0)
+        else:
+            for uid in stale:
+                try:
+                    name = pwd.getpwuid(uid)[0]
+                    names[uid] = name
+                except KeyError:
+                    name = None
+                self.cache.update(str(uid), name, 0)
+
+        return names
+
+    def close(self):
+        """Store the index."""
+        self.cache.close()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+##
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Bounded-concurrency pool for writing many small files to (network) filesystems.
+
+Writing per-user files is dominated by waiting on filesystem metadata operations, so the
+writes are executed by a pool of threads. The number of concurrent writes can additionally
+be limited per target filesystem. A failing write only affects the item it was submitted for,
+and a write that does not finish within the timeout is abandoned and counted as failed.
+
+@author: Andy Georges (Ghent University)
+"""
+
+import math
+import os
+import Queue
+import threading
+import time
+
+from vsc.utils import fancylogger
+
+logger = fancylogger.getLogger(__name__)
+
+DEFAULT_WORKERS = 8
+
+
+class WriterTimeout(Exception):
+    """The write did not finish in time."""
+    pass
+
+
+def mount_point(path, cache=None):
+    """Determine the mount point of the filesystem the path is on, to be used as the target of a write.
+
+    @type path: string
+    @type cache: dict mapping directories to their mount point, shared between calls to avoid
+                 repeating the os.path.ismount checks for paths with a common parent
+    """
+    if cache is None:
+        cache = {}
+
+    visited = []
+    current = os.path.abspath(path)
+    while current not in cache:
+        visited.append(current)
+        if os.path.ismount(current):
+            cache[current] = current
+            break
+        parent = os.path.dirname(current)
+        if parent == current:
+            cache[current] = current
+            break
+        current = parent
+
+    result = cache[current]
+    for directory in visited:
+        cache[directory] = result
+    return result
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list of values.
+
+    @type values: sorted list of numbers
+    @type fraction: float between 0 and 1
+    """
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(math.ceil(fraction * len(values))) - 1))
+    return values[index]
+
+
+class WriterStats(object):
+    """Counters for a single run of the WriterPool."""
+
+    def __init__(self):
+        self.written = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.latencies = []
+        self.elapsed = 0.0
+
+    def throughput(self):
+        """Number of successful writes per second."""
+        if self.elapsed > 0:
+            return self.written / self.elapsed
+        return 0.0
+
+    def summary(self):
+        """Dict with the counters, suitable for a NagiosResult or a log line."""
+        latencies = sorted(self.latencies)
+        return {
+            'written': self.written,
+            'failed': self.failed,
+            'timeouts': self.timeouts,
+            'elapsed': self.elapsed,
+            'throughput': self.throughput(),
+            'p50': percentile(latencies, 0.50),
+            'p90': percentile(latencies, 0.90),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies and latencies[-1] or 0.0,
+        }
+
+    def __str__(self):
+        return ("written=%(written)d failed=%(failed)d timeouts=%(timeouts)d elapsed=%(elapsed).2fs throughput=%(throughput).1f/s "
+                "latency p50=%(p50).3fs p90=%(p90).3fs p99=%(p99).3fs max=%(max).3fs" % self.summary())
+
+
+class WriterPool(object):
+    """Execute write functions for a set of items using a fixed number of threads.
+
+    Each submitted write has a key (e.g., the user ID), a target (e.g., the filesystem it writes to),
+    and a function with its arguments. The result of run() is a tuple (results, failures, stats), where
+    results maps the key to the return value of the function and failures maps the key to the
+    exception that was raised.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, target_limits=None, default_target_limit=None, timeout=None):
+        """Initialisation.
+
+        @type workers: int, number of threads
+        @type target_limits: dict mapping a target to the maximal number of concurrent writes
+        @type default_target_limit: int, limit for targets not in target_limits, None for no limit
+        @type timeout: number of seconds after which a single write is abandoned, None for no timeout
+
+        An abandoned write keeps running in the background and keeps counting against the limit of
+        its target until it finishes, so a hanging filesystem does not get more writes thrown at it.
+        """
+        self.workers = max(1, int(workers))
+        self.target_limits = target_limits or {}
+        self.default_target_limit = default_target_limit
+        self.timeout = timeout
+
+        self._semaphores = {}
+        self._semaphores_lock = threading.Lock()
+        self._tasks = []
+
+    def _semaphore(self, target):
+        """Get the semaphore limiting the concurrent writes to the target, or None if unlimited."""
+        self._semaphores_lock.acquire()
+        try:
+            if target not in self._semaphores:
+                limit = self.target_limits.get(target, self.default_target_limit)
+                if limit:
+                    self._semaphores[target] = threading.BoundedSemaphore(int(limit))
+                else:
+                    self._semaphores[target] = None
+            return self._semaphores[target]
+        finally:
+            self._semaphores_lock.release()
+
+    def submit(self, key, target, function, *args, **kwargs):
+        """Add a write to be executed by run()."""
+        self._tasks.append((key, target, function, args, kwargs))
+
+    def _call(self, function, args, kwargs, outcome, semaphore):
+        """Call the function, storing (succeeded, result or exception) in outcome and releasing the semaphore."""
+        try:
+            try:
+                outcome.append((True, function(*args, **kwargs)))
+            except Exception, err:
+                outcome.append((False, err))
+        finally:
+            if semaphore:
+                semaphore.release()
+
+    def _execute(self, task):
+        """Execute a single task, returning (key, succeeded, result or exception, latency)."""
+        (key, target, function, args, kwargs) = task
+        semaphore = self._semaphore(target)
+        if semaphore:
+            semaphore.acquire()
+
+        outcome = []
+        start = time.time()
+        if self.timeout:
+            thread = threading.Thread(target=self._call, args=(function, args, kwargs, outcome, semaphore))
+            thread.setDaemon(True)
+            thread.start()
+            thread.join(self.timeout)
+            if thread.isAlive():
+                outcome = [(False, WriterTimeout("write did not finish within %s seconds" % (self.timeout,)))]
+        else:
+            self._call(function, args, kwargs, outcome, semaphore)
+        latency = time.time() - start
+
+        (succeeded, value) = outcome[0]
+        if not succeeded:
+            logger.error("Write for %s on %s failed: %s" % (key, target, value))
+        return (key, succeeded, value, latency)
+
+    def _worker(self, tasks, done):
+        while True:
+            try:
+                task = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            done.put(self._execute(task))
+
+    def run(self):
+        """Execute all submitted writes and wait for them to finish.
+
+        @returns: tuple (results, failures, WriterStats instance)
+        """
+        tasks = Queue.Queue()
+        done = Queue.Queue()
+        for task in self._tasks:
+            tasks.put(task)
+        task_count = len(self._tasks)
+        self._tasks = []
+
+        stats = WriterStats()
+        start = time.time()
+
+        if self.workers == 1 or task_count <= 1:
+            self._worker(tasks, done)
+        else:
+            threads = []
+            for _ in range(min(self.workers, task_count)):
+                thread = threading.Thread(target=self._worker, args=(tasks, done))
+                thread.setDaemon(True)
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+
+        stats.elapsed = time.time() - start
+
+        results = {}
+        failures = {}
+        while not done.empty():
+            (key, succeeded, value, latency) = done.get_nowait()
+            stats.latencies.append(latency)
+            if succeeded:
+                results[key] = value
+                stats.written += 1
+            else:
+                failures[key] = value
+                stats.failed += 1
+                if isinstance(value, WriterTimeout):
+                    stats.timeouts += 1
+
+        logger.info("Writer pool finished %d writes with %d workers: %s" % (task_count, self.workers, stats))
+        return (results, failures, stats)